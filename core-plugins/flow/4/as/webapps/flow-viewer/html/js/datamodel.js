@@ -407,6 +407,10 @@ define(["openbis",
              * @param platePermId string Identifier of the plate to process
              * @param plateType string Type of the plate to process
              * @param mode string One of "normal" or "zip"
+             * @param incremental boolean (optional) If true, update an existing export in the user
+             * folder: only new or changed files are copied (mode "normal" only).
+             * @param compression string (optional) One of "none" or "deflate": if "deflate", the files
+             * are compressed in the archive (mode "zip" only).
              */
             callServerSidePluginExportDataSets: function (task,
                                                           collectionId,
@@ -416,7 +420,9 @@ define(["openbis",
                                                           experimentSampleType,
                                                           platePermId,
                                                           plateType,
-                                                          mode) {
+                                                          mode,
+                                                          incremental,
+                                                          compression) {
 
                 // Parameters for the aggregation service
                 let parameters = {
@@ -428,7 +434,9 @@ define(["openbis",
                     expSampleType: experimentSampleType,
                     platePermId: platePermId,
                     plateType: plateType,
-                    mode: mode
+                    mode: mode,
+                    incremental: incremental === true ? "true" : "false",
+                    compression: compression === "deflate" ? "deflate" : "none"
                 };
 
                 // Inform the user that we are about to process the request
@@ -471,6 +479,28 @@ define(["openbis",
                 }
             },
 
+            /**
+             * Cancel a running export.
+             *
+             * The export stops copying files and removes its partial output; its
+             * final state is reported by the pending status poll.
+             *
+             * @param uid string Unique identifier of the export job.
+             */
+            callServerSidePluginCancelExport: function (uid) {
+
+                // Inform the user that the export is being cancelled
+                DATAVIEWER.displayStatus("Cancelling the export...", "warning");
+
+                // Call the service
+                let options = new AggregationServiceExecutionOptions();
+                options.withParameter("uid", uid);
+                options.withParameter("cancel", "true");
+                DATAMODEL.openbisV3.executeAggregationService(
+                    DATAMODEL.exportDatasetsService.getPermId(),
+                    options);
+            },
+
             /**
              * Generate a scatter plot for FCS file of given code and parameters.
              * @param node DynaTree node Node from the experiment structure tree.
@@ -481,13 +511,29 @@ define(["openbis",
              * @param displayY string Display type of the parameter for the Y axis ("LIN" or "LOG)
              * @param maxNumEvents int Maximum number of events to be retrieved from the server.
              * @param samplingMethod
+             * @param compensate string "1" to compensate the events with the spillover matrix, "0" otherwise.
              */
-            callServerSidePluginGenerateFCSPlot: function (node, code, paramX, paramY, displayX, displayY, maxNumEvents, samplingMethod) {
+            callServerSidePluginGenerateFCSPlot: function (node, code, paramX, paramY, displayX, displayY, maxNumEvents, samplingMethod, compensate) {
+
+                // Parameters for the aggregation service
+                let parameters = {
+                    code: code,
+                    paramX: paramX,
+                    paramY: paramY,
+                    displayX: displayX,
+                    displayY: displayY,
+                    numEvents: node.data.parameterInfo['numEvents'],
+                    maxNumEvents: maxNumEvents,
+                    samplingMethod: samplingMethod,
+                    compensate: compensate,
+                    nodeKey: node.data.key
+                };
 
                 // Check whether the data for the plot is already cached
                 if (node.data.cached) {
                     let key = code + "_" + paramX + "_" + paramY + "_" + maxNumEvents.toString() +
-                        "_" + displayX + "_" + displayY + "_" + samplingMethod.toString();
+                        "_" + displayX + "_" + displayY + "_" + samplingMethod.toString() +
+                        "_" + compensate.toString();
                     if (node.data.cached.hasOwnProperty(key)) {
 
                         // Plot the cached data
@@ -496,23 +542,60 @@ define(["openbis",
                             paramX,
                             paramY,
                             displayX,
-                            displayY);
+                            displayY,
+                            parameters);
 
                         // Return immediately
                         return;
                     }
                 }
 
+                // Inform the user that we are about to process the request
+                DATAVIEWER.displayStatus("Please wait while processing your request. This might take a while...",
+                    "info");
+
+                // Call service
+                DATAMODEL.callServerSidePluginRetrieveFCSEvents(parameters);
+            },
+
+            /**
+             * Retrieve the events of a plot that fall inside the zoomed viewport, drawn from all
+             * events of the FCS file.
+             * @param plotParameters Object Parameters of the aggregation service used for the plot.
+             * @param viewport Object Axis ranges {xMin, xMax, yMin, yMax} in display coordinates
+             * (missing bounds are unbounded).
+             */
+            callServerSidePluginRetrieveViewportEvents: function (plotParameters, viewport) {
+
+                // Parameters for the aggregation service
+                let parameters = $.extend({}, plotParameters, {
+                    mode: "viewport",
+                    viewport: JSON.stringify(viewport)
+                });
+
+                // Inform the user that we are about to process the request
+                DATAVIEWER.displayStatus("Please wait while retrieving the events in the zoomed region...",
+                    "info");
+
+                // Call service
+                DATAMODEL.callServerSidePluginRetrieveFCSEvents(parameters);
+            },
+
+            /**
+             * Compute a statistic of the FCS files of all wells of a plate and display it as a heatmap.
+             * @param node DynaTree node Plate node from the experiment structure tree.
+             * @param parameter string Name of the parameter (not needed for the event count).
+             * @param statistic string One of "count", "mean", "sd", "cv", "min", "max", "median" or "p<N>"
+             * for the N-th percentile.
+             */
+            callServerSidePluginComputePlateStatistics: function (node, parameter, statistic) {
+
                 // Parameters for the aggregation service
                 let parameters = {
-                    code: code,
-                    paramX: paramX,
-                    paramY: paramY,
-                    displayX: displayX,
-                    displayY: displayY,
-                    numEvents: node.data.parameterInfo['numEvents'],
-                    maxNumEvents: maxNumEvents,
-                    samplingMethod: samplingMethod,
+                    mode: "plate",
+                    samplePermId: node.data.element.getPermId().permId,
+                    paramX: parameter,
+                    statistic: statistic,
                     nodeKey: node.data.key
                 };
 
@@ -521,6 +604,16 @@ define(["openbis",
                     "info");
 
                 // Call service
+                DATAMODEL.callServerSidePluginRetrieveFCSEvents(parameters);
+            },
+
+            /**
+             * Call the retrieve_fcs_events server-side plug-in with given parameters (the
+             * plug-in is retrieved the first time it is called).
+             * @param parameters Object Parameters for the aggregation service.
+             */
+            callServerSidePluginRetrieveFCSEvents: function (parameters) {
+
                 if (null === DATAMODEL.retrieveFCSEventsService) {
                     let criteria = new AggregationServiceSearchCriteria();
                     criteria.withName().thatEquals("retrieve_fcs_events");
@@ -533,15 +626,7 @@ define(["openbis",
                         DATAMODEL.retrieveFCSEventsService = result.getObjects()[0];
 
                         // Now call the service
-                        let options = new AggregationServiceExecutionOptions();
-                        for (let key in parameters) {
-                            options.withParameter(key, parameters[key]);
-                        }
-                        DATAMODEL.openbisV3.executeAggregationService(
-                            DATAMODEL.retrieveFCSEventsService.getPermId(),
-                            options).then(function(result) {
-                            DATAMODEL.processResultsFromRetrieveFCSEventsServerSidePlugin(result);
-                        });
+                        DATAMODEL.callServerSidePluginRetrieveFCSEvents(parameters);
                     });
                 } else {
                     // Call the service
@@ -1150,6 +1235,19 @@ define(["openbis",
 
                 if (r_Completed === 0) {
 
+                    // Display the progress of the export (the first reply only
+                    // contains the uid and the completion state)
+                    let r_Progress = row.length > 3 ? row[3].value : "";
+                    if (r_Progress !== "") {
+                        DATAVIEWER.displayStatus(
+                            r_Progress + "&nbsp;<a id=\"cancel_export_link\" href=\"#\">Cancel</a>",
+                            "info");
+                        $("#cancel_export_link").click(function (e) {
+                            e.preventDefault();
+                            DATAMODEL.callServerSidePluginCancelExport(r_UID);
+                        });
+                    }
+
                     // Call the plug-in
                     setTimeout(function () {
 
@@ -1186,8 +1284,16 @@ define(["openbis",
                 let r_RelativeExpFolder = row[5].value;
                 let r_ZipArchiveFileName = row[6].value;
                 let r_Mode = row[7].value;
+                let r_NSkippedFiles = row.length > 8 ? row[8].value : 0;
+                let r_Cancelled = row.length > 15 ? row[15].value : 0;
 
-                if (r_Success === 1) {
+                if (r_Cancelled === 1) {
+                    status = "The export was cancelled.";
+                    if (r_Mode === "normal") {
+                        status = status + " The partially exported files were removed.";
+                    }
+                    level = "warning";
+                } else if (r_Success === 1) {
                     let snip = "<b>Congratulations!</b>&nbsp;";
                     if (r_NCopiedFiles === 1) {
                         snip = snip + "<span class=\"badge\">1</span> file was ";
@@ -1196,6 +1302,11 @@ define(["openbis",
                     }
                     if (r_Mode === "normal") {
                         status = snip + "successfully exported to {...}/" + r_RelativeExpFolder + ".";
+                        if (r_NSkippedFiles > 0) {
+                            status = status + "&nbsp;<span class=\"badge\">" + r_NSkippedFiles +
+                                "</span> unchanged " + (r_NSkippedFiles === 1 ? "file was" : "files were") +
+                                " already there and skipped.";
+                        }
                     } else {
                         // Add a placeholder to store the download URL.
                         status = snip + "successfully packaged. <span id=\"download_url_span\"></span>";
@@ -1262,6 +1373,18 @@ define(["openbis",
 
                 if (r_Completed === 0) {
 
+                    // Is the job waiting for server memory to be released?
+                    let r_Queued = row[14].value;
+                    if (r_Queued === 1) {
+                        DATAVIEWER.displayStatus(
+                            "The server is busy: your request is queued and will be processed as soon as possible.",
+                            "warning");
+                    } else if (row[3].value !== "") {
+
+                        // Display the progress reported by the job
+                        DATAVIEWER.displayStatus(row[3].value, "info");
+                    }
+
                     // Call the plug-in
                     setTimeout(function () {
 
@@ -1300,6 +1423,10 @@ define(["openbis",
                 let r_MaxNumEvents = row[11].value;
                 let r_SamplingMethod = row[12].value;
                 let r_NodeKey = row[13].value;
+                let r_Compensate = row[15].value;
+                let r_Mode = row[16].value;
+                let r_Gates = row[17].value;
+                let r_Population = row[19].value;
 
                 let level;
                 if (r_Success === 1) {
@@ -1308,12 +1435,42 @@ define(["openbis",
                     status = r_ErrorMessage;
                     level = "success";
 
+                    // Plate statistics are displayed as a heatmap
+                    if (r_Mode === "plate") {
+                        DATAVIEWER.plotPlateHeatmap(r_Data);
+                        DATAVIEWER.hideStatus();
+                        return table;
+                    }
+
+                    // Parameters to retrieve the events of a zoomed region of the plot
+                    let plotParameters = {
+                        code: r_Code,
+                        paramX: r_ParamX,
+                        paramY: r_ParamY,
+                        displayX: r_DisplayX,
+                        displayY: r_DisplayY,
+                        numEvents: r_NumEvents,
+                        maxNumEvents: r_MaxNumEvents,
+                        samplingMethod: r_SamplingMethod,
+                        compensate: r_Compensate,
+                        gates: r_Gates,
+                        population: r_Population,
+                        nodeKey: r_NodeKey
+                    };
+
                     // Plot the data
-                    DATAVIEWER.plotFCSData(r_Data, r_ParamX, r_ParamY, r_DisplayX, r_DisplayY);
+                    DATAVIEWER.plotFCSData(r_Data, r_ParamX, r_ParamY, r_DisplayX, r_DisplayY, plotParameters);
+
+                    // The events of a zoomed region are not cached
+                    if (r_Mode === "viewport") {
+                        DATAVIEWER.hideStatus();
+                        return table;
+                    }
 
                     // Cache the plotted data
                     let dataKey = r_Code + "_" + r_ParamX + "_" + r_ParamY + "_" + r_MaxNumEvents.toString() +
-                        "_" + r_DisplayX + "_" + r_DisplayY + "_" + r_SamplingMethod.toString();
+                        "_" + r_DisplayX + "_" + r_DisplayY + "_" + r_SamplingMethod.toString() +
+                        "_" + r_Compensate.toString();
                     DATAVIEWER.cacheFCSData(r_NodeKey, dataKey, r_Data);
 
                 } else {
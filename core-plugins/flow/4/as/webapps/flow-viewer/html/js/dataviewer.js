@@ -212,6 +212,9 @@ define(["d3", "c3"], function (d3, c3) {
                 detailViewSampleID.append($("<p>").html("This plate has geometry " +
                     node.data.element.properties[DATAMODEL.EXPERIMENT_PREFIX + "_PLATE_GEOMETRY"] + "."));
 
+                // Display the form to be used for the plate heatmap
+                this.renderPlateStatisticsForm(node);
+
             } else if (node.data.element.getType().code.endsWith("_TUBE")) {
 
                 let sortType = "This is a standard sort.";
@@ -455,6 +458,69 @@ define(["d3", "c3"], function (d3, c3) {
 
                 $("#detailViewAction").append(link);
 
+                // Update a previous export: only new or changed files are copied
+                img = $("<img>")
+                    .attr("src", "img/export.png")
+                    .attr("width", 32)
+                    .attr("height", 32);
+
+                link = $("<a>")
+                    .addClass("action")
+                    .attr("href", "#")
+                    .html("")
+                    .hover(function () {
+                            $("#detailViewActionExpl").html(
+                                "Update previous export in your folder (only new or changed files are copied).");
+                        },
+                        function () {
+                            $("#detailViewActionExpl").html("");
+                        })
+                    .attr("title", "")
+                    .click(function () {
+                        DATAMODEL.callServerSidePluginExportDataSets(
+                            task, collectionId, collectionType,
+                            experimentSampleId, experimentSamplePermId,
+                            experimentSampleType, platePermId, plateType, "normal", true);
+                        return false;
+                    });
+
+                link.prepend(img);
+
+                $("#detailViewAction").append(link);
+
+                // Export all experiments of the collection in one job
+                if (task === "EXPERIMENT_SAMPLE") {
+
+                    img = $("<img>")
+                        .attr("src", "img/export.png")
+                        .attr("width", 32)
+                        .attr("height", 32);
+
+                    link = $("<a>")
+                        .addClass("action")
+                        .attr("href", "#")
+                        .html("")
+                        .hover(function () {
+                                $("#detailViewActionExpl").html(
+                                    "Export all experiments of the collection to your folder.");
+                            },
+                            function () {
+                                $("#detailViewActionExpl").html("");
+                            })
+                        .attr("title", "")
+                        .click(function () {
+                            DATAMODEL.callServerSidePluginExportDataSets(
+                                "COLLECTION", collectionId, collectionType,
+                                experimentSampleId, experimentSamplePermId,
+                                experimentSampleType, "", "", "normal");
+                            return false;
+                        });
+
+                    link.prepend(img);
+
+                    $("#detailViewAction").append(link);
+                }
+
             }
 
             img = $("<img>")
@@ -485,6 +551,37 @@ define(["d3", "c3"], function (d3, c3) {
 
             $("#detailViewAction").append(link);
 
+            // Compressed archive: smaller download, for slow connections
+            img = $("<img>")
+                .attr("src", "img/zip.png")
+                .attr("width", 32)
+                .attr("height", 32);
+
+            link = $("<a>")
+                .addClass("action")
+                .attr("href", "#")
+                .html("")
+                .attr("title", "")
+                .hover(function () {
+                        $("#detailViewActionExpl").html(
+                            "Download compressed archive (smaller, but takes longer to prepare).");
+                    },
+                    function () {
+                        $("#detailViewActionExpl").html("");
+                    })
+                .click(function () {
+                    DATAMODEL.callServerSidePluginExportDataSets(
+                        task, collectionId, collectionType,
+                        experimentSampleId, experimentSamplePermId,
+                        experimentSampleType, platePermId, plateType, "zip",
+                        false, "deflate");
+                    return false;
+                });
+
+            link.prepend(img);
+
+            $("#detailViewAction").append(link);
+
         },
 
         /**
@@ -575,10 +672,12 @@ define(["d3", "c3"], function (d3, c3) {
          * @param data list of (X, Y) points
          * @param xLabel X label
          * @param yLabel Y label
-         * @param xDisplay string Display type of the parameter for the X axis ("Linear" or "Hyperlog")
-         * @param yDisplay string Display type of the parameter for the Y axis ("Linear" or "Hyperlog")
+         * @param xDisplay string Display type of the parameter for the X axis ("Linear", "Hyperlog", "Arcsinh" or "Logicle")
+         * @param yDisplay string Display type of the parameter for the Y axis ("Linear", "Hyperlog", "Arcsinh" or "Logicle")
+         * @param plotParameters (optional) Object Parameters of the aggregation service used for the plot: if
+         * set, the events of a zoomed region are retrieved from the whole file.
          */
-        plotFCSData: function(data, xLabel, yLabel, xDisplay, yDisplay) {
+        plotFCSData: function(data, xLabel, yLabel, xDisplay, yDisplay, plotParameters) {
 
             // Make sure to have a proper array
             let parsed_data = JSON.parse(data);
@@ -637,11 +736,120 @@ define(["d3", "c3"], function (d3, c3) {
                 },
                 zoom: {
                     enabled: true,
-                    rescale: true
+                    rescale: true,
+                    onzoomend: function (domain) {
+
+                        // Retrieve the events of the zoomed region from the server
+                        if (plotParameters) {
+                            DATAMODEL.callServerSidePluginRetrieveViewportEvents(
+                                plotParameters, {xMin: domain[0], xMax: domain[1]});
+                        }
+                    }
                 },
             });
         },
 
+        /**
+         * Plot per-well statistics as a heatmap with the plate geometry.
+         *
+         * @param data JSON-encoded plate matrix as returned by the
+         * retrieve_fcs_events server-side plug-in in mode "plate".
+         */
+        plotPlateHeatmap: function(data) {
+
+            // Make sure to have a proper object
+            let plate = JSON.parse(data);
+
+            // Clear the plot area
+            let detailViewPlotID = $("#detailViewPlot");
+            detailViewPlotID.empty();
+
+            // Range of the values
+            let values = [];
+            for (let r = 0; r < plate.numRows; r++) {
+                for (let c = 0; c < plate.numColumns; c++) {
+                    if (plate.values[r][c] !== null) {
+                        values.push(plate.values[r][c]);
+                    }
+                }
+            }
+            let colorScale = d3.scaleSequential(d3.interpolateViridis)
+                .domain(values.length > 0 ? d3.extent(values) : [0, 1]);
+
+            // Geometry of the plot
+            const cellSize = Math.max(12, Math.min(40, Math.floor(720 / plate.numColumns)));
+            const margin = {top: 50, left: 30};
+            const width = margin.left + plate.numColumns * cellSize;
+            const height = margin.top + plate.numRows * cellSize;
+            const format = d3.format(",.4~g");
+
+            let svg = d3.select("#detailViewPlot")
+                .append("svg")
+                .attr("width", width)
+                .attr("height", height);
+
+            // Title
+            let title = plate.statistic;
+            if (plate.statistic !== "count") {
+                title = title + " of " + plate.parameter;
+            }
+            if (plate.population !== "") {
+                title = title + " in " + plate.population;
+            }
+            svg.append("text")
+                .attr("x", width / 2)
+                .attr("y", 15)
+                .attr("text-anchor", "middle")
+                .text(title);
+
+            // Row and column labels
+            svg.selectAll(".rowLabel")
+                .data(plate.rowLabels)
+                .enter()
+                .append("text")
+                .attr("class", "axis")
+                .attr("x", margin.left - 5)
+                .attr("y", function (d, i) { return margin.top + (i + 0.5) * cellSize; })
+                .attr("text-anchor", "end")
+                .attr("dominant-baseline", "middle")
+                .text(function (d) { return d; });
+            svg.selectAll(".columnLabel")
+                .data(plate.columnLabels)
+                .enter()
+                .append("text")
+                .attr("class", "axis")
+                .attr("x", function (d, i) { return margin.left + (i + 0.5) * cellSize; })
+                .attr("y", margin.top - 5)
+                .attr("text-anchor", "middle")
+                .text(function (d) { return d; });
+
+            // Wells
+            let cells = [];
+            for (let r = 0; r < plate.numRows; r++) {
+                for (let c = 0; c < plate.numColumns; c++) {
+                    let wellName = plate.rowLabels[r] + plate.columnLabels[c];
+                    cells.push({row: r, column: c, name: wellName, value: plate.values[r][c],
+                        count: plate.counts[r][c]});
+                }
+            }
+            svg.selectAll(".well")
+                .data(cells)
+                .enter()
+                .append("rect")
+                .attr("x", function (d) { return margin.left + d.column * cellSize; })
+                .attr("y", function (d) { return margin.top + d.row * cellSize; })
+                .attr("width", cellSize - 1)
+                .attr("height", cellSize - 1)
+                .style("fill", function (d) { return d.value === null ? "#eee" : colorScale(d.value); })
+                .append("title")
+                .text(function (d) {
+                    if (d.value === null) {
+                        return d.name + ": no data";
+                    }
+                    return d.name + ": " + format(d.value) + " (" + format(d.count) + " events)";
+                });
+        },
+
         /**
          * Prepare a title div to be added to the page.
          *
@@ -660,6 +868,86 @@ define(["d3", "c3"], function (d3, c3) {
 
         },
 
+        /**
+         * Display the form with the statistic selection for the plate heatmap.
+         *
+         * @param node: Tree node
+         */
+        renderPlateStatisticsForm: function(node) {
+
+            // Get details div
+            let detailViewSampleID = $("#detailViewSample");
+
+            // Create a form for the statistic
+            let form = $("<form>")
+                .addClass("form-group")
+                .attr("id", "plate_form");
+            detailViewSampleID.append(form);
+
+            // Parameter
+            let parameterDiv = $("<div>")
+                .addClass("plotBasicParamsDiv");
+            form.append(parameterDiv);
+            parameterDiv.append($("<label>")
+                .attr("for", "plate_form_parameter")
+                .html("Parameter"));
+            let inputParameter = $("<input>")
+                .attr("type", "text")
+                .attr("placeholder", "e.g. FITC-A")
+                .addClass("form_control")
+                .attr("id", "plate_form_parameter");
+            parameterDiv.append(inputParameter);
+
+            // Statistic
+            let statisticDiv = $("<div>")
+                .addClass("plotBasicParamsDiv");
+            form.append(statisticDiv);
+            statisticDiv.append($("<label>")
+                .attr("for", "plate_form_statistic")
+                .html("Statistic"));
+            let selectStatistic = $("<select>")
+                .addClass("form_control")
+                .attr("id", "plate_form_statistic");
+            statisticDiv.append(selectStatistic);
+
+            // Add the options
+            let possibleOptions = {
+                "count": "Event count",
+                "mean": "Mean",
+                "median": "Median",
+                "cv": "CV (%)",
+                "p5": "5th percentile",
+                "p95": "95th percentile"
+            };
+            for (let key in possibleOptions) {
+                selectStatistic.append($("<option>")
+                    .attr("value", key)
+                    .text(possibleOptions[key]));
+            }
+
+            // Heatmap button
+            let plotDiv = $("<div>")
+                .addClass("plotBasicParamsDiv");
+            form.append(plotDiv);
+            let plotButton = $("<input>")
+                .attr("type", "button")
+                .attr("value", "Heatmap")
+                .click(function () {
+
+                    // Get the selected parameter and statistic
+                    let parameter = inputParameter.val().trim();
+                    let statistic = selectStatistic.find(":selected").val();
+
+                    if (statistic !== "count" && parameter === "") {
+                        DATAVIEWER.displayStatus("Please specify a parameter.", "warning");
+                        return;
+                    }
+
+                    DATAMODEL.callServerSidePluginComputePlateStatistics(node, parameter, statistic);
+                });
+            plotDiv.append(plotButton);
+        },
+
         /**
          * Display the form with the parameter selections for the plotting.
          *
@@ -812,6 +1100,9 @@ define(["d3", "c3"], function (d3, c3) {
                     // Sampling method
                     let samplingMethod = selectSamplingMethod.find(":selected").val();
 
+                    // Compensation
+                    let compensate = selectCompensation.find(":selected").val();
+
                     DATAMODEL.callServerSidePluginGenerateFCSPlot(
                         node,
                         node.data.element.code,
@@ -820,7 +1111,8 @@ define(["d3", "c3"], function (d3, c3) {
                         displayX,
                         displayY,
                         numEvents,
-                        samplingMethod);
+                        samplingMethod,
+                        compensate);
                 });
             plotDiv.append(plotButton);
 
@@ -837,7 +1129,7 @@ define(["d3", "c3"], function (d3, c3) {
             xAxisScalingdId.append(selectScaleX);
 
             // Add the options
-            possibleOptions = ["Linear", "Hyperlog"];
+            possibleOptions = ["Linear", "Hyperlog", "Arcsinh", "Logicle"];
             for (let i = 0; i < possibleOptions.length; i++) {
                 selectScaleX.append($("<option>")
                     .attr("value", possibleOptions[i])
@@ -860,7 +1152,7 @@ define(["d3", "c3"], function (d3, c3) {
             yAxisScalingId.append(selectScaleY);
 
             // Add the options
-            possibleOptions = ["Linear", "Hyperlog"];
+            possibleOptions = ["Linear", "Hyperlog", "Arcsinh", "Logicle"];
             for (let i = 0; i < possibleOptions.length; i++) {
                 selectScaleY.append($("<option>")
                     .attr("value", possibleOptions[i])
@@ -892,6 +1184,29 @@ define(["d3", "c3"], function (d3, c3) {
 
             // Pre-select "Linear"
             selectSamplingMethod.val(0);
+
+            // Add a selector for the compensation
+            let compensationDiv = eventsDiv.append($("<div>")
+                .attr("id", "compensationDiv"));
+            let compensationId = $("#compensationDiv");
+            compensationId.append($("<label>")
+                .attr("for", "parameter_form_select_compensation")
+                .html("Compensation"));
+            let selectCompensation = $("<select>")
+                .addClass("form_control")
+                .attr("id", "parameter_form_select_compensation");
+            compensationId.append(selectCompensation);
+
+            // Add the options
+            possibleOptions = ["Uncompensated", "Compensated"];
+            for (let i = 0; i < possibleOptions.length; i++) {
+                selectCompensation.append($("<option>")
+                    .attr("value", i)
+                    .text(possibleOptions[i]));
+            }
+
+            // Pre-select "Uncompensated"
+            selectCompensation.val(0);
         }
     };
 
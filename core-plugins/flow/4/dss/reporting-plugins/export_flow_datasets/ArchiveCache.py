@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+'''
+Cache of the finished export archives, shared by the DSS nodes, so that
+identical exports are served without building the archive again.
+'''
+
+import os
+import hashlib
+import java.io.File
+import java.lang.Thread
+import java.net.InetAddress
+from java.nio.file import Files
+from java.nio.file import StandardCopyOption
+
+
+def buildArchiveKey(dataSetCodes, options, entryNames):
+    """Return the key of an archive in the cache.
+
+    @param dataSetCodes Codes of the exported datasets.
+    @param options Dictionary of the export options that change the archive
+           (e.g. the compression).
+    @param entryNames Names of the files in the archive (they change if the
+           experiment, plates or tubes are renamed).
+    @return string Hexadecimal SHA-256 digest.
+    """
+
+    digest = hashlib.sha256()
+    for code in sorted(dataSetCodes):
+        digest.update("dataset:" + code + "\n")
+    for name in sorted(options.keys()):
+        digest.update("option:" + name + "=" + str(options[name]) + "\n")
+    for entryName in sorted(entryNames):
+        digest.update("entry:" + entryName.encode("utf-8") + "\n")
+    return digest.hexdigest()
+
+
+class ArchiveCache:
+    """The ArchiveCache class keeps finished export archives in a folder on
+    the DSS, so that identical exports are served without rebuilding them.
+
+    Archives are stored as <key>.zip (see buildArchiveKey()). They are handed
+    out as hard links (or copies, if the target is on another file system),
+    so a cached archive costs no additional space in the session workspaces.
+
+    When the cache grows beyond its maximum size, the least recently used
+    archives are deleted. The use of an archive is recorded in its
+    modification time.
+    """
+
+    # Constructor
+    def __init__(self, cacheDir, maxSizeBytes, logger):
+        """Constructor
+
+        @param cacheDir Folder of the cache. If it is "", the cache is
+               disabled and all operations are no-ops.
+        @param maxSizeBytes Maximum total size of the cached archives.
+        @param logger Logger.
+        """
+
+        self._cacheDir = cacheDir
+        self._maxSizeBytes = maxSizeBytes
+        self._logger = logger
+
+        # Name of current DSS node
+        self._node = java.net.InetAddress.getLocalHost().getHostName()
+
+        # Make sure the cache folder exists
+        if self.isEnabled() and not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+
+    def isEnabled(self):
+        """Return True if the cache is enabled."""
+        return self._cacheDir != ""
+
+    def fetch(self, key, target):
+        """Make the cached archive with given key available as target.
+
+        @param key Key of the archive.
+        @param target Full path of the archive to serve. An existing file is
+               replaced.
+        @return True if the archive was in the cache, False otherwise.
+        """
+
+        if not self.isEnabled():
+            return False
+
+        cached = self._getPath(key)
+        if not os.path.isfile(cached):
+            return False
+
+        try:
+            self._linkOrCopy(cached, target)
+
+            # Mark the archive as recently used
+            os.utime(cached, None)
+        except Exception, e:
+            # The archive was evicted in the meanwhile
+            self._logger.warning("Could not serve cached archive " + cached +
+                                 ": " + str(e))
+            return False
+
+        self._logger.info("Served archive " + target + " from cache " +
+                          cached + ".")
+        return True
+
+    def store(self, key, archive):
+        """Add a finished archive to the cache and evict the least recently
+        used archives if the cache is too large.
+
+        Errors are logged but not raised: the archive itself is not affected.
+
+        @param key Key of the archive.
+        @param archive Full path of the archive.
+        """
+
+        if not self.isEnabled():
+            return
+
+        cached = self._getPath(key)
+        tmpFile = cached + "." + self._node + "." + \
+            str(java.lang.Thread.currentThread().getId()) + ".tmp"
+        try:
+            self._linkOrCopy(archive, tmpFile)
+            Files.move(java.io.File(tmpFile).toPath(),
+                       java.io.File(cached).toPath(),
+                       StandardCopyOption.REPLACE_EXISTING,
+                       StandardCopyOption.ATOMIC_MOVE)
+        except Exception, e:
+            self._logger.warning("Could not add archive " + archive +
+                                 " to the cache: " + str(e))
+            if os.path.isfile(tmpFile):
+                os.remove(tmpFile)
+            return
+
+        self._logger.info("Added archive " + archive + " to cache " +
+                          cached + ".")
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used archives until the cache is not
+        larger than its maximum size."""
+
+        archives = []
+        totalSize = 0
+        for fileName in os.listdir(self._cacheDir):
+            if not fileName.endswith(".zip"):
+                continue
+            fullFileName = os.path.join(self._cacheDir, fileName)
+            try:
+                size = os.path.getsize(fullFileName)
+                archives.append((os.path.getmtime(fullFileName), size,
+                                 fullFileName))
+                totalSize += size
+            except OSError:
+                # The file was removed in the meanwhile by another node
+                pass
+
+        archives.sort()
+        for (mtime, size, fullFileName) in archives:
+            if totalSize <= self._maxSizeBytes:
+                break
+            try:
+                os.remove(fullFileName)
+                self._logger.info("Evicted archive " + fullFileName +
+                                  " from the cache.")
+            except OSError:
+                pass
+            totalSize -= size
+
+    def _linkOrCopy(self, source, target):
+        """Hard link source to target (or copy it, if they are on different
+        file systems). An existing target is replaced."""
+
+        if os.path.isfile(target):
+            os.remove(target)
+
+        sourcePath = java.io.File(source).toPath()
+        targetPath = java.io.File(target).toPath()
+        try:
+            Files.createLink(targetPath, sourcePath)
+        except Exception:
+            Files.copy(sourcePath, targetPath,
+                       StandardCopyOption.REPLACE_EXISTING)
+
+    def _getPath(self, key):
+        """Return the full path of the cached archive with given key."""
+        return os.path.join(self._cacheDir, key + ".zip")
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+'''
+In-process copy of the exported files on a bounded pool of threads. The
+checksums of the files for the manifest of the export are computed while
+they are copied.
+'''
+
+import os
+import java.io.File
+import java.io.FileInputStream
+import java.io.FileOutputStream
+import java.lang.Thread
+from java.nio import ByteBuffer
+from java.nio.file import Files
+from java.nio.file import StandardCopyOption
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutorCompletionService
+from java.util.concurrent import Executors
+from ExportProgress import ExportProgress
+from Manifest import Checksum
+
+# Size of the buffer used to copy the files (the progress is updated and the
+# cancellation checked after each buffer)
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Size of the buffers used to compare files
+_COMPARE_BUFFER_SIZE = 1024 * 1024
+
+# Largest difference (in ms) of the modification times of a file and its
+# copy that are considered equal (some file systems store them in units of
+# up to 2 s)
+_MTIME_TOLERANCE_MS = 2000
+
+
+def copyFile(source, dstFile, progress=None):
+    """Copy the source file to dstFile (both with full path).
+
+    We use a trick to preserve the NFSv4 ACLs: since copying the file loses
+    them, we first create an (empty) temporary file in the destination
+    folder, so that it inherits the ACLs of the folder, and then we
+    overwrite it in place. The temporary file replaces dstFile only once it
+    is complete: a failed or cancelled copy never leaves a truncated file
+    behind, and does not affect an earlier copy of the file (e.g. in
+    incremental mode). The bytes are copied through a buffer, and their
+    checksums are computed on the way, so that the files do not need to be
+    read again to build the manifest of the export.
+
+    The modification time of the source is preserved, so that unchanged
+    copies can be recognized cheaply by isUnchanged().
+
+    @param source Full path of the file to copy.
+    @param dstFile Full path of the destination file.
+    @param progress (optional) ExportProgress: the copied bytes are added to
+           it.
+    @return tuple (size, crc32, sha256) with the number of copied bytes and
+            their CRC-32 and SHA-256 digest (hexadecimal string).
+    @throws IOError if the file could not be copied.
+    @throws ExportCancelled if the export was cancelled.
+    """
+
+    tmp = java.io.File(dstFile + "." +
+                       str(java.lang.Thread.currentThread().getId()) + ".tmp")
+    checksum = Checksum()
+    buffer = ByteBuffer.allocate(_COPY_BUFFER_SIZE)
+    size = 0
+    inStream = java.io.FileInputStream(source)
+    try:
+        try:
+            # Create the temporary file first...
+            tmp.createNewFile()
+
+            # ...and then overwrite (truncate) it
+            outStream = java.io.FileOutputStream(tmp, False)
+            try:
+                inChannel = inStream.getChannel()
+                outChannel = outStream.getChannel()
+                while True:
+                    if progress is not None:
+                        progress.checkCancelled()
+                    buffer.clear()
+                    n = inChannel.read(buffer)
+                    if n < 0:
+                        break
+                    buffer.flip()
+                    checksum.update(buffer)
+                    while buffer.hasRemaining():
+                        outChannel.write(buffer)
+                    size += n
+                    if progress is not None:
+                        progress.addBytes(n)
+            finally:
+                outStream.close()
+
+            tmp.setLastModified(java.io.File(source).lastModified())
+
+            # Replace the destination file (if any) by the complete copy
+            Files.move(tmp.toPath(), java.io.File(dstFile).toPath(),
+                       StandardCopyOption.REPLACE_EXISTING,
+                       StandardCopyOption.ATOMIC_MOVE)
+        except:
+            # Do not leave a partially copied file behind
+            tmp.delete()
+            raise
+    finally:
+        inStream.close()
+
+    return (size, checksum.getCrc32(), checksum.getSha256())
+
+
+def computeChecksums(fileName):
+    """Read a file and compute its checksums.
+
+    @param fileName Full path of the file.
+    @return tuple (size, crc32, sha256) (see copyFile()).
+    """
+
+    checksum = Checksum()
+    buffer = ByteBuffer.allocate(_COPY_BUFFER_SIZE)
+    size = 0
+    inStream = java.io.FileInputStream(fileName)
+    try:
+        inChannel = inStream.getChannel()
+        while True:
+            buffer.clear()
+            n = inChannel.read(buffer)
+            if n < 0:
+                break
+            buffer.flip()
+            checksum.update(buffer)
+            size += n
+    finally:
+        inStream.close()
+
+    return (size, checksum.getCrc32(), checksum.getSha256())
+
+
+def _haveSameContent(source, dstFile):
+    """Return True if the two files have the same content (they must have
+    the same size)."""
+
+    sourceStream = java.io.FileInputStream(source)
+    try:
+        dstStream = java.io.FileInputStream(dstFile)
+        try:
+            sourceChannel = sourceStream.getChannel()
+            dstChannel = dstStream.getChannel()
+            sourceBuffer = ByteBuffer.allocate(_COMPARE_BUFFER_SIZE)
+            dstBuffer = ByteBuffer.allocate(_COMPARE_BUFFER_SIZE)
+            while True:
+                sourceBuffer.clear()
+                dstBuffer.clear()
+                n = sourceChannel.read(sourceBuffer)
+                if n < 0:
+                    return True
+                dstBuffer.limit(n)
+                while dstBuffer.hasRemaining():
+                    if dstChannel.read(dstBuffer) < 0:
+                        return False
+                sourceBuffer.flip()
+                dstBuffer.flip()
+                if not sourceBuffer.equals(dstBuffer):
+                    return False
+        finally:
+            dstStream.close()
+    finally:
+        sourceStream.close()
+
+
+def isUnchanged(source, dstFile):
+    """Return True if dstFile is an unchanged copy of the source file.
+
+    Copies made by copyFile() are recognized by their size and modification
+    time. If only the sizes match (e.g. copies made without preserving the
+    modification time), the contents are compared; in that case the
+    modification time of the copy is updated, so that the next comparison
+    is cheap.
+
+    @param source Full path of the file to copy.
+    @param dstFile Full path of the destination file.
+    @return True if the file does not need to be copied again.
+    """
+
+    src = java.io.File(source)
+    dst = java.io.File(dstFile)
+    if not dst.isFile() or dst.length() != src.length():
+        return False
+
+    if abs(dst.lastModified() - src.lastModified()) <= _MTIME_TOLERANCE_MS:
+        return True
+
+    if not _haveSameContent(source, dstFile):
+        return False
+
+    dst.setLastModified(src.lastModified())
+    return True
+
+
+class CopyTask(Callable):
+    """Copy one file (unless it is unchanged, in incremental mode)."""
+
+    def __init__(self, source, dstFile, incremental, progress):
+        self._source = source
+        self._dstFile = dstFile
+        self._incremental = incremental
+        self._progress = progress
+
+    def call(self):
+        """Return (source, destination file, number of copied bytes, error
+        message, skipped, checksums). The checksums (size, crc32, sha256) are
+        None if the file was not copied."""
+
+        try:
+            # The queued copies are not started after a cancellation
+            self._progress.checkCancelled()
+
+            if self._incremental and isUnchanged(self._source, self._dstFile):
+                self._progress.addSkippedFile(os.path.getsize(self._source))
+                return (self._source, self._dstFile, 0, None, True, None)
+
+            checksums = copyFile(self._source, self._dstFile, self._progress)
+            self._progress.addFile()
+            return (self._source, self._dstFile, checksums[0], None, False,
+                    checksums)
+        except Exception, e:
+            return (self._source, self._dstFile, 0, str(e), False, None)
+
+
+class CopyEngine:
+    """The CopyEngine class copies files in-process on a bounded pool of
+    threads.
+
+    Files are queued with submit(); waitForCompletion() then waits for all
+    queued copies to finish.
+
+    In incremental mode, files whose destination is an unchanged copy (see
+    isUnchanged()) are skipped.
+
+    The checksums of the copied files are collected for the manifest of the
+    export (see getChecksums()).
+
+    The progress of the copies is tracked in an ExportProgress object, which
+    is also used to cancel them.
+    """
+
+    # Constructor
+    def __init__(self, numThreads, logger, incremental=False, progress=None):
+        """Constructor
+
+        @param numThreads Number of files that are copied in parallel.
+        @param logger Logger.
+        @param incremental If True, unchanged files are not copied again.
+        @param progress (optional) ExportProgress.
+        """
+
+        self._logger = logger
+        self._incremental = incremental
+        if progress is None:
+            progress = ExportProgress()
+        self._progress = progress
+        self._numThreads = max(1, numThreads)
+        self._executor = Executors.newFixedThreadPool(self._numThreads)
+        self._completionService = ExecutorCompletionService(self._executor)
+
+        # Destination files of the queued copies
+        self._dstFiles = set()
+
+        # Number of queued copies that were not collected yet
+        self._numPending = 0
+
+        # Statistics of the completed copies
+        self._numCopiedFiles = 0
+        self._numCopiedBytes = 0
+        self._numSkippedFiles = 0
+
+        # Checksums of the copied files (destination file -> (size, crc32,
+        # sha256))
+        self._checksums = {}
+
+    def submit(self, source, dstDir):
+        """Queue the source file (with full path) for copying to directory
+        dstDir.
+
+        If several files with the same name are queued for the same folder,
+        only the first one is copied: they would otherwise overwrite each
+        other concurrently.
+
+        @param source Full path of the file to copy.
+        @param dstDir Full path of the destination folder (must exist).
+        """
+
+        dstFile = os.path.join(dstDir, os.path.basename(source))
+        if dstFile in self._dstFiles:
+            self._logger.warning("Skipping file " + source + ": " +
+                                 dstFile + " is already being copied.")
+            return
+        self._dstFiles.add(dstFile)
+
+        self._logger.info("Copying file " + source + " to " + dstDir)
+        self._completionService.submit(
+            CopyTask(source, dstFile, self._incremental, self._progress))
+        self._numPending += 1
+
+    def waitForCompletion(self):
+        """Wait for all queued copies to finish. After a cancellation, the
+        copies that were not started yet return immediately.
+
+        @return list of error messages of the files that could not be copied.
+        """
+
+        errors = []
+        while self._numPending > 0:
+            (source, dstFile, numBytes, error, skipped, checksums) = \
+                self._completionService.take().get()
+            self._numPending -= 1
+            if error is not None:
+                if not self._progress.isCancelled():
+                    self._logger.error("Could not copy file " + source +
+                                       ": " + error)
+                errors.append(error)
+            elif skipped:
+                self._logger.info("Skipped unchanged file " + source)
+                self._numSkippedFiles += 1
+            else:
+                self._numCopiedFiles += 1
+                self._numCopiedBytes += numBytes
+                self._checksums[dstFile] = checksums
+
+        return errors
+
+    def shutdown(self):
+        """Stop the threads of the pool. Queued copies that were not started
+        yet are discarded."""
+        self._executor.shutdownNow()
+
+    def getNumberOfCopiedFiles(self):
+        """Return the number of files copied so far."""
+        return self._numCopiedFiles
+
+    def getNumberOfCopiedBytes(self):
+        """Return the number of bytes copied so far."""
+        return self._numCopiedBytes
+
+    def getNumberOfSkippedFiles(self):
+        """Return the number of unchanged files skipped so far."""
+        return self._numSkippedFiles
+
+    def getChecksums(self):
+        """Return the checksums of the files copied so far, as a dictionary
+        destination file -> (size, crc32, sha256). Skipped files are not
+        included."""
+        return self._checksums
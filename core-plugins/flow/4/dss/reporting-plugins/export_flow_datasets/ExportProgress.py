@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+'''
+Progress of an export (files and bytes processed and estimated remaining
+time) and its cancellation, shared by all the threads of the export.
+'''
+
+import time
+from java.util.concurrent.atomic import AtomicBoolean
+from java.util.concurrent.atomic import AtomicLong
+
+
+class ExportCancelled(Exception):
+    """Raised by the copy threads when the export was cancelled."""
+    pass
+
+
+def formatBytes(numBytes):
+    """Return a human-readable size (e.g. "1.2 GB")."""
+    value = float(numBytes)
+    for unit in ["B", "kB", "MB", "GB"]:
+        if value < 1024.0:
+            return "%.1f %s" % (value, unit)
+        value /= 1024.0
+    return "%.1f TB" % value
+
+
+def formatDuration(seconds):
+    """Return a human-readable duration (e.g. "3 min")."""
+    if seconds < 60:
+        return str(int(seconds)) + " s"
+    if seconds < 3600:
+        return str(int(round(seconds / 60.0))) + " min"
+    return "%.1f h" % (seconds / 3600.0)
+
+
+class ExportProgress:
+    """The ExportProgress class keeps track of the files and bytes processed
+    by an export and of its cancellation.
+
+    It is updated concurrently by all copy threads, and read by the thread
+    that publishes the progress of the job. If a Throttle is set, the copy
+    threads are slowed down to its rate as they report their bytes.
+    """
+
+    # Constructor
+    def __init__(self, throttle=None):
+        """Constructor
+
+        @param throttle (optional) Throttle that limits the copy rate.
+        """
+
+        self._throttle = throttle
+
+        self._numFilesTotal = AtomicLong(0)
+        self._numBytesTotal = AtomicLong(0)
+        self._numFilesDone = AtomicLong(0)
+        self._numBytesDone = AtomicLong(0)
+
+        # Bytes of the files that were skipped (they do not count for the
+        # throughput)
+        self._numBytesSkipped = AtomicLong(0)
+
+        self._cancelled = AtomicBoolean(False)
+        self._startTime = time.time()
+
+    def addToTotal(self, numFiles, numBytes):
+        """Add files to be processed to the total."""
+        self._numFilesTotal.addAndGet(numFiles)
+        self._numBytesTotal.addAndGet(numBytes)
+
+    def start(self):
+        """Reset the start time used to compute the throughput."""
+        self._startTime = time.time()
+
+    def addBytes(self, numBytes):
+        """Add bytes that were copied (and wait if they were copied faster
+        than the throttle allows)."""
+        self._numBytesDone.addAndGet(numBytes)
+        if self._throttle is not None:
+            self._throttle.consume(numBytes)
+
+    def addFile(self):
+        """Count a file as processed (its bytes are added with addBytes())."""
+        self._numFilesDone.incrementAndGet()
+
+    def addSkippedFile(self, numBytes):
+        """Count a file as processed without copying it."""
+        self._numBytesDone.addAndGet(numBytes)
+        self._numBytesSkipped.addAndGet(numBytes)
+        self._numFilesDone.incrementAndGet()
+
+    def cancel(self):
+        """Request the cancellation of the export."""
+        self._cancelled.set(True)
+
+    def isCancelled(self):
+        """Return True if the cancellation of the export was requested."""
+        return self._cancelled.get()
+
+    def checkCancelled(self):
+        """Raise ExportCancelled if the cancellation was requested."""
+        if self._cancelled.get():
+            raise ExportCancelled("The export was cancelled.")
+
+    def getStatus(self):
+        """Return the progress of the export.
+
+        @return dictionary with keys nFilesDone, nFilesTotal, nBytesDone,
+                nBytesTotal, throughput (copied bytes per second) and eta
+                (estimated remaining time in seconds, or -1 if it is not
+                known yet).
+        """
+
+        numFilesDone = self._numFilesDone.get()
+        numFilesTotal = self._numFilesTotal.get()
+        numBytesDone = self._numBytesDone.get()
+        numBytesTotal = self._numBytesTotal.get()
+
+        elapsed = time.time() - self._startTime
+        numBytesCopied = numBytesDone - self._numBytesSkipped.get()
+        throughput = 0
+        if elapsed > 0:
+            throughput = int(numBytesCopied / elapsed)
+        eta = -1
+        if throughput > 0:
+            eta = int(max(0, numBytesTotal - numBytesDone) / throughput)
+
+        return {"nFilesDone": numFilesDone,
+                "nFilesTotal": numFilesTotal,
+                "nBytesDone": numBytesDone,
+                "nBytesTotal": numBytesTotal,
+                "throughput": throughput,
+                "eta": eta}
+
+    def getMessage(self):
+        """Return a description of the progress for the user."""
+
+        status = self.getStatus()
+        message = "Processed " + str(status["nFilesDone"]) + " of " + \
+            str(status["nFilesTotal"]) + " files (" + \
+            formatBytes(status["nBytesDone"]) + " of " + \
+            formatBytes(status["nBytesTotal"]) + ")"
+        if status["throughput"] > 0:
+            message += " at " + formatBytes(status["throughput"]) + "/s"
+        if status["eta"] > 0:
+            message += ", about " + formatDuration(status["eta"]) + " left"
+        return message + "."
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+'''
+Scheduling of the exports of the DSS: limits on the number of exports that
+run at the same time (in total and per user) and on their total bandwidth.
+'''
+
+import time
+import threading
+
+
+class Throttle:
+    """The Throttle class limits the rate at which bytes are copied.
+
+    The rate is shared by all threads that use the same Throttle: each thread
+    reserves the time that its bytes take at the given rate and sleeps until
+    the reservation is over.
+    """
+
+    # Constructor
+    def __init__(self, bytesPerSecond=0):
+        """Constructor
+
+        @param bytesPerSecond Maximum rate in bytes per second (0 for no
+               limit).
+        """
+
+        self._lock = threading.Lock()
+        self._bytesPerSecond = bytesPerSecond
+
+        # Time at which the bytes reserved so far are all copied
+        self._next = time.time()
+
+    def setRate(self, bytesPerSecond):
+        """Set the maximum rate in bytes per second (0 for no limit)."""
+        self._bytesPerSecond = bytesPerSecond
+
+    def consume(self, numBytes):
+        """Wait as long as copying numBytes bytes takes at the maximum rate
+        (taking into account the bytes copied by the other threads)."""
+
+        bytesPerSecond = self._bytesPerSecond
+        if bytesPerSecond <= 0:
+            return
+
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._next = max(self._next, now) + \
+                numBytes / float(bytesPerSecond)
+            delay = self._next - now
+        finally:
+            self._lock.release()
+
+        time.sleep(delay)
+
+
+class ExportScheduler:
+    """The ExportScheduler class limits the number of exports that run at
+    the same time, globally and per user.
+
+    Jobs that cannot run yet wait in a first-in, first-out queue: a job starts
+    as soon as a slot is free, unless an earlier job in the queue can take
+    it. Jobs of a user who already runs the maximum number of exports do not
+    hold back the jobs of other users.
+
+    The scheduler also owns the Throttle that limits the total bandwidth of
+    the exports.
+    """
+
+    # Constructor
+    def __init__(self, maxJobs, maxJobsPerUser, bytesPerSecond=0):
+        """Constructor
+
+        @param maxJobs Maximum number of exports that run at the same time.
+        @param maxJobsPerUser Maximum number of exports of one user that run
+               at the same time.
+        @param bytesPerSecond Maximum total bandwidth of the exports in bytes
+               per second (0 for no limit).
+        """
+
+        self._condition = threading.Condition()
+        self._maxJobs = max(1, maxJobs)
+        self._maxJobsPerUser = max(1, maxJobsPerUser)
+        self._throttle = Throttle(bytesPerSecond)
+
+        # Queued jobs (uids) in order of arrival
+        self._queue = []
+
+        # User of each queued or running job
+        self._users = {}
+
+        # Running jobs and number of running jobs per user
+        self._running = set()
+        self._numRunningPerUser = {}
+
+    def setLimits(self, maxJobs, maxJobsPerUser, bytesPerSecond=0):
+        """Update the limits (e.g. after a change of the plug-in settings)."""
+
+        self._condition.acquire()
+        try:
+            self._maxJobs = max(1, maxJobs)
+            self._maxJobsPerUser = max(1, maxJobsPerUser)
+            self._throttle.setRate(bytesPerSecond)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def getThrottle(self):
+        """Return the Throttle shared by all exports."""
+        return self._throttle
+
+    def enqueue(self, uid, userId):
+        """Add a job at the end of the queue."""
+
+        self._condition.acquire()
+        try:
+            self._queue.append(uid)
+            self._users[uid] = userId
+        finally:
+            self._condition.release()
+
+    def waitForTurn(self, uid, timeout):
+        """Wait at most timeout seconds for the queued job to be allowed to
+        run. If it is, the job is removed from the queue and counted as
+        running.
+
+        @param uid Unique identifier of the job.
+        @param timeout Maximum waiting time in seconds.
+        @return True if the job can run, False if it is still queued.
+        """
+
+        self._condition.acquire()
+        try:
+            if not self._canStart(uid):
+                self._condition.wait(timeout)
+                if not self._canStart(uid):
+                    return False
+
+            userId = self._users[uid]
+            self._queue.remove(uid)
+            self._running.add(uid)
+            self._numRunningPerUser[userId] = \
+                self._numRunningPerUser.get(userId, 0) + 1
+
+            # The next job in the queue may be able to start as well
+            self._condition.notifyAll()
+            return True
+        finally:
+            self._condition.release()
+
+    def release(self, uid):
+        """Remove a job from the queue or from the running jobs."""
+
+        self._condition.acquire()
+        try:
+            userId = self._users.pop(uid, None)
+            if uid in self._queue:
+                self._queue.remove(uid)
+            if uid in self._running:
+                self._running.remove(uid)
+                self._numRunningPerUser[userId] -= 1
+                if self._numRunningPerUser[userId] == 0:
+                    del self._numRunningPerUser[userId]
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def getQueuePosition(self, uid):
+        """Return the (1-based) position of a job in the queue, or 0 if the
+        job is not queued."""
+
+        self._condition.acquire()
+        try:
+            if uid not in self._queue:
+                return 0
+            return self._queue.index(uid) + 1
+        finally:
+            self._condition.release()
+
+    def getNumberOfRunningJobs(self):
+        """Return the number of running jobs."""
+        return len(self._running)
+
+    def _canStart(self, uid):
+        """Return True if the queued job can run now (the caller must hold
+        the lock)."""
+
+        if len(self._running) >= self._maxJobs:
+            return False
+
+        # The job runs if it is the first in the queue whose user still has
+        # a free slot
+        for queuedUid in self._queue:
+            if self._hasFreeSlot(self._users[queuedUid]):
+                return queuedUid == uid
+            if queuedUid == uid:
+                return False
+        return False
+
+    def _hasFreeSlot(self, userId):
+        """Return True if the user can run one more job (the caller must hold
+        the lock)."""
+        return self._numRunningPerUser.get(userId, 0) < self._maxJobsPerUser
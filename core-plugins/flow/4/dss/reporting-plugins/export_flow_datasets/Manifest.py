@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+'''
+Checksum manifest (MANIFEST.tsv) of the exports: size, CRC-32 and SHA-256 of
+every exported file, computed while the files are copied or archived.
+'''
+
+import os
+import codecs
+from java.security import MessageDigest
+from java.util.zip import CRC32
+
+# Name of the manifest file in the export folder (or archive)
+MANIFEST_FILE_NAME = "MANIFEST.tsv"
+
+# Header of the manifest
+_MANIFEST_HEADER = "path\tsize\tcrc32\tsha256"
+
+
+class Checksum:
+    """The Checksum class computes the CRC-32 and the SHA-256 digest of the
+    bytes of a file while they are copied."""
+
+    # Constructor
+    def __init__(self):
+        """Constructor"""
+        self._crc = CRC32()
+        self._sha256 = MessageDigest.getInstance("SHA-256")
+
+    def update(self, buffer):
+        """Add the remaining bytes of a ByteBuffer (its position is not
+        changed)."""
+        position = buffer.position()
+        self._crc.update(buffer)
+        buffer.position(position)
+        self._sha256.update(buffer)
+        buffer.position(position)
+
+    def updateBytes(self, array, offset, length):
+        """Add length bytes of a byte array, starting at offset."""
+        self._crc.update(array, offset, length)
+        self._sha256.update(array, offset, length)
+
+    def getCrc32(self):
+        """Return the CRC-32 of the bytes added so far."""
+        return self._crc.getValue()
+
+    def getSha256(self):
+        """Return the SHA-256 digest (hexadecimal string). The digest can only
+        be retrieved once."""
+        return "".join(["%02x" % (b & 0xff) for b in self._sha256.digest()])
+
+
+def formatManifest(entries):
+    """Return the content of a manifest.
+
+    The manifest is a tab-separated table with one line per file: its path
+    (relative to the folder of the manifest, with '/' separators), its size
+    in bytes, its CRC-32 (8 hexadecimal digits) and its SHA-256 digest.
+
+    @param entries Dictionary path -> (size, crc32, sha256).
+    @return unicode Content of the manifest.
+    """
+
+    lines = [_MANIFEST_HEADER]
+    for path in sorted(entries.keys()):
+        (size, crc, sha256) = entries[path]
+        lines.append(path + "\t" + str(size) + "\t" + ("%08x" % crc) +
+                     "\t" + sha256)
+    return u"\n".join(lines) + u"\n"
+
+
+def writeManifest(folder, entries):
+    """Write the manifest (see formatManifest()) to given folder."""
+
+    f = open(os.path.join(folder, MANIFEST_FILE_NAME), "wb")
+    try:
+        f.write(formatManifest(entries).encode("utf-8"))
+    finally:
+        f.close()
+
+
+def readManifest(folder):
+    """Read the manifest from given folder.
+
+    @return dictionary path -> (size, crc32, sha256); it is empty if there
+            is no (valid) manifest.
+    """
+
+    entries = {}
+    fileName = os.path.join(folder, MANIFEST_FILE_NAME)
+    if not os.path.isfile(fileName):
+        return entries
+
+    f = codecs.open(fileName, "r", "utf-8")
+    try:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 4 or line.startswith("path\t"):
+                continue
+            try:
+                entries[parts[0]] = (long(parts[1]), long(parts[2], 16),
+                                     parts[3])
+            except ValueError:
+                continue
+    finally:
+        f.close()
+
+    return entries
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Notes:
+#
+# - this module is also used by retrieve_fcs_events, which imports it from
+#   this folder: keep it free of plug-in specific code.
+
+'''
+Persistence of the results of long-running jobs (export_flow_datasets and
+retrieve_fcs_events) to a folder shared by all DSS nodes.
+'''
+
+import os
+import json
+import time
+import threading
+import java.io.File
+import java.lang.Thread
+import java.net.InetAddress
+from java.nio.file import Files
+from java.nio.file import StandardCopyOption
+
+# Maximum total length (in characters) of the payloads kept in memory after
+# they were read from disk
+_PAYLOAD_CACHE_MAX_CHARS = 32 * 1048576
+
+# Minimum time in seconds between two purges of the store folder
+_PURGE_INTERVAL_S = 600
+
+
+class ResultStore:
+    """The ResultStore class persists the results of long-running jobs to
+    files in a folder shared by all DSS nodes, keyed by job uid.
+
+    Since the results are on disk, they survive a restart of the DSS and any
+    node can answer the status polls for a job started by another node.
+
+    Each job is stored as a small JSON file with the results (<uid>.json) and
+    one file per (potentially large) payload entry (<uid>.<key>), so that the
+    payloads do not need to be kept in memory once the job is completed. The
+    payloads that were read back recently are kept in a small cache (at most
+    _PAYLOAD_CACHE_MAX_CHARS characters, least recently used first out): a
+    result that is polled several times is read and decoded only once.
+    """
+
+    # Constructor
+    def __init__(self, storeDir, maxAgeHours, payloadKeys=[]):
+        """Constructor
+
+        @param storeDir Folder where the results are stored. If it is "", the
+               store is disabled and all operations are no-ops.
+        @param maxAgeHours Results older than maxAgeHours hours are deleted by
+               purgeExpired().
+        @param payloadKeys Keys of the result entries that are stored in their
+               own file.
+        """
+
+        # Store arguments
+        self._storeDir = storeDir
+        self._maxAgeSeconds = maxAgeHours * 3600
+        self._payloadKeys = payloadKeys
+
+        # Name of current DSS node
+        self._node = java.net.InetAddress.getLocalHost().getHostName()
+
+        # Payloads read recently: (file name, mtime, size) -> content, and
+        # total length of the cached payloads
+        self._payloadCacheLock = threading.Lock()
+        self._payloadCache = {}
+        self._payloadCacheOrder = []
+        self._payloadCacheChars = 0
+
+        # Time of the last purge of the store folder
+        self._lastPurge = 0
+
+        # Make sure the store folder exists
+        if self.isEnabled() and not os.path.isdir(self._storeDir):
+            os.makedirs(self._storeDir)
+
+    def isEnabled(self):
+        """Return True if the store is enabled."""
+        return self._storeDir != ""
+
+    def save(self, uid, result):
+        """Store the results of the job with given uid.
+
+        Files are written to a temporary file first and then atomically moved
+        in place, so that other nodes never read partially written results.
+
+        @param uid Unique identifier of the job.
+        @param result Dictionary of results.
+        """
+
+        if not self.isEnabled():
+            return
+
+        # Write the payloads to their own files
+        metadata = {}
+        for key in result.keys():
+            if key in self._payloadKeys:
+                self._writeFile(self._getPath(uid, key), result[key])
+            else:
+                metadata[key] = result[key]
+
+        # Write the results (last, so that the payloads are already there)
+        content = {"node": self._node, "result": metadata}
+        self._writeFile(self._getPath(uid, "json"), json.dumps(content))
+
+    def load(self, uid):
+        """Load the results of the job with given uid.
+
+        This is meant to be called when the current node does not know the
+        job (anymore): if the job is not completed but was started by the
+        current node, the node was restarted and the job is reported as failed.
+
+        @param uid Unique identifier of the job.
+        @return dictionary of results or None if the job is not in the store.
+        """
+
+        if not self.isEnabled():
+            return None
+
+        # Read the results
+        fileName = self._getPath(uid, "json")
+        if not os.path.isfile(fileName):
+            return None
+        content = json.loads(self._readFile(fileName))
+        result = content["result"]
+
+        # Read the payloads
+        for key in self._payloadKeys:
+            payloadFileName = self._getPath(uid, key)
+            if os.path.isfile(payloadFileName):
+                result[key] = self._readPayload(payloadFileName)
+            elif key not in result:
+                result[key] = ""
+
+        # Was the job interrupted by a restart of this node?
+        if not result.get("completed", True) and \
+            content["node"] == self._node:
+            result["completed"] = True
+            result["success"] = False
+            result["message"] = "The job was interrupted by a restart " + \
+                "of the server. Please try again."
+
+        return result
+
+    def purgeExpired(self):
+        """Delete all results older than the maximum age. The store folder is
+        listed at most once every _PURGE_INTERVAL_S seconds: further calls
+        return immediately."""
+
+        if not self.isEnabled():
+            return
+
+        now = time.time()
+        if now - self._lastPurge < _PURGE_INTERVAL_S:
+            return
+        self._lastPurge = now
+
+        for fileName in os.listdir(self._storeDir):
+            fullFileName = os.path.join(self._storeDir, fileName)
+            try:
+                if now - os.path.getmtime(fullFileName) > self._maxAgeSeconds:
+                    os.remove(fullFileName)
+            except OSError:
+                # The file was removed in the meanwhile by another node
+                pass
+
+    def _getPath(self, uid, extension):
+        """Return the full path of the file with given extension for a job.
+
+        @param uid Unique identifier of the job.
+        @param extension File extension.
+        @return string Full file path.
+        """
+        return os.path.join(self._storeDir, uid + "." + extension)
+
+    def _writeFile(self, fileName, content):
+        """Atomically write the content (string) to given file.
+
+        @param fileName Full path of the file to write.
+        @param content String to write.
+        """
+        tmpFileName = fileName + "." + self._node + "." + \
+            str(java.lang.Thread.currentThread().getId()) + ".tmp"
+        f = open(tmpFileName, "w")
+        try:
+            f.write(unicode(content).encode("utf-8"))
+        finally:
+            f.close()
+        Files.move(java.io.File(tmpFileName).toPath(),
+                   java.io.File(fileName).toPath(),
+                   StandardCopyOption.REPLACE_EXISTING,
+                   StandardCopyOption.ATOMIC_MOVE)
+
+    def _readFile(self, fileName):
+        """Read the content of given file.
+
+        @param fileName Full path of the file to read.
+        @return string Content of the file.
+        """
+        f = open(fileName, "r")
+        try:
+            return f.read().decode("utf-8")
+        finally:
+            f.close()
+
+    def _readPayload(self, fileName):
+        """Read the content of given payload file, from the cache of recently
+        read payloads if the file did not change.
+
+        @param fileName Full path of the file to read.
+        @return string Content of the file.
+        """
+
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            # The file was removed in the meanwhile
+            return ""
+        cacheKey = (fileName, stat.st_mtime, stat.st_size)
+
+        self._payloadCacheLock.acquire()
+        try:
+            content = self._payloadCache.get(cacheKey)
+            if content is not None:
+                self._payloadCacheOrder.remove(cacheKey)
+                self._payloadCacheOrder.append(cacheKey)
+                return content
+        finally:
+            self._payloadCacheLock.release()
+
+        content = self._readFile(fileName)
+        if len(content) > _PAYLOAD_CACHE_MAX_CHARS:
+            return content
+
+        self._payloadCacheLock.acquire()
+        try:
+            if cacheKey not in self._payloadCache:
+                self._payloadCache[cacheKey] = content
+                self._payloadCacheOrder.append(cacheKey)
+                self._payloadCacheChars += len(content)
+
+            # Evict the least recently read payloads
+            while self._payloadCacheChars > _PAYLOAD_CACHE_MAX_CHARS:
+                oldestKey = self._payloadCacheOrder.pop(0)
+                self._payloadCacheChars -= \
+                    len(self._payloadCache.pop(oldestKey))
+        finally:
+            self._payloadCacheLock.release()
+
+        return content
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Notes:
+#
+# - this module is also used by retrieve_fcs_events, which imports it from
+#   this folder: keep it free of plug-in specific code.
+
+'''
+Objects shared by all invocations of the flow plug-ins in the DSS (e.g. the
+export scheduler or the memory budget of the FCS event retrieval).
+
+The globals of a plug-in script do not outlive its invocation: the only
+process-wide storage is the LRCache. Its entries expire 24 hours after they
+were last set, so the shared objects are kept in one holder that is set again
+at least every hour while it is used. A shared object therefore stays the
+same as long as it is accessed regularly (e.g. from the progress updates of
+the jobs that depend on it); it is only recreated after a whole day without
+any use.
+'''
+
+import time
+from synchronize import apply_synchronized
+from ch.ethz.scu.obit.common.server.longrunning import LRCache
+
+# LRCache key of the holder of the shared objects
+_SHARED_STATE_KEY = "obit_flow_shared_state"
+
+# Maximum time in seconds between two updates of the holder in the LRCache
+# (well below the maximum age of the LRCache entries)
+_REFRESH_INTERVAL_S = 3600
+
+
+class _SharedState:
+    """Holder of the shared objects.
+
+    The LRCache logs the string representation of every value it stores:
+    the holder keeps it short, whatever it contains.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lastRefresh = 0
+
+    def __repr__(self):
+        # Also used by Jython as the Java toString()
+        return "<SharedState: " + str(len(self.objects)) + " objects>"
+
+
+def getSharedObject(name, factory):
+    """Return the shared object with given name.
+
+    @param name Name of the object (prefix it with the name of the plug-in).
+    @param factory Function without arguments that creates the object if it
+           does not exist yet.
+    @return the shared object.
+    """
+
+    def _get():
+        state = LRCache.get(_SHARED_STATE_KEY)
+        if state is None:
+            state = _SharedState()
+
+        now = time.time()
+        if now - state.lastRefresh > _REFRESH_INTERVAL_S:
+            state.lastRefresh = now
+            LRCache.set(_SHARED_STATE_KEY, state)
+
+        sharedObject = state.objects.get(name)
+        if sharedObject is None:
+            sharedObject = factory()
+            state.objects[name] = sharedObject
+        return sharedObject
+
+    return apply_synchronized(LRCache, _get, ())
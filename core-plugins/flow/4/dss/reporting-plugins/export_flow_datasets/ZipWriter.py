@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+
+'''
+Writer of the (ZIP64) archives of the "zip" export mode: the files are
+streamed into the archive in one pass, optionally compressed in parallel.
+'''
+
+import os
+import time
+import jarray
+import java.io.File
+import java.io.FileInputStream
+import java.io.FileOutputStream
+import java.io.RandomAccessFile
+import java.lang.String
+from java.nio import ByteBuffer
+from java.nio import ByteOrder
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutorCompletionService
+from java.util.concurrent import Executors
+from java.util.concurrent import TimeUnit
+from java.util.concurrent.atomic import AtomicBoolean
+from java.util.zip import CRC32
+from java.util.zip import Deflater
+from java.util.zip import DeflaterOutputStream
+from Manifest import Checksum
+
+# Signatures of the ZIP records
+_LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+_CENTRAL_DIRECTORY_HEADER_SIGNATURE = 0x02014b50
+_ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06064b50
+_ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE = 0x07064b50
+_END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+
+# Header id of the ZIP64 extended information extra field
+_ZIP64_EXTRA_FIELD_ID = 0x0001
+
+# Largest sizes, offsets and number of entries that do not need ZIP64
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_ENTRIES_LIMIT = 0xFFFF
+
+# Versions needed to extract the entries
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+
+# General purpose flag: the entry names are encoded in UTF-8
+_FLAG_UTF8 = 0x0800
+
+# Compression methods
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+# Offset of the CRC-32 in the local file header
+_CRC_OFFSET = 14
+
+# Size of the buffer used to stream the files into the archive
+_BUFFER_SIZE = 1024 * 1024
+
+# Number of compressed files (per compression thread) that may wait to be
+# written to the archive
+_MAX_PENDING_PER_THREAD = 2
+
+# Time in seconds that abort() waits for the compression threads to stop
+_ABORT_TIMEOUT_S = 60
+
+
+def _u16(value):
+    """Return the Java short with the bits of the unsigned 16-bit value."""
+    if value >= 0x8000:
+        return value - 0x10000
+    return value
+
+
+def _u32(value):
+    """Return the Java int with the bits of the unsigned 32-bit value."""
+    if value >= 0x80000000:
+        return value - 0x100000000
+    return value
+
+
+def _toDosDateTime(timestamp):
+    """Return the (time, date) pair in MS-DOS format of a timestamp."""
+    t = time.localtime(timestamp)
+    year = max(1980, t.tm_year)
+    dosTime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec / 2)
+    dosDate = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return (dosTime, dosDate)
+
+
+def deflateFile(source, dstFile, level, progress=None, aborted=None):
+    """Compress a file with the raw deflate method (as stored in ZIP archives).
+
+    @param source Full path of the file to compress.
+    @param dstFile Full path of the compressed file.
+    @param level Compression level (0-9).
+    @param progress (optional) ExportProgress: the compressed bytes of the
+           source are added to it.
+    @param aborted (optional) AtomicBoolean: the compression stops when it is
+           set.
+    @return tuple (crc, sha256, size, compressedSize) with the CRC-32, the
+            SHA-256 digest (hexadecimal string) and the size of the source and
+            the size of the compressed file.
+    @throws IOError if the compression was aborted.
+    @throws ExportCancelled if the export was cancelled.
+    """
+
+    deflater = Deflater(level, True)
+    checksum = Checksum()
+    size = 0
+    buffer = jarray.zeros(_BUFFER_SIZE, 'b')
+    inStream = java.io.FileInputStream(source)
+    try:
+        outStream = DeflaterOutputStream(java.io.FileOutputStream(dstFile),
+                                         deflater, _BUFFER_SIZE)
+        try:
+            while True:
+                if progress is not None:
+                    progress.checkCancelled()
+                if aborted is not None and aborted.get():
+                    raise IOError("The compression of " + source +
+                                  " was aborted.")
+                n = inStream.read(buffer)
+                if n < 0:
+                    break
+                checksum.updateBytes(buffer, 0, n)
+                outStream.write(buffer, 0, n)
+                size += n
+                if progress is not None:
+                    progress.addBytes(n)
+        finally:
+            outStream.close()
+    finally:
+        inStream.close()
+        deflater.end()
+
+    return (checksum.getCrc32(), checksum.getSha256(), size,
+            java.io.File(dstFile).length())
+
+
+class DeflateTask(Callable):
+    """Compress one file of the archive into a temporary file."""
+
+    def __init__(self, source, entryName, tmpFile, level, progress, aborted):
+        self.source = source
+        self.entryName = entryName
+        self.tmpFile = tmpFile
+        self.progress = progress
+        (self.dosTime, self.dosDate) = _toDosDateTime(os.path.getmtime(source))
+        self.crc = 0
+        self.sha256 = ""
+        self.size = 0
+        self.compressedSize = 0
+        self.error = None
+        self._level = level
+        self._aborted = aborted
+
+    def call(self):
+        """Return the task, with the checksums and sizes (or the error)."""
+
+        try:
+            (self.crc, self.sha256, self.size, self.compressedSize) = deflateFile(
+                self.source, self.tmpFile, self._level, self.progress,
+                self._aborted)
+        except Exception, e:
+            self.error = str(e)
+        return self
+
+
+class ZipEntry:
+    """Description of one entry of the archive, as needed to write the central
+    directory."""
+
+    def __init__(self, name, method, dosTime, dosDate, offset, zip64):
+        self.name = name
+        self.method = method
+        self.dosTime = dosTime
+        self.dosDate = dosDate
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compressedSize = 0
+        self.size = 0
+
+
+class ZipWriter:
+    """The ZipWriter class writes a (ZIP64) archive in one pass.
+
+    The files are streamed from their location (e.g. the DSS store) directly
+    into the archive: the CRC-32 of each file is computed while the file is
+    written and then patched into its local file header, so that every byte
+    is read only once and no copy of the files is ever made.
+
+    The ZIP64 extensions are used for the files, offsets and archives (or
+    number of entries) that are too large for the standard ZIP format.
+
+    The SHA-256 digest of each file is computed in the same pass as its CRC-32
+    (see getChecksums()), for the manifest of the export.
+
+    With METHOD_DEFLATED, the files are compressed in parallel on a pool of
+    threads, each into a temporary file next to the archive; the compressed
+    files are then appended to the archive in the order in which they are
+    ready. Files that do not get smaller are stored instead.
+    """
+
+    # Constructor
+    def __init__(self, fileName, method=METHOD_STORED, numThreads=1,
+                 level=Deflater.BEST_SPEED):
+        """Constructor
+
+        @param fileName Full path of the archive. An existing file is
+               replaced (it is deleted rather than overwritten in place, since
+               it may be a hard link to a cached archive).
+        @param method METHOD_STORED or METHOD_DEFLATED.
+        @param numThreads Number of files that are compressed in parallel
+               (only for METHOD_DEFLATED).
+        @param level Compression level (only for METHOD_DEFLATED).
+        """
+
+        self._fileName = fileName
+        self._method = method
+        self._level = level
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+        self._file = java.io.RandomAccessFile(fileName, "rw")
+        self._file.setLength(0)
+        self._channel = self._file.getChannel()
+
+        # Buffer used to stream the files
+        self._buffer = ByteBuffer.allocateDirect(_BUFFER_SIZE)
+
+        # Entries written so far, and checksums of the added files (entry
+        # name -> (size, crc32, sha256))
+        self._entries = []
+        self._checksums = {}
+
+        # Compression threads
+        self._executor = None
+        if self._method == METHOD_DEFLATED:
+            self._numThreads = max(1, numThreads)
+            self._executor = Executors.newFixedThreadPool(self._numThreads)
+            self._completionService = ExecutorCompletionService(self._executor)
+
+        # Number of files being compressed or waiting to be written, and their
+        # temporary files
+        self._numPending = 0
+        self._tmpFiles = set()
+        self._numTmpFiles = 0
+
+        # Set when the archive is aborted, to stop the compression threads
+        self._aborted = AtomicBoolean(False)
+
+        self._closed = False
+
+    def addFile(self, source, entryName, progress=None):
+        """Add a file to the archive.
+
+        With METHOD_STORED, the file is streamed into the archive before the
+        method returns. With METHOD_DEFLATED, it is queued for compression and
+        written later (at the latest by close()).
+
+        @param source Full path of the file to add.
+        @param entryName Name (relative path with '/' separators) of the file
+               in the archive.
+        @param progress (optional) ExportProgress: the read bytes are added
+               to it, and the file is counted once it is in the archive.
+        @throws IOError if the file could not be added.
+        @throws ExportCancelled if the export was cancelled.
+        """
+
+        if self._method == METHOD_STORED:
+            self._addStoredFile(source, entryName, progress)
+            if progress is not None:
+                progress.addFile()
+            return
+
+        # Queue the file for compression
+        self._numTmpFiles += 1
+        tmpFile = self._fileName + "." + str(self._numTmpFiles) + ".tmp"
+        self._tmpFiles.add(tmpFile)
+        self._completionService.submit(
+            DeflateTask(source, entryName, tmpFile, self._level, progress,
+                        self._aborted))
+        self._numPending += 1
+
+        # Do not let compressed files pile up on disk
+        while self._numPending >= _MAX_PENDING_PER_THREAD * self._numThreads:
+            self._writeCompressedFile(self._completionService.take().get())
+
+    def _addStoredFile(self, source, entryName, progress):
+        """Stream a file into the archive (without compression)."""
+
+        size = os.path.getsize(source)
+        (dosTime, dosDate) = _toDosDateTime(os.path.getmtime(source))
+        entry = ZipEntry(java.lang.String(entryName).getBytes("UTF-8"),
+                         METHOD_STORED, dosTime, dosDate,
+                         self._channel.position(), size >= _ZIP64_LIMIT)
+        entry.size = size
+        entry.compressedSize = size
+        self._writeLocalFileHeader(entry)
+
+        # Stream the content of the file
+        checksum = Checksum()
+        numBytes = 0
+        inStream = java.io.FileInputStream(source)
+        try:
+            inChannel = inStream.getChannel()
+            while True:
+                if progress is not None:
+                    progress.checkCancelled()
+                self._buffer.clear()
+                n = inChannel.read(self._buffer)
+                if n < 0:
+                    break
+                self._buffer.flip()
+                checksum.update(self._buffer)
+                self._write(self._buffer)
+                numBytes += n
+                if progress is not None:
+                    progress.addBytes(n)
+        finally:
+            inStream.close()
+
+        if numBytes != size:
+            raise IOError("The file " + source + " changed while it was " +
+                          "added to the archive.")
+
+        # Patch the CRC-32 into the local file header
+        entry.crc = checksum.getCrc32()
+        buffer = self._allocate(4)
+        buffer.putInt(_u32(entry.crc))
+        buffer.flip()
+        self._channel.write(buffer, entry.offset + _CRC_OFFSET)
+
+        self._entries.append(entry)
+        self._checksums[entryName] = (size, entry.crc, checksum.getSha256())
+
+    def _writeCompressedFile(self, task):
+        """Write a file compressed by a DeflateTask to the archive."""
+
+        self._numPending -= 1
+        try:
+            if task.error is not None:
+                if task.progress is not None:
+                    task.progress.checkCancelled()
+                raise IOError("Could not compress " + task.source + ": " +
+                              task.error)
+
+            # Store the files that do not get smaller
+            if task.compressedSize < task.size:
+                method = METHOD_DEFLATED
+                dataFile = task.tmpFile
+                compressedSize = task.compressedSize
+            else:
+                method = METHOD_STORED
+                dataFile = task.source
+                compressedSize = task.size
+
+            entry = ZipEntry(java.lang.String(task.entryName).getBytes("UTF-8"),
+                             method, task.dosTime, task.dosDate,
+                             self._channel.position(),
+                             task.size >= _ZIP64_LIMIT or
+                             compressedSize >= _ZIP64_LIMIT)
+            entry.crc = task.crc
+            entry.size = task.size
+            entry.compressedSize = compressedSize
+            self._writeLocalFileHeader(entry)
+            self._append(dataFile, compressedSize)
+            self._entries.append(entry)
+            self._checksums[task.entryName] = (task.size, task.crc,
+                                               task.sha256)
+        finally:
+            self._deleteTmpFile(task.tmpFile)
+
+        if task.progress is not None:
+            task.progress.addFile()
+
+    def _append(self, fileName, size):
+        """Append size bytes of the given file at the end of the archive."""
+
+        inStream = java.io.FileInputStream(fileName)
+        try:
+            inChannel = inStream.getChannel()
+            position = 0
+            while position < size:
+                transferred = inChannel.transferTo(position, size - position,
+                                                   self._channel)
+                if transferred <= 0:
+                    raise IOError("The file " + fileName + " changed while " +
+                                  "it was added to the archive.")
+                position += transferred
+        finally:
+            inStream.close()
+
+    def _deleteTmpFile(self, tmpFile):
+        """Delete a temporary file of the compression."""
+        self._tmpFiles.discard(tmpFile)
+        if os.path.isfile(tmpFile):
+            os.remove(tmpFile)
+
+    def addEmptyFile(self, entryName):
+        """Add an empty file to the archive.
+
+        @param entryName Name (relative path with '/' separators) of the file
+               in the archive.
+        """
+
+        (dosTime, dosDate) = _toDosDateTime(time.time())
+        entry = ZipEntry(java.lang.String(entryName).getBytes("UTF-8"),
+                         METHOD_STORED, dosTime, dosDate,
+                         self._channel.position(), False)
+        self._writeLocalFileHeader(entry)
+        self._entries.append(entry)
+
+    def addText(self, entryName, text):
+        """Add a (small) text file to the archive.
+
+        @param entryName Name (relative path with '/' separators) of the file
+               in the archive.
+        @param text Content of the file (it is stored UTF-8 encoded).
+        """
+
+        data = java.lang.String(text).getBytes("UTF-8")
+        crc = CRC32()
+        crc.update(data)
+        (dosTime, dosDate) = _toDosDateTime(time.time())
+        entry = ZipEntry(java.lang.String(entryName).getBytes("UTF-8"),
+                         METHOD_STORED, dosTime, dosDate,
+                         self._channel.position(), False)
+        entry.crc = crc.getValue()
+        entry.size = len(data)
+        entry.compressedSize = len(data)
+        self._writeLocalFileHeader(entry)
+        self._write(ByteBuffer.wrap(data))
+        self._entries.append(entry)
+
+    def getChecksums(self):
+        """Return the checksums of the files added so far, as a dictionary
+        entry name -> (size, crc32, sha256). With METHOD_DEFLATED, the files
+        that are still being compressed are not included (see flush())."""
+        return self._checksums
+
+    def flush(self):
+        """Wait for the files that are still being compressed and write
+        them to the archive."""
+        while self._numPending > 0:
+            self._writeCompressedFile(self._completionService.take().get())
+
+    def close(self):
+        """Write the central directory and close the archive."""
+
+        if self._closed:
+            return
+
+        # Write the files that are still being compressed
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        self._closed = True
+
+        try:
+            self._writeCentralDirectory()
+        finally:
+            self._file.close()
+
+    def abort(self):
+        """Close and delete the (incomplete) archive and the temporary files
+        of the compression."""
+
+        self._closed = True
+        if self._executor is not None:
+            self._aborted.set(True)
+            self._executor.shutdownNow()
+            self._executor.awaitTermination(_ABORT_TIMEOUT_S, TimeUnit.SECONDS)
+            for tmpFile in list(self._tmpFiles):
+                self._deleteTmpFile(tmpFile)
+        self._file.close()
+        if os.path.isfile(self._fileName):
+            os.remove(self._fileName)
+
+    def getNumberOfEntries(self):
+        """Return the number of entries written so far."""
+        return len(self._entries)
+
+    def _allocate(self, size):
+        """Return a little-endian buffer of given size."""
+        buffer = ByteBuffer.allocate(size)
+        buffer.order(ByteOrder.LITTLE_ENDIAN)
+        return buffer
+
+    def _write(self, buffer):
+        """Write the remaining content of the buffer at the end of the
+        archive."""
+        while buffer.hasRemaining():
+            self._channel.write(buffer)
+
+    def _writeLocalFileHeader(self, entry):
+        """Write the local file header of an entry. The CRC-32 is patched in
+        once the content of the entry is written."""
+
+        extraLength = 20 if entry.zip64 else 0
+        buffer = self._allocate(30 + len(entry.name) + extraLength)
+        buffer.putInt(_LOCAL_FILE_HEADER_SIGNATURE)
+        buffer.putShort(_VERSION_ZIP64 if entry.zip64 else _VERSION_DEFAULT)
+        buffer.putShort(_FLAG_UTF8)
+        buffer.putShort(entry.method)
+        buffer.putShort(_u16(entry.dosTime))
+        buffer.putShort(_u16(entry.dosDate))
+        buffer.putInt(_u32(entry.crc))
+        if entry.zip64:
+            buffer.putInt(_u32(_ZIP64_LIMIT))
+            buffer.putInt(_u32(_ZIP64_LIMIT))
+        else:
+            buffer.putInt(_u32(entry.compressedSize))
+            buffer.putInt(_u32(entry.size))
+        buffer.putShort(len(entry.name))
+        buffer.putShort(extraLength)
+        buffer.put(entry.name)
+        if entry.zip64:
+            buffer.putShort(_ZIP64_EXTRA_FIELD_ID)
+            buffer.putShort(16)
+            buffer.putLong(entry.size)
+            buffer.putLong(entry.compressedSize)
+        buffer.flip()
+        self._write(buffer)
+
+    def _writeCentralDirectory(self):
+        """Write the central directory and the end of central directory
+        records."""
+
+        start = self._channel.position()
+
+        for entry in self._entries:
+
+            # The values that do not fit are stored in the ZIP64 extra field
+            zip64Values = []
+            if entry.size >= _ZIP64_LIMIT:
+                zip64Values.append(entry.size)
+            if entry.compressedSize >= _ZIP64_LIMIT:
+                zip64Values.append(entry.compressedSize)
+            if entry.offset >= _ZIP64_LIMIT:
+                zip64Values.append(entry.offset)
+            extraLength = 4 + 8 * len(zip64Values) if zip64Values else 0
+            version = _VERSION_ZIP64 if entry.zip64 or zip64Values \
+                else _VERSION_DEFAULT
+
+            buffer = self._allocate(46 + len(entry.name) + extraLength)
+            buffer.putInt(_CENTRAL_DIRECTORY_HEADER_SIGNATURE)
+            buffer.putShort(version)
+            buffer.putShort(version)
+            buffer.putShort(_FLAG_UTF8)
+            buffer.putShort(entry.method)
+            buffer.putShort(_u16(entry.dosTime))
+            buffer.putShort(_u16(entry.dosDate))
+            buffer.putInt(_u32(entry.crc))
+            buffer.putInt(_u32(min(entry.compressedSize, _ZIP64_LIMIT)))
+            buffer.putInt(_u32(min(entry.size, _ZIP64_LIMIT)))
+            buffer.putShort(len(entry.name))
+            buffer.putShort(extraLength)
+            buffer.putShort(0)
+            buffer.putShort(0)
+            buffer.putShort(0)
+            buffer.putInt(0)
+            buffer.putInt(_u32(min(entry.offset, _ZIP64_LIMIT)))
+            buffer.put(entry.name)
+            if zip64Values:
+                buffer.putShort(_ZIP64_EXTRA_FIELD_ID)
+                buffer.putShort(8 * len(zip64Values))
+                for value in zip64Values:
+                    buffer.putLong(value)
+            buffer.flip()
+            self._write(buffer)
+
+        end = self._channel.position()
+        numEntries = len(self._entries)
+        size = end - start
+
+        if numEntries >= _ZIP64_ENTRIES_LIMIT or size >= _ZIP64_LIMIT or \
+                start >= _ZIP64_LIMIT:
+
+            # ZIP64 end of central directory record and locator
+            buffer = self._allocate(56 + 20)
+            buffer.putInt(_ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+            buffer.putLong(44)
+            buffer.putShort(_VERSION_ZIP64)
+            buffer.putShort(_VERSION_ZIP64)
+            buffer.putInt(0)
+            buffer.putInt(0)
+            buffer.putLong(numEntries)
+            buffer.putLong(numEntries)
+            buffer.putLong(size)
+            buffer.putLong(start)
+            buffer.putInt(_ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE)
+            buffer.putInt(0)
+            buffer.putLong(end)
+            buffer.putInt(1)
+            buffer.flip()
+            self._write(buffer)
+
+        # End of central directory record
+        buffer = self._allocate(22)
+        buffer.putInt(_END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+        buffer.putShort(0)
+        buffer.putShort(0)
+        buffer.putShort(_u16(min(numEntries, _ZIP64_ENTRIES_LIMIT)))
+        buffer.putShort(_u16(min(numEntries, _ZIP64_ENTRIES_LIMIT)))
+        buffer.putInt(_u32(min(size, _ZIP64_LIMIT)))
+        buffer.putInt(_u32(min(start, _ZIP64_LIMIT)))
+        buffer.putShort(0)
+        buffer.flip()
+        self._write(buffer)
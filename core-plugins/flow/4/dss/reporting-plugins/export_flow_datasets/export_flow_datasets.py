@@ -10,94 +10,92 @@ from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchCriteria
 from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchSubCriteria
 from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClause
 from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClauseAttribute
-from ch.systemsx.cisd.base.utilities import OSUtilities
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import SearchOperator
 import os
-import subprocess
 import sys
 import re
-import zipfile
+import shutil
 import java.io.File
+from java.util.concurrent import Callable
+from java.util.concurrent import Executors
 from ch.ethz.scu.obit.common.server.longrunning import LRCache
+from ResultStore import ResultStore
+from SharedState import getSharedObject
+from ArchiveCache import ArchiveCache
+from ArchiveCache import buildArchiveKey
+from CopyEngine import CopyEngine
+from CopyEngine import computeChecksums
+from Manifest import MANIFEST_FILE_NAME
+from Manifest import formatManifest
+from Manifest import readManifest
+from Manifest import writeManifest
+from ZipWriter import ZipWriter
+from ZipWriter import METHOD_DEFLATED
+from ZipWriter import METHOD_STORED
+from ExportProgress import ExportCancelled
+from ExportProgress import ExportProgress
+from ExportScheduler import ExportScheduler
 import uuid
 from threading import Thread
+from threading import Event
 import logging
 from __builtin__ import True, None
 
 _DEBUG = False
 
+# Prefix of the keys of the cancellation requests (in the LRCache and in the
+# result store)
+_CANCEL_KEY_PREFIX = "export_flow_datasets_cancel_"
 
-def touch(full_file):
-    """Touches a file.
-    """
-    f = open(full_file, 'w')
-    f.close()
-
-
-def zip_folder(folder_path, output_path):
-    """Zip the contents of an entire folder recursively. Please notice that
-    empty sub-folders will NOT be included in the archive.
-    """
+# Interval in seconds between two updates of the progress of a job
+_PROGRESS_INTERVAL_S = 1.0
 
-    # Note: os.path.relpath() does not exist in Jython.
-    # target = os.path.relpath(folder_path, start=os.path.dirname(folder_path))
-    target = folder_path[folder_path.rfind(os.sep) + 1:]
-
-    # Simple trick to build relative paths
-    root_len = folder_path.find(target)
-
-    try:
+# Tasks that export several experiment samples of the collection
+_MULTI_EXPERIMENT_TASKS = ["COLLECTION", "EXPERIMENTS"]
 
-        # Open zip file (no compression)
-        zip_file = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+# Name of the export scheduler shared by all jobs (see SharedState.py)
+_SCHEDULER_NAME = "export_flow_datasets.scheduler"
 
-        # Now recurse into the folder
-        for root, folders, files in os.walk(folder_path):
+# Name of the result store shared by all jobs (see SharedState.py)
+_RESULT_STORE_NAME = "export_flow_datasets.resultStore"
 
-            # We do not process folders. This is only useful to store empty
-            # folders to the archive, but 1) jython's zipfile implementation
-            # throws:
-            #
-            #     Exception: [Errno 21] Is a directory <directory_name>
-            #
-            # when trying to write a directory to a zip file (in contrast to
-            # Python's implementation) and 2) oBIT does not export empty
-            # folders in the first place.
+# Progress columns of the job results with their initial values
+_PROGRESS_COLUMNS = [("nFilesDone", 0), ("nFilesTotal", 0),
+                     ("nBytesDone", 0), ("nBytesTotal", 0),
+                     ("throughput", 0), ("eta", -1), ("cancelled", False),
+                     ("queuePosition", 0)]
 
-            # Build the relative directory path (current root)
-            relative_dir_path = os.path.abspath(root)[root_len:]
 
-            # If a folder only contains a subfolder, we disrupt the hierarchy,
-            # unless we add a file.
-            if len(files) == 0:
-                touch(os.path.join(root, '~'))
-                files.append('~')
-
-            # Include all files
-            for file_name in files:
-
-                # Full file path to add
-                full_file_path = os.path.join(root, file_name)
-                relative_file_path = os.path.join(relative_dir_path, file_name)
+def getFilesForDataSet(code):
+    """
+    Get the list of FCS file paths of the dataset with given code. If no
+    files are found, returns [].
+    """
 
-                # Workaround problem with file name encoding
-                full_file_path = full_file_path.encode('latin-1')
-                relative_file_path = relative_file_path.encode('latin-1')
+    dataSetFiles = []
+    content = contentProvider.getContent(code)
+    nodes = content.listMatchingNodes("original", ".*\.fcs")
+    if nodes is not None:
+        for node in nodes:
+            fileName = node.tryGetFile()
+            if fileName is not None:
+                fileName = str(fileName)
+                if fileName.lower().endswith(".fcs"):
+                    dataSetFiles.append(fileName)
 
-                # Write to zip
-                zip_file.write(full_file_path, relative_file_path, \
-                               zipfile.ZIP_STORED)
+    # Return the files
+    return dataSetFiles
 
-    except IOError, message:
-        raise Exception(message)
 
-    except OSError, message:
-        raise Exception(message)
+class DataSetFilesTask(Callable):
+    """Look up the FCS files of one dataset."""
 
-    except zipfile.BadZipfile, message:
-        raise Exception(message)
+    def __init__(self, code):
+        self._code = code
 
-    finally:
-        zip_file.close()
+    def call(self):
+        """Return the list of FCS file paths of the dataset."""
+        return getFilesForDataSet(self._code)
 
 
 class Mover():
@@ -107,14 +105,17 @@ class Mover():
     """
 
     def __init__(self, task, collectionId, collectionType, expSampleId, expSamplePermId,
-                 expSampleType, platePermId, plateType, mode, userId, properties, logger):
+                 expSampleType, platePermId, plateType, mode, userId, properties, logger,
+                 incremental=False, compression="none", throttle=None):
         """Constructor
 
         task           : helper argument to define what to export. 
         collectionId   : id of the collection
         collectionType : type of the collection
         expSampleId    : id of the experiment sample.
-        expSamplePermId: permId of the experiment sample.
+        expSamplePermId: permId of the experiment sample. For task
+                         "EXPERIMENTS", comma-separated list of the permIds
+                         of the experiment samples to export.
         expSampleType  : type of the experiment sample.
         entityId       : id of the entity to export (with children)
         entityType     : type of the entity to export
@@ -125,6 +126,13 @@ class Mover():
         userId         : user id.
         properties     : plug-in properties.
         logger         : logger.
+        incremental    : if True (and mode is "normal"), an existing export
+                         folder is reused and the files that are already
+                         there and unchanged are not copied again.
+        compression    : "none" or "deflate". If mode is "zip" and
+                         compression is "deflate", the files are compressed
+                         in the archive.
+        throttle       : (optional) Throttle that limits the copy rate.
         """
 
         # Logger
@@ -143,6 +151,8 @@ class Mover():
                               "    plateType       = " + plateType + "\n" +
                               "    mode            = " + mode + "\n" +
                               "    userId          = " + userId + "\n" +
+                              "    incremental     = " + str(incremental) + "\n" +
+                              "    compression     = " + compression + "\n" +
                               "    properties      = " + str(properties) + "\n")
 
         # Store properties
@@ -172,15 +182,27 @@ class Mover():
         # Entity type
         self._plateType = plateType
 
-        # Get the EXPERIMENT SAMPLE object
-        self._experimentSample = self._getFlowExperimentSample()
-        if self._experimentSample is None:
-            raise Exception("Could not retrieve experiment sample with permId " + \
-                             self._expSamplePermId + ".")
-
         # Get the COLLECTION object
         self._experiment = searchService.getExperiment(self._collectionId)
 
+        # Get the EXPERIMENT SAMPLE object (for the multi-experiment tasks,
+        # get all of them: they are exported one after the other, see
+        # _copyDataSetsForExperiments())
+        self._experimentSamples = []
+        if self._task in _MULTI_EXPERIMENT_TASKS:
+            self._experimentSamples = self._getFlowExperimentSamples()
+            if len(self._experimentSamples) == 0:
+                raise Exception("Could not retrieve any experiment sample " + \
+                                "of type " + self._expSampleType + ".")
+            self._expSampleId = self._experimentSamples[0].getSampleIdentifier()
+            self._expSamplePermId = self._experimentSamples[0].getPermId()
+            self._experimentSample = self._experimentSamples[0]
+        else:
+            self._experimentSample = self._getFlowExperimentSample()
+            if self._experimentSample is None:
+                raise Exception("Could not retrieve experiment sample with permId " + \
+                                 self._expSamplePermId + ".")
+
         # Get the PLATE object
         self._plate = None
         if self._platePermId != "" and self._plateType != "":
@@ -226,6 +248,12 @@ class Mover():
         # Store the mode
         self._mode = mode
 
+        # Incremental export (only to the user folder)
+        self._incremental = incremental and mode == "normal"
+
+        # Compression of the archive (only in "zip" mode)
+        self._compression = compression
+
         # Make sure the use folder (with export subfolder) exists and has
         # the correct permissions
         if not os.path.isdir(self._userFolder):
@@ -251,6 +279,39 @@ class Mover():
         # Keep track of the number of copied files
         self._numCopiedFiles = 0
 
+        # Keep track of the number of unchanged files that were skipped
+        self._numSkippedFiles = 0
+
+        # Files to export: list of (source file, destination folder), and
+        # codes of their datasets
+        self._plan = []
+        self._planned = False
+        self._dataSetCodes = set()
+
+        # Cache of finished archives (only in "zip" mode)
+        self._archiveCache = ArchiveCache(
+            self._properties['archive_cache_dir'],
+            int(float(self._properties['archive_cache_max_size_gb']) *
+                1024 * 1024 * 1024),
+            self._logger)
+
+        # Progress of the export (also used to cancel it and to throttle
+        # the copies)
+        self._progress = ExportProgress(throttle)
+
+        # Topmost folders created by the export (they are removed if the
+        # export is cancelled)
+        self._createdFolders = []
+
+        # Copy engine (see process())
+        self._copyEngine = None
+
+        # Archive writer (see process(); only in "zip" mode)
+        self._zipWriter = None
+
+        # Archive folders that contain files (only in "zip" mode)
+        self._archiveFoldersWithFiles = set()
+
     # Public methods
     # =========================================================================
 
@@ -260,54 +321,89 @@ class Mover():
         structure of the experiment and copies it to the user folder. If the
         processing was successful, the method returns True. Otherwise,
         it returns False.
+
+        In "zip" mode, the files are streamed from the store directly into
+        the zip archive instead.
+
+        A manifest (MANIFEST.tsv) with the sizes and checksums of the
+        exported files is added to the export folder or to the archive.
         """
 
-        # Create the experiment (sample) folder in the user/export
-        if not self._createRootAndExperimentFolder():
+        # Create the experiment (sample) folder in the user/export (for the
+        # multi-experiment tasks, the folders are created while the files are
+        # collected)
+        if self._task not in _MULTI_EXPERIMENT_TASKS and \
+                not self._createRootAndExperimentFolder():
             self._message = "Could not create experiment folder " + \
             self._rootExportPath
             self._logger.error(self._message)
             return False
 
-        self._logger.info("Starting copy...")
-
-        # Now process depending on the task
-        if self._task == "EXPERIMENT_SAMPLE":
-
-            # Copy all datasets contained in this experiment
-            return self._copyDataSetsForExperiment()
+        # Collect the files of the requested task
+        if not self._planTask():
+            return False
 
-        if self._task == "ALL_PLATES":
+        self._progress.start()
 
-            # Copy all datasets for all plates Experiment
-            return self._copyDataSetsForPlates()
+        if self._mode == "zip":
+            success = self._archiveFiles()
+            if success:
+                self._archiveCache.store(self._getArchiveCacheKey(),
+                                         self.getZipArchiveFullPath())
+        else:
+            success = self._copyFiles()
 
-        if self._task == "TUBESET":
+        if self._progress.isCancelled():
+            self._message = "The export was cancelled."
+            self._logger.info(self._message)
+            self._removePartialOutput()
+            return False
 
-            # Copy all datasets for all plates Experiment
-            return self._copyDataSetsForTubes()
+        # Return
+        return success
 
-        if self._task == "PLATE":
+    def serveArchiveFromCache(self):
+        """
+        In "zip" mode, serves an identical archive from the archive cache
+        (if enabled) instead of building it again. Returns True if the archive
+        was found in the cache, False otherwise (the files of the task are
+        then already collected for process()).
+        """
 
-            # Copy all the datasets contained in selected plate
-            return self._copyDataSetsForPlate(self._plate)
+        if self._mode != "zip" or not self._archiveCache.isEnabled():
+            return False
 
-        else:
+        if not self._planTask():
+            return False
 
-            self._message = "Unknown task!"
-            self._logger.error(self._message)
+        if not self._archiveCache.fetch(self._getArchiveCacheKey(),
+                                        self.getZipArchiveFullPath()):
             return False
 
-        # Return
+        # Nothing left to do
+        for (source, dstDir) in self._plan:
+            self._progress.addSkippedFile(os.path.getsize(source))
+        self._numCopiedFiles = len(self._plan)
         return True
 
-    def compressIfNeeded(self):
-        """Compresses the exported experiment folder to a zip archive
-        but only if the mode was "zip".
+    def cancel(self):
+        """
+        Cancels the export: the files that are being copied are abandoned,
+        no further file is copied, and the partial output is removed.
         """
+        self._progress.cancel()
 
-        if self._mode == "zip":
-            zip_folder(self._rootExportPath, self.getZipArchiveFullPath())
+    def isCancelled(self):
+        """
+        Return True if the export was cancelled.
+        """
+        return self._progress.isCancelled()
+
+    def getProgress(self):
+        """
+        Return the progress (ExportProgress) of the export.
+        """
+        return self._progress
 
     def getZipArchiveFullPath(self):
         """Return the full path of the zip archive (or "" if mode was "normal").
@@ -339,6 +435,13 @@ class Mover():
         """
         return self._numCopiedFiles
 
+    def getNumberOfSkippedFiles(self):
+        """
+        Return the number of files that were skipped because an unchanged
+        copy already existed (incremental export only).
+        """
+        return self._numSkippedFiles
+
     def getRelativeRootExperimentPath(self):
         """
         Return the experiment path relative to the user folder.
@@ -386,6 +489,100 @@ class Mover():
         # Return
         return samples[0]
 
+    def _getFlowExperimentSamples(self):
+        """
+        Find the {FLOW}_EXPERIMENT samples to export in a multi-experiment
+        task (with one search): all experiment samples of the collection for
+        task "COLLECTION", or the listed ones for task "EXPERIMENTS". The
+        samples are sorted by code.
+
+        Raises an Exception if some of the listed samples do not exist or do
+        not belong to the collection.
+        """
+
+        requestedPermIds = None
+        searchCriteria = SearchCriteria()
+        if self._task == "EXPERIMENTS":
+            requestedPermIds = set([permId.strip() for permId in
+                                    self._expSamplePermId.split(",")
+                                    if permId.strip() != ""])
+            searchCriteria.setOperator(SearchOperator.MATCH_ANY_CLAUSES)
+            for permId in requestedPermIds:
+                searchCriteria.addMatchClause(
+                    MatchClause.createAttributeMatch(
+                        MatchClauseAttribute.PERM_ID,
+                        permId))
+        else:
+            searchCriteria.addMatchClause(
+                MatchClause.createAttributeMatch(
+                    MatchClauseAttribute.TYPE,
+                    self._expSampleType))
+
+        # The samples belong to the collection
+        expCriteria = SearchCriteria()
+        expCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.PERM_ID,
+                self._experiment.getPermId()))
+        searchCriteria.addSubCriteria(
+            SearchSubCriteria.createExperimentCriteria(expCriteria))
+
+        # Search (with MATCH_ANY_CLAUSES, the collection criterion may be
+        # OR-ed with the perm ids as well: only the requested samples of the
+        # collection are kept)
+        collectionIdentifier = self._experiment.getExperimentIdentifier()
+        samples = []
+        foreignPermIds = []
+        for sample in searchService.searchForSamples(searchCriteria):
+            if sample.getSampleType() != self._expSampleType:
+                continue
+            if requestedPermIds is not None and \
+                    sample.getPermId() not in requestedPermIds:
+                continue
+            experiment = sample.getExperiment()
+            if experiment is None or \
+                    experiment.getExperimentIdentifier() != collectionIdentifier:
+                foreignPermIds.append(sample.getPermId())
+                continue
+            samples.append(sample)
+        samples.sort(key=lambda sample: sample.getCode())
+
+        # All listed samples must be exported
+        if requestedPermIds is not None and \
+                len(samples) != len(requestedPermIds):
+            foundPermIds = set([sample.getPermId() for sample in samples])
+            missingPermIds = requestedPermIds - foundPermIds - \
+                set(foreignPermIds)
+            message = "Could not export the requested experiment samples."
+            if len(missingPermIds) > 0:
+                message += " Not found (or not of type " + \
+                    self._expSampleType + "): " + \
+                    ", ".join(sorted(missingPermIds)) + "."
+            if len(foreignPermIds) > 0:
+                message += " Not in collection " + self._collectionId + \
+                    ": " + ", ".join(sorted(foreignPermIds)) + "."
+            raise Exception(message)
+
+        self._logger.info("Found " + str(len(samples)) + " experiment samples " +
+                          "to export in collection " + self._collectionId + ".")
+
+        # Return
+        return samples
+
+    def _selectExperimentSample(self, experimentSample):
+        """
+        Make the given {FLOW}_EXPERIMENT sample the current one: its files
+        are collected into its own folder.
+        """
+
+        self._experimentSample = experimentSample
+        self._expSampleId = experimentSample.getSampleIdentifier()
+        self._expSamplePermId = experimentSample.getPermId()
+        self._experimentSampleName = experimentSample.getCode() + "/" + \
+            experimentSample.getPropertyValue("$NAME")
+        self._experimentPath = os.path.join(self._rootExportPath,
+                                            self._experimentSampleName)
+
     def _retrieveSampleWithTypeAndPermId(self, samplePermId, sampleType):
         """
         Retrieve a sample belonging to current experiment 
@@ -493,46 +690,290 @@ class Mover():
         # Return the samples
         return samples
 
-    def _retrieveAllSamplesWithTypeAndParent(self, sampleType, parentSampleId, parentSampleType):
+    def _copyDataSetsForTask(self):
         """
-        Retrieve all samples belonging to current experiment 
-        sample and collection having specified type.
+        Queues the files of the requested task for copying.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
         """
 
-        if _DEBUG:
-            self._logger.info("Retrieving samples of type " + sampleType +
-                              " with parent sample with id " + parentSampleId +
-                              " and type " + parentSampleType)
+        # Now process depending on the task
+        if self._task == "EXPERIMENT_SAMPLE":
 
-        # The samples are of type 'sampleType'
-        searchCriteria = SearchCriteria()
-        searchCriteria.addMatchClause(
-            MatchClause.createAttributeMatch(
-                MatchClauseAttribute.TYPE,
-                sampleType)
-            )
+            # Copy all datasets contained in this experiment
+            return self._copyDataSetsForExperiment()
 
-        # The samples have given parent
-        expSampleCriteria = SearchCriteria()
-        expSampleCriteria.addMatchClause(
-            MatchClause.createAttributeMatch(
-                MatchClauseAttribute.TYPE,
-                parentSampleType)
-            )
-        expSampleCriteria.addMatchClause(
-            MatchClause.createAttributeMatch(
-                MatchClauseAttribute.CODE,
-                parentSampleId)
-            )
-        searchCriteria.addSubCriteria(
-            SearchSubCriteria.createSampleParentCriteria(expSampleCriteria)
-        )
+        if self._task == "ALL_PLATES":
 
-        # Now search
-        samples = searchService.searchForSamples(searchCriteria)
+            # Copy all datasets for all plates Experiment
+            return self._copyDataSetsForPlates()
 
-        # Return the samples
-        return samples
+        if self._task == "TUBESET":
+
+            # Copy all datasets for all plates Experiment
+            return self._copyDataSetsForTubes()
+
+        if self._task == "PLATE":
+
+            # Copy all the datasets contained in selected plate
+            return self._copyDataSetsForPlate(self._plate)
+
+        if self._task in _MULTI_EXPERIMENT_TASKS:
+
+            # Copy all datasets of all selected experiments
+            return self._copyDataSetsForExperiments()
+
+        else:
+
+            self._message = "Unknown task!"
+            self._logger.error(self._message)
+            return False
+
+        # Return
+        return True
+
+    def _planTask(self):
+        """
+        Collects the files of the requested task (once) and adds them to the
+        totals of the progress.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
+        """
+
+        if self._planned:
+            return True
+
+        if not self._copyDataSetsForTask():
+            return False
+        self._planned = True
+
+        # The totals are known before the first byte is copied
+        numBytes = 0
+        for (source, dstDir) in self._plan:
+            numBytes += os.path.getsize(source)
+        self._progress.addToTotal(len(self._plan), numBytes)
+
+        return True
+
+    def _getArchiveCacheKey(self):
+        """
+        Return the key of the archive in the archive cache: it depends on the
+        exported datasets, the compression and the structure of the archive.
+        """
+
+        entryNames = [self._getArchiveEntryName(source, dstDir)
+                      for (source, dstDir) in self._plan]
+        return buildArchiveKey(self._dataSetCodes,
+                               {"compression": self._compression},
+                               entryNames)
+
+    def _copyFiles(self):
+        """
+        Copies the files of the export to the user folder. The files are
+        copied in parallel by the copy engine.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
+        """
+
+        self._logger.info("Starting copy...")
+
+        self._copyEngine = CopyEngine(
+            int(self._properties['copy_worker_threads']), self._logger,
+            self._incremental, self._progress)
+
+        try:
+
+            # Queue all files for copying
+            for (source, dstDir) in self._plan:
+                self._copyEngine.submit(source, dstDir)
+
+            # Wait for all queued files to be copied
+            errors = self._copyEngine.waitForCompletion()
+
+        finally:
+            self._copyEngine.shutdown()
+
+        # Keep track of the number of copied and skipped files
+        self._numCopiedFiles = self._copyEngine.getNumberOfCopiedFiles()
+        self._numSkippedFiles = self._copyEngine.getNumberOfSkippedFiles()
+        self._logger.info("Copied " + str(self._numCopiedFiles) + " files (" +
+                          str(self._copyEngine.getNumberOfCopiedBytes()) +
+                          " bytes); skipped " + str(self._numSkippedFiles) +
+                          " unchanged files.")
+
+        if len(errors) > 0 and not self._progress.isCancelled():
+            self._message = "Could not copy " + str(len(errors)) + \
+            " file(s): " + errors[0]
+            self._logger.error(self._message)
+            return False
+
+        if self._progress.isCancelled():
+            return True
+
+        # Write the manifest of the export
+        try:
+            self._writeManifest()
+        except Exception, e:
+            self._message = "Could not write the manifest: " + str(e)
+            self._logger.error(self._message)
+            return False
+
+        # Return success
+        return True
+
+    def _writeManifest(self):
+        """
+        Writes the manifest of the copied files to the experiment folder (or,
+        for the multi-experiment tasks, to the collection folder).
+
+        The checksums were computed by the copy engine while copying. For the
+        unchanged files that were skipped (incremental export), they are
+        taken from the previous manifest, or computed if it does not list
+        them.
+        """
+
+        if self._task in _MULTI_EXPERIMENT_TASKS:
+            folder = self._rootExportPath
+        else:
+            folder = self._experimentPath
+
+        checksums = self._copyEngine.getChecksums()
+        if self._incremental:
+            previousEntries = readManifest(folder)
+        else:
+            previousEntries = {}
+
+        entries = {}
+        for (source, dstDir) in self._plan:
+            dstFile = os.path.join(dstDir, os.path.basename(source))
+            path = dstFile[len(folder) + 1:].replace(os.sep, "/")
+            if dstFile in checksums:
+                entries[path] = checksums[dstFile]
+            elif path in previousEntries and \
+                    previousEntries[path][0] == os.path.getsize(dstFile):
+                entries[path] = previousEntries[path]
+            else:
+                entries[path] = computeChecksums(dstFile)
+
+        writeManifest(folder, entries)
+        self._logger.info("Wrote manifest of " + str(len(entries)) +
+                          " files to " + folder)
+
+    def _archiveFiles(self):
+        """
+        Streams the files of the export into the zip archive. The archive has
+        the same folder structure as the exported folder, but no copy of the
+        files is made. If requested, the files are compressed in parallel.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method. The incomplete archive is deleted.
+        """
+
+        self._logger.info("Starting archiving to " +
+                          self.getZipArchiveFullPath() + "...")
+
+        if self._compression == "deflate":
+            self._zipWriter = ZipWriter(
+                self.getZipArchiveFullPath(), METHOD_DEFLATED,
+                int(self._properties['compression_threads']),
+                int(self._properties['compression_level']))
+        else:
+            self._zipWriter = ZipWriter(self.getZipArchiveFullPath(),
+                                        METHOD_STORED)
+
+        try:
+            for (source, dstDir) in self._plan:
+                entryName = self._getArchiveEntryName(source, dstDir)
+                self._zipWriter.addFile(source, entryName, self._progress)
+                self._archiveFoldersWithFiles.add(
+                    entryName[:entryName.rfind("/")])
+                self._numCopiedFiles += 1
+                self._logger.info("Archived file " + source + " as " + entryName)
+            self._addArchiveManifest()
+            self._addArchivePlaceholders()
+            self._zipWriter.close()
+        except ExportCancelled:
+            self._zipWriter.abort()
+            return False
+        except Exception, e:
+            self._message = "Could not create the zip archive: " + str(e)
+            self._logger.error(self._message)
+            self._zipWriter.abort()
+            return False
+
+        self._logger.info("Archived " + str(self._numCopiedFiles) + " files.")
+
+        # Return success
+        return True
+
+    def _removePartialOutput(self):
+        """
+        Removes the output of a cancelled export from the user folder: the
+        folders that were created by the export are deleted. Partially copied
+        files are deleted by the copy engine, and the incomplete zip archive
+        by the archive writer.
+        """
+
+        if self._mode == "zip":
+            return
+
+        for folder in self._createdFolders:
+            self._logger.info("Removing folder " + folder)
+            shutil.rmtree(folder, True)
+
+    def _getArchiveEntryName(self, source, dstDir):
+        """
+        Returns the name of the archive entry of the source file that would
+        be copied to the (export) directory dstDir.
+        """
+
+        # The archive root is the collection folder
+        relativeDir = dstDir[len(self._rootExportPath):].replace(os.sep, "/")
+        return self._collectionName + relativeDir.rstrip("/") + "/" + \
+            os.path.basename(source)
+
+    def _addArchiveManifest(self):
+        """
+        Adds the manifest of the archived files to the root (collection)
+        folder of the archive. The checksums were computed by the archive
+        writer while archiving.
+        """
+
+        # Wait for the files that are still being compressed
+        self._zipWriter.flush()
+
+        prefix = self._collectionName + "/"
+        entries = {}
+        for (entryName, checksums) in self._zipWriter.getChecksums().items():
+            entries[entryName[len(prefix):]] = checksums
+
+        self._zipWriter.addText(prefix + MANIFEST_FILE_NAME,
+                                formatManifest(entries))
+        self._archiveFoldersWithFiles.add(self._collectionName)
+
+    def _addArchivePlaceholders(self):
+        """
+        Adds an empty file '~' to all folders of the archive that do not
+        contain any file: if a folder only contains a subfolder, we disrupt
+        the hierarchy, unless we add a file.
+        """
+
+        # Collect all folders (with their parents)
+        folders = set()
+        for folder in self._archiveFoldersWithFiles:
+            while folder != "":
+                folders.add(folder)
+                folder = folder[:max(0, folder.rfind("/"))]
+
+        for folder in sorted(folders - self._archiveFoldersWithFiles):
+            self._zipWriter.addEmptyFile(folder + "/~")
 
     def _copyDataSetsForExperiment(self):
         """
@@ -556,6 +997,34 @@ class Mover():
         # Return success
         return True
 
+    def _copyDataSetsForExperiments(self):
+        """
+        Copies all FCS files of the experiments of a multi-experiment task to
+        the user directory. Each experiment maps to its own folder in the
+        collection folder, with the same structure as if it was exported
+        alone; all files are copied by the same copy engine.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
+        """
+
+        for experimentSample in self._experimentSamples:
+
+            self._selectExperimentSample(experimentSample)
+
+            if not self._createRootAndExperimentFolder():
+                self._message = "Could not create experiment folder " + \
+                    self._experimentPath
+                self._logger.error(self._message)
+                return False
+
+            if not self._copyDataSetsForExperiment():
+                return False
+
+        # Return success
+        return True
+
     def _copyDataSetsForPlate(self, plate):
         """
         Copy all FCS files for given plate in the experiment to the user
@@ -574,15 +1043,20 @@ class Mover():
         if _DEBUG:
             self._logger.info("Processing plate with name " + plateName)
 
-        # Create a folder for the plate
+        # Create a folder for the plate (in "zip" mode, it only exists in
+        # the archive)
         self._currentPath = os.path.join(self._experimentPath, plateName)
-        self._createDir(self._currentPath)
+        if self._mode != "zip":
+            self._createDir(self._currentPath)
 
         if _DEBUG:
             self._logger.info("Plate with name " + plateName + " will be exported to " + self._currentPath)
 
-        # Get all datasets for the plate
-        dataSets = self._getDataSetsForPlate(plateCode)
+        # Get the datasets of all wells of the plate (with one search)
+        dataSets = self._getDataSetsForChildrenOf(
+            self._expSamplePrefix + "_WELL",
+            plate.getPermId(),
+            self._expSamplePrefix + "_PLATE")
         if len(dataSets) == 0:
             self._message = "Could not retrieve datasets for plate with code " + plateCode + "."
             self._logger.error(self._message)
@@ -649,19 +1123,18 @@ class Mover():
         # Reset the current target folder to the root of the experiment sample
         self._currentPath = self._experimentPath
 
-        # Now iterate over the tubes and retrieve their datasets
-        dataSets = []
-        for tube in tubes:
-            tubeId = tube.getCode()
-            dataSetsForSample = self._getDataSetForTube(tubeId)
-            dataSets.extend(dataSetsForSample)
+        # Get the datasets of all tubes (with one search)
+        dataSets = self._getDataSetsForChildrenOf(
+            self._expSamplePrefix + "_TUBE",
+            self._expSamplePermId,
+            self._expSampleType)
 
         if _DEBUG:
             self._logger.info("Found " + str(len(dataSets)) + " datasets")
 
         if len(dataSets) == 0:
             self._message = "Could not retrieve datasets for tubes in " \
-            "experiment with code " + self._experimentCode + "."
+            "experiment with code " + self._expSampleId + "."
             self._logger.error(self._message)
             return False
 
@@ -689,17 +1162,15 @@ class Mover():
         return True
 
     def _copyFile(self, source, dstDir):
-        """Copies the source file (with full path) to directory dstDir.
-        We use a trick to preserve the NFSv4 ACLs: since copying the file
-        loses them, we first touch the destination file to create it, and
-        then we overwrite it.
-        """
-        dstFile = os.path.join(dstDir, os.path.basename(source))
-        touch = "/usr/bin/touch" if OSUtilities.isMacOS() else "/bin/touch"
-        subprocess.call([touch, dstFile])
-        subprocess.call(["/bin/cp", source, dstDir])
-        self._logger.info("Copying file " + source + " to " + dstDir)
-        self._numCopiedFiles += 1
+        """Adds the source file (with full path) to the files to be copied to
+        directory dstDir. The files are copied by the copy engine once all of
+        them are known (see CopyEngine.copyFile() for the handling of the
+        NFSv4 ACLs).
+
+        In "zip" mode, the file is streamed into the archive instead, in the
+        folder that corresponds to dstDir.
+        """
+        self._plan.append((source, dstDir))
 
     def _createDir(self, dirFullPath):
         """Creates the passed directory (with full path).
@@ -722,19 +1193,24 @@ class Mover():
         Please notice that if the experiment folder already exists, _{digit}
         will be appended to the folder name, to ensure that the folder is
         unique. The updated folder name will be stored in the _rootExportPath
-        property.
+        property. In an incremental export, the existing folder is reused
+        instead.
         """
 
         # This should not happen
         if self._rootExportPath == "" or self._experimentPath == "":
             return False
 
+        # In "zip" mode, the folders only exist in the archive
+        if self._mode == "zip":
+            return True
+
         # Make sure that the experiment folder does not already exist
         expPath = self._experimentPath
 
         # Does the folder already exist? It if does, append an increasing
-        # numeric index.
-        if os.path.exists(expPath):
+        # numeric index (unless we want to update it).
+        if os.path.exists(expPath) and not self._incremental:
             counter = 1
             ok = False
             while not ok:
@@ -748,6 +1224,15 @@ class Mover():
         # Update the root and experiment paths
         self._experimentPath = os.path.join(self._rootExportPath, expPath)
 
+        # Keep track of the topmost folder that we create
+        createdFolder = ""
+        path = self._experimentPath
+        while path.startswith(self._rootExportPath) and not os.path.isdir(path):
+            createdFolder = path
+            path = os.path.dirname(path)
+        if createdFolder != "":
+            self._createdFolders.append(createdFolder)
+
         # Create the root folder
         self._createDir(self._rootExportPath)
 
@@ -760,128 +1245,83 @@ class Mover():
         # Return success
         return True
 
-    def _getDataSetsForPlate(self, platePermId):
-        """
-        Return a list of datasets belonging to the plate with specified ID.
-        If none are found, return [].
+    def _getDataSetsForChildrenOf(self, sampleType, parentSamplePermId, parentSampleType):
         """
-
-        # Get the wells
-        wells = self._retrieveAllSamplesWithTypeAndParent(
-            self._expSamplePrefix + "_WELL",
-            platePermId,
-            self._expSamplePrefix + "_PLATE")
-
-        if len(wells) == 0:
-            self._message = "Could not retrieve wells for plate with " \
-            "code " + plateCode + "."
-            self._logger.error(self._message)
-            return wells
-
-        # Now iterate over the samples and retrieve their datasets
-        dataSets = []
-        for well in wells:
-            wellCode = well.getCode()
-            dataSetsForWell = self._getDataSetForWell(wellCode)
-            dataSets.extend(dataSetsForWell)
-
-        if len(dataSets) == 0:
-            self._message = "Could not retrieve datasets for wells in " \
-            "plate with code " + plateCode + " from experiment " \
-            "with code " + self._experimentCode + "."
-            self._logger.error(self._message)
-
-        # Return
-        return dataSets
-
-    def _getDataSetForWell(self, wellId=None):
+        Return the datasets of all samples of given type that are children
+        of the sample with given perm id and type. The datasets are retrieved
+        with one search, independent of the number of samples. If none are
+        found, returns [].
         """
-        Get the datasets belonging to the well with specified code. If none
-        are found, return [].
 
-        If no wellId is given, it is assumed that the well is the passed
-        entity with code self._entityId.
-        """
+        if _DEBUG:
+            self._logger.info("Retrieving datasets of samples of type " +
+                              sampleType + " with parent sample with perm id " +
+                              parentSamplePermId + " and type " + parentSampleType)
 
-        if wellId is None:
-            wellId = self._entityId
+        # The datasets belong to samples of type 'sampleType'...
+        sampleCriteria = SearchCriteria()
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                sampleType)
+            )
 
-        # Set search criteria to retrieve the dataset contained in the well
-        searchCriteria = SearchCriteria()
-        wellCriteria = SearchCriteria()
-        wellCriteria.addMatchClause(
+        # ...that have given parent
+        parentCriteria = SearchCriteria()
+        parentCriteria.addMatchClause(
             MatchClause.createAttributeMatch(
-                MatchClauseAttribute.CODE,
-                wellId)
+                MatchClauseAttribute.TYPE,
+                parentSampleType)
             )
-        searchCriteria.addSubCriteria(
-            SearchSubCriteria.createSampleCriteria(
-                wellCriteria)
+        parentCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.PERM_ID,
+                parentSamplePermId)
+            )
+        sampleCriteria.addSubCriteria(
+            SearchSubCriteria.createSampleParentCriteria(parentCriteria)
         )
-        dataSets = searchService.searchForDataSets(searchCriteria)
-
-        if len(dataSets) == 0:
-            self._message = "Could not retrieve datasets for well " \
-            "with code " + wellId + "."
-            self._logger.error(self._message)
-
-        # Return
-        return dataSets
-
-    def _getDataSetForTube(self, tubeCode):
-        """
-        Get the datasets belonging to the tube with specified tube code.
-        If none is found, return [].
-        """
-
-        if _DEBUG:
-            self._logger.info("Searching for tube with code " + tubeCode)
 
-        # Set search criteria to retrieve the dataset contained in the tube
         searchCriteria = SearchCriteria()
-        tubeCriteria = SearchCriteria()
-        tubeCriteria.addMatchClause(
-            MatchClause.createAttributeMatch(
-                MatchClauseAttribute.CODE,
-                tubeCode))
         searchCriteria.addSubCriteria(
-            SearchSubCriteria.createSampleCriteria(
-                tubeCriteria)
-            )
+            SearchSubCriteria.createSampleCriteria(sampleCriteria)
+        )
+
+        # Now search
         dataSets = searchService.searchForDataSets(searchCriteria)
 
         if _DEBUG:
-            self._logger.info("Retrieved " + str(len(dataSets)) + \
-                              " datasets for tube with code " + tubeCode)
-
-        if len(dataSets) == 0:
-            self._message = "Could not retrieve datasets for tube " \
-            "with code " + tubeCode + "."
-            self._logger.error(self._message)
+            self._logger.info("Retrieved " + str(len(dataSets)) + " datasets.")
 
-        # Return
+        # Return the datasets
         return dataSets
 
     def _getFilesForDataSets(self, dataSets):
         """
         Get the list of FCS file paths that correspond to the input list
         of datasets. If not files are found, returns [].
+
+        The content provider can only look up one dataset at a time: the
+        lookups run in parallel on copy_worker_threads threads.
         """
 
         if len(dataSets) == 0:
             return []
 
-        dataSetFiles = []
         for dataSet in dataSets:
-            content = contentProvider.getContent(dataSet.getDataSetCode())
-            nodes = content.listMatchingNodes("original", ".*\.fcs")
-            if nodes is not None:
-                for node in nodes:
-                    fileName = node.tryGetFile()
-                    if fileName is not None:
-                        fileName = str(fileName)
-                        if fileName.lower().endswith(".fcs"):
-                            dataSetFiles.append(fileName)
+            self._dataSetCodes.add(dataSet.getDataSetCode())
+
+        numThreads = max(1, min(int(self._properties['copy_worker_threads']),
+                                len(dataSets)))
+        executor = Executors.newFixedThreadPool(numThreads)
+        try:
+            futures = [executor.submit(DataSetFilesTask(dataSet.getDataSetCode()))
+                       for dataSet in dataSets]
+            dataSetFiles = []
+            for future in futures:
+                dataSetFiles.extend(future.get())
+        finally:
+            executor.shutdownNow()
 
         if len(dataSetFiles) == 0:
             self._message = "Could not retrieve dataset files!"
@@ -950,6 +1390,14 @@ def parsePropertiesFile():
     filename = "../core-plugins/flow/4/dss/reporting-plugins/export_flow_datasets/plugin.properties"
     var_names = ['base_dir', 'export_dir']
 
+    # Optional settings with their default values
+    optional_vars = {'result_store_dir': '', 'result_store_max_age_h': '24',
+                     'copy_worker_threads': '4', 'compression_threads': '4',
+                     'compression_level': '1', 'max_concurrent_exports': '4',
+                     'max_concurrent_exports_per_user': '2',
+                     'max_export_bytes_per_s': '0', 'archive_cache_dir': '',
+                     'archive_cache_max_size_gb': '50'}
+
     properties = {}
     try:
         fp = open(filename, "r")
@@ -961,7 +1409,7 @@ def parsePropertiesFile():
             line = re.sub('[ \'\"\n]', '', line)
             parts = line.split("=")
             if len(parts) == 2:
-                if parts[0] in var_names:
+                if parts[0] in var_names or parts[0] in optional_vars:
                     properties[parts[0]] = parts[1]
     finally:
         fp.close()
@@ -977,28 +1425,176 @@ def parsePropertiesFile():
             return None
 
     # Make sure that there are no Windows line endings
-    for var_name in var_names:
+    for var_name in properties.keys():
         properties[var_name] = properties[var_name].replace('\r', '')
 
+    # Fill in the optional settings that were not found
+    for var_name in optional_vars.keys():
+        if var_name not in properties or properties[var_name] == "":
+            properties[var_name] = optional_vars[var_name]
+
     # Everything found
     return properties
 
 
+def getResultStore(properties):
+    """
+    Return the store that persists the job results to disk. The store is
+    created once for the DSS (see SharedState.py) and shared by all jobs.
+    """
+
+    if properties is None or 'result_store_dir' not in properties:
+        storeDir = ""
+        maxAgeHours = 0
+    else:
+        storeDir = properties['result_store_dir']
+        maxAgeHours = int(properties['result_store_max_age_h'])
+
+    return getSharedObject(
+        _RESULT_STORE_NAME + "|" + storeDir + "|" + str(maxAgeHours),
+        lambda: ResultStore(storeDir, maxAgeHours))
+
+
+def storeResults(uid, resultToStore, properties):
+    """
+    Store the results of the job with given uid in the LRCache and, if it is
+    enabled, in the result store.
+    """
+
+    LRCache.set(uid, resultToStore)
+    getResultStore(properties).save(uid, resultToStore)
+
+
+def getScheduler(properties):
+    """
+    Return the scheduler shared by all export jobs of the DSS, with the limits
+    from the plug-in properties. The scheduler is created once for the DSS
+    (see SharedState.py): it is kept as long as the jobs access the shared
+    objects, which they do every _PROGRESS_INTERVAL_S seconds while they are
+    queued or running (see waitForTurn() and publishProgress()).
+    """
+
+    scheduler = getSharedObject(_SCHEDULER_NAME,
+                                lambda: ExportScheduler(1, 1))
+    scheduler.setLimits(int(properties['max_concurrent_exports']),
+                        int(properties['max_concurrent_exports_per_user']),
+                        int(properties['max_export_bytes_per_s']))
+    return scheduler
+
+
+def waitForTurn(uid, resultToStore, properties, scheduler, logger):
+    """
+    Wait in the queue of the scheduler until the job with given uid may run,
+    and publish its position in the queue. Returns False if the job was
+    cancelled while it was queued.
+    """
+
+    while not scheduler.waitForTurn(uid, _PROGRESS_INTERVAL_S):
+
+        if isCancelRequested(uid, properties):
+            logger.info("Export " + uid + " cancelled while queued.")
+            return False
+
+        # Keep the shared objects (and thus the scheduler)
+        getScheduler(properties)
+
+        position = scheduler.getQueuePosition(uid)
+        if position != resultToStore["queuePosition"]:
+            resultToStore["queuePosition"] = position
+            resultToStore["message"] = "The server is busy: your export " + \
+                "is queued (position " + str(position) + ") and will " + \
+                "start as soon as possible."
+            storeResults(uid, resultToStore, properties)
+
+    resultToStore["queuePosition"] = 0
+    resultToStore["message"] = ""
+    storeResults(uid, resultToStore, properties)
+    return True
+
+
+def requestCancel(uid):
+    """
+    Request the cancellation of the job with given uid. The request is also
+    stored in the result store (if enabled), so that it reaches the job if it
+    runs on another DSS node.
+    """
+
+    LRCache.set(_CANCEL_KEY_PREFIX + uid, True)
+    getResultStore(parsePropertiesFile()).save(_CANCEL_KEY_PREFIX + uid,
+                                               {"cancel": True})
+
+
+def isCancelRequested(uid, properties):
+    """
+    Return True if the cancellation of the job with given uid was requested.
+    """
+
+    if LRCache.get(_CANCEL_KEY_PREFIX + uid) is not None:
+        return True
+    return getResultStore(properties).load(_CANCEL_KEY_PREFIX + uid) is not None
+
+
+def publishProgress(uid, resultToStore, properties, mover, done):
+    """
+    Publish the progress of the export in the job results every
+    _PROGRESS_INTERVAL_S seconds until done is set, and forward cancellation
+    requests to the mover.
+    """
+
+    while not done.isSet():
+        done.wait(_PROGRESS_INTERVAL_S)
+        if done.isSet():
+            break
+
+        if not mover.isCancelled() and isCancelRequested(uid, properties):
+            mover.cancel()
+
+        # Keep the shared objects (and thus the scheduler of the running job)
+        getScheduler(properties)
+
+        resultToStore.update(mover.getProgress().getStatus())
+        if mover.isCancelled():
+            resultToStore["message"] = "Cancelling..."
+        else:
+            resultToStore["message"] = mover.getProgress().getMessage()
+        storeResults(uid, resultToStore, properties)
+
+
 # Plug-in entry point
 #
 # Input parameters:
 #
 # uid           : job unique identifier (see below)
+# task          : what to export: one of 'EXPERIMENT_SAMPLE', 'ALL_PLATES',
+#                 'TUBESET', 'PLATE' (within one experiment sample), or
+#                 'COLLECTION' (all experiment samples of the collection) and
+#                 'EXPERIMENTS' (the experiment samples whose permIds are
+#                 listed, comma-separated, in expSamplePermId).
 # experimentId  : experiment identifier
 # experimentSampleType: experiment type
 # entityType    : entity type
 # entityId      : entity ID
 # mode          : requested mode of operation: one of 'normal', 'zip'.
+# incremental   : (optional) "true" to update an existing export in the user
+#                 folder: only new or changed files are copied.
+# compression   : (optional) "deflate" to compress the files in the zip
+#                 archive (default "none": the files are stored).
+# cancel        : (optional, with uid) "true" to cancel the running job. The
+#                 files are no longer copied and the partial output is removed.
+#
+# The export contains a manifest (MANIFEST.tsv) with the path, size, CRC-32
+# and SHA-256 digest of each exported file: in the experiment folder (in the
+# collection folder for 'COLLECTION' and 'EXPERIMENTS'), or at the root of the
+# zip archive.
 #
 # This method returns a table to the client with a different set of columns
 # depending on whether the plug-in is called for the first time and the process
 # is just started, or if it is queried for completeness at a later time.
 #
+# If a result store is configured in plugin.properties, the results are also
+# persisted to disk: they survive a restart of the DSS and can be queried from
+# any DSS node.
+#
 # At the end of the first call, a table with following columns is returned:
 #
 # uid      : unique identifier of the running plug-in
@@ -1020,6 +1616,19 @@ def parsePropertiesFile():
 #            export folder.
 # zipArchiveFileName: file name of the zip in case compression was requested.
 # mode     : requested mode of operation.
+# nSkippedFiles: number of unchanged files that were not copied again
+#            (incremental export only).
+# nFilesDone, nFilesTotal: number of processed files and total number of
+#            files to export.
+# nBytesDone, nBytesTotal: number of processed bytes and total number of
+#            bytes to export.
+# throughput: copy rate in bytes per second.
+# eta      : estimated remaining time in seconds (-1 if not known yet).
+# cancelled: True if the job was cancelled.
+# queuePosition: position of the job in the export queue (0 if the job is
+#            not waiting for other exports to finish).
+#
+# While the job is running, message describes its progress.
 def aggregate(parameters, tableBuilder):
 
     # Get the ID of the call if it already exists
@@ -1030,6 +1639,9 @@ def aggregate(parameters, tableBuilder):
         # Create a unique id
         uid = str(uuid.uuid4())
 
+        # Delete expired results from the result store
+        getResultStore(parsePropertiesFile()).purgeExpired()
+
         # Add the table headers
         tableBuilder.addHeader("uid")
         tableBuilder.addHeader("completed")
@@ -1047,9 +1659,15 @@ def aggregate(parameters, tableBuilder):
         # Return immediately
         return
 
-    # The process is already running in a separate thread. We get current
-    # results and return them
+    # Cancel the export if requested
+    if str(parameters.get("cancel")).lower() == "true":
+        requestCancel(uid)
+
+    # The process is already running in a separate thread (possibly on
+    # another DSS node). We get current results and return them
     resultToSend = LRCache.get(uid);
+    if resultToSend is None:
+        resultToSend = getResultStore(parsePropertiesFile()).load(uid)
     if resultToSend is None:
         # This should not happen
         raise Exception("Could not retrieve results from result cache!")
@@ -1063,6 +1681,9 @@ def aggregate(parameters, tableBuilder):
     tableBuilder.addHeader("relativeExpFolder")
     tableBuilder.addHeader("zipArchiveFileName")
     tableBuilder.addHeader("mode")
+    tableBuilder.addHeader("nSkippedFiles")
+    for (column, default) in _PROGRESS_COLUMNS:
+        tableBuilder.addHeader(column)
 
     # Store current results in the table
     row = tableBuilder.addRow()
@@ -1074,6 +1695,9 @@ def aggregate(parameters, tableBuilder):
     row.setCell("relativeExpFolder", resultToSend["relativeExpFolder"])
     row.setCell("zipArchiveFileName", resultToSend["zipArchiveFileName"])
     row.setCell("mode", resultToSend["mode"])
+    row.setCell("nSkippedFiles", resultToSend.get("nSkippedFiles", 0))
+    for (column, default) in _PROGRESS_COLUMNS:
+        row.setCell(column, resultToSend.get(column, default))
 
 
 # Actual work process
@@ -1091,6 +1715,9 @@ def aggregateProcess(parameters, tableBuilder, uid):
     resultToStore["relativeExpFolder"] = ""
     resultToStore["zipArchiveFileName"] = ""
     resultToStore["mode"] = ""
+    resultToStore["nSkippedFiles"] = 0
+    for (column, default) in _PROGRESS_COLUMNS:
+        resultToStore[column] = default
     LRCache.set(uid, resultToStore)
 
     # Get path to containing folder
@@ -1124,6 +1751,9 @@ def aggregateProcess(parameters, tableBuilder, uid):
         logger.error(msg)
         raise Exception(msg)
 
+    # Store the initial results to disk as well
+    storeResults(uid, resultToStore, properties)
+
     # Dump the properties dictionary to log
     logger.info(str(parameters))
 
@@ -1154,6 +1784,14 @@ def aggregateProcess(parameters, tableBuilder, uid):
     # Get the mode
     mode = parameters.get("mode")
 
+    # Update an existing export?
+    incremental = str(parameters.get("incremental")).lower() == "true"
+
+    # Get the compression of the archive
+    compression = parameters.get("compression")
+    if compression is None or compression == "":
+        compression = "none"
+
     # Info
     logger.info("Aggregation plug-in called with following parameters:")
     logger.info("task            = " + task)
@@ -1165,37 +1803,85 @@ def aggregateProcess(parameters, tableBuilder, uid):
     logger.info("platePermId     = " + platePermId)
     logger.info("plateType       = " + plateType)
     logger.info("mode            = " + mode)
+    logger.info("incremental     = " + str(incremental))
+    logger.info("compression     = " + compression)
     logger.info("userId          = " + userId)
     logger.info("Aggregation plugin properties:")
     logger.info("properties      = " + str(properties))
 
+    # Consistency check: compression must be one of a known set
+    if compression != "none" and compression != "deflate":
+        msg = "The requested compression " + compression + " is not known!"
+        logger.error(msg)
+        raise Exception(msg)
+
     # Consistency check: task must be one of a known set
     if task != "EXPERIMENT_SAMPLE" and \
         task != "ALL_PLATES" and \
         task != "PLATE" and \
-        task != "TUBESET":
+        task != "TUBESET" and \
+        task not in _MULTI_EXPERIMENT_TASKS:
         msg = "The requested task " + task + " is not known!"
         logger.error(msg)
         raise Exception(msg)
 
     logger.info("Requested task: " + task)
 
+    # The scheduler limits the number of concurrent exports and their
+    # bandwidth
+    scheduler = getScheduler(properties)
+
     # Instantiate the Mover object - userId is a global variable
     # made available to the aggregation plug-in
-    mover = Mover(task, collectionId, collectionType, expSampleId, expSamplePermId,
-                  expSampleType, platePermId, plateType, mode, userId, properties, logger)
+    try:
+        mover = Mover(task, collectionId, collectionType, expSampleId, expSamplePermId,
+                      expSampleType, platePermId, plateType, mode, userId, properties, logger,
+                      incremental, compression, scheduler.getThrottle())
+    except Exception, e:
+
+        # The export cannot start (e.g. a requested sample was not found)
+        logger.error(str(e))
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = str(e)
+        storeResults(uid, resultToStore, properties)
+        return
 
-    # Process
-    success = mover.process()
-    logger.info("Process ended successfully.")
+    # Wait until the scheduler lets the export run (the export can be
+    # cancelled while it is queued). Archives that are already in the cache
+    # are served immediately.
+    scheduler.enqueue(uid, userId)
+    try:
+        if mover.serveArchiveFromCache():
+            success = True
+        elif not waitForTurn(uid, resultToStore, properties, scheduler, logger):
+            mover.cancel()
+            success = False
+        else:
 
-    # Compress
-    if mode == "zip":
-        mover.compressIfNeeded()
+            # Process (in "zip" mode, this also writes the archive). The
+            # progress is published while the files are copied.
+            done = Event()
+            publisher = Thread(target=publishProgress,
+                               args=(uid, resultToStore, properties, mover,
+                                     done))
+            publisher.start()
+            try:
+                success = mover.process()
+            finally:
+                done.set()
+                publisher.join()
+    finally:
+        scheduler.release(uid)
+
+    logger.info("Process ended successfully.")
 
     # Get some results info
     nCopiedFiles = mover.getNumberOfCopiedFiles()
+    nSkippedFiles = mover.getNumberOfSkippedFiles()
     errorMessage = mover.getErrorMessage()
+    if mover.isCancelled():
+        errorMessage = "The export was cancelled."
     relativeExpFolder = mover.getRelativeRootExperimentPath()
     zipFileName = mover.getZipArchiveFileName()
 
@@ -1208,7 +1894,14 @@ def aggregateProcess(parameters, tableBuilder, uid):
     resultToStore["relativeExpFolder"] = relativeExpFolder
     resultToStore["zipArchiveFileName"] = zipFileName
     resultToStore["mode"] = mode
-    LRCache.set(uid, resultToStore)
+    resultToStore["nSkippedFiles"] = nSkippedFiles
+    resultToStore.update(mover.getProgress().getStatus())
+    resultToStore["cancelled"] = mover.isCancelled()
+    storeResults(uid, resultToStore, properties)
+
+    # The user who cancelled the export does not need an email
+    if mover.isCancelled():
+        return
 
     # Email result to the user
     if success == True:
@@ -1222,6 +1915,10 @@ def aggregateProcess(parameters, tableBuilder, uid):
 
         if mode == "normal":
             body = snip + "successfully exported to {...}/" + relativeExpFolder + "."
+            if nSkippedFiles > 0:
+                body += "\n\n" + str(nSkippedFiles) + " unchanged " + \
+                    ("file was" if nSkippedFiles == 1 else "files were") + \
+                    " already there and not copied again."
         else:
             body = snip + "successfully packaged for download: " + zipFileName
 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compensation of the FCS events with the spillover matrix stored in the
+keywords of the file ($SPILLOVER, SPILL, ...). The inverted matrix is
+computed once per dataset and cached in the LRCache.
+'''
+
+import jarray
+from ch.ethz.scu.obit.common.server.longrunning import LRCache
+
+# Prefix of the LRCache keys of the cached (inverted) spillover matrices
+_COMPENSATION_KEY_PREFIX = "retrieve_fcs_events_compensation_"
+
+# Keywords that can store the spillover matrix (in order of preference)
+_SPILLOVER_KEYWORDS = ["$SPILLOVER", "SPILL", "$SPILL", "SPILLOVER"]
+
+# Coefficients of the inverted matrix smaller than this are ignored
+_EPSILON = 1e-12
+
+
+def parseSpillover(value):
+    """Parse the value of a spillover keyword.
+
+    The value has the form "n,P1,...,Pn,s11,s12,...,snn" where P1...Pn are
+    the names of the compensated parameters and s11...snn is the spillover
+    matrix in row-major order.
+
+    @param value Keyword value.
+    @return tuple (names, matrix) or None if the value is not valid.
+    """
+
+    parts = [p.strip() for p in value.split(",")]
+    try:
+        n = int(parts[0])
+        if n < 1 or len(parts) != 1 + n + n * n:
+            return None
+        names = parts[1:n + 1]
+        values = [float(v) for v in parts[n + 1:]]
+    except ValueError:
+        return None
+
+    matrix = [values[i * n:(i + 1) * n] for i in range(n)]
+    return (names, matrix)
+
+
+def invert(matrix):
+    """Invert a square matrix by Gauss-Jordan elimination with partial
+    pivoting.
+
+    @param matrix List of rows.
+    @return inverted matrix (list of rows) or None if it is singular.
+    """
+
+    n = len(matrix)
+    a = [list(row) + [1.0 if i == j else 0.0 for j in range(n)]
+         for i, row in enumerate(matrix)]
+
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < _EPSILON:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        p = a[col][col]
+        a[col] = [v / p for v in a[col]]
+        for r in range(n):
+            if r != col and a[r][col] != 0.0:
+                factor = a[r][col]
+                a[r] = [v - factor * w for v, w in zip(a[r], a[col])]
+
+    return [row[n:] for row in a]
+
+
+class Compensation:
+    """The Compensation class computes compensated columns of events from the
+    inverted spillover matrix of a dataset.
+
+    Since the observed events are the true events multiplied by the spillover
+    matrix S, the compensated value of parameter j is the product of the
+    observed events with column j of S^-1. Only the requested columns are
+    computed, and only from the parameters with a non-zero coefficient.
+    """
+
+    def __init__(self, names, inverse):
+        """Constructor
+
+        @param names Names of the compensated parameters.
+        @param inverse Inverted spillover matrix (list of rows).
+        """
+        self._names = names
+        self._inverse = inverse
+
+    def isCompensated(self, name):
+        """Return True if the parameter with given name is compensated."""
+        return name in self._names
+
+    def getColumn(self, reader, channelIndex, numEvents, sample):
+        """Return the (compensated) events of a parameter. This has the same
+        signature as FCSReader.getDataPerColumnIndex(); the events of
+        parameters that are not in the spillover matrix are returned as is.
+
+        @param reader FCSReader with the data loaded.
+        @param channelIndex 0-based index of the parameter.
+        @param numEvents Number of events to return.
+        @param sample True to sample the events regularly from the whole file,
+               False to return the first numEvents events.
+        @return Java double[] array.
+        """
+
+        parameterNames = reader.getParameterNames()
+        name = parameterNames.get(channelIndex)
+        if not self.isCompensated(name):
+            return reader.getDataPerColumnIndex(channelIndex, numEvents, sample)
+
+        j = self._names.index(name)
+        out = jarray.zeros(numEvents, 'd')
+        for k in range(len(self._names)):
+            weight = self._inverse[k][j]
+            if abs(weight) < _EPSILON:
+                continue
+            indx = int(parameterNames.indexOf(self._names[k]))
+            if indx == -1:
+                continue
+            column = reader.getDataPerColumnIndex(indx, numEvents, sample)
+            for i in xrange(numEvents):
+                out[i] += weight * column[i]
+
+        return out
+
+
+def getCompensation(reader, code):
+    """Return the Compensation for a dataset, or None if the FCS file does not
+    contain a (valid) spillover matrix. The inverted matrix is cached in the
+    LRCache per dataset.
+
+    @param reader FCSReader of the dataset.
+    @param code Code of the dataset.
+    @return Compensation object or None.
+    """
+
+    key = _COMPENSATION_KEY_PREFIX + code
+    cached = LRCache.get(key)
+    if cached is None:
+
+        cached = ""
+        keywords = reader.getAllKeywords()
+        for keyword in _SPILLOVER_KEYWORDS:
+            value = keywords.get(keyword)
+            if value is None:
+                continue
+            spillover = parseSpillover(value)
+            if spillover is None:
+                continue
+            inverse = invert(spillover[1])
+            if inverse is not None:
+                cached = [spillover[0], inverse]
+                break
+
+        # An empty string records that the dataset cannot be compensated
+        LRCache.set(key, cached)
+
+    if cached == "":
+        return None
+
+    return Compensation(list(cached[0]), [list(row) for row in cached[1]])
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+'''
+Gates of the FCS event retrieval (rectangle, polygon and ellipse) and their
+evaluation into per-event membership masks (java.util.BitSet).
+
+Gates can be nested: a population is the intersection of its gate with the
+population of its parent. The masks are kept in a bounded cache shared by
+all jobs of the DSS.
+'''
+
+import math
+import json
+import hashlib
+import threading
+from java.util import BitSet
+from java.util import LinkedHashMap
+from SharedState import getSharedObject
+
+# Supported gate types
+GATE_TYPES = ["rectangle", "polygon", "ellipse"]
+
+# Name of the (bounded) cache of gate membership masks shared by all jobs
+# (see SharedState.py)
+_MASK_CACHE_NAME = "retrieve_fcs_events.gateMasks"
+
+
+class RectangleGate:
+    """Axis-aligned rectangle gate.
+
+    JSON definition: {"name": ..., "type": "rectangle",
+                      "xMin": ..., "xMax": ..., "yMin": ..., "yMax": ...}
+    """
+
+    def __init__(self, definition):
+        """Constructor
+
+        @param definition Dictionary with the gate definition.
+        """
+        self.xMin = float(definition["xMin"])
+        self.xMax = float(definition["xMax"])
+        self.yMin = float(definition["yMin"])
+        self.yMax = float(definition["yMax"])
+        if self.xMin > self.xMax or self.yMin > self.yMax:
+            raise ValueError("invalid rectangle bounds")
+
+    def getBounds(self):
+        """Return the bounding box (xMin, xMax, yMin, yMax) of the gate."""
+        return (self.xMin, self.xMax, self.yMin, self.yMax)
+
+    def contains(self, x, y):
+        """Return True if the point (x, y) is inside the bounding box (that
+        has already been checked by the caller)."""
+        return True
+
+
+class PolygonGate:
+    """Polygon gate (even-odd rule).
+
+    JSON definition: {"name": ..., "type": "polygon",
+                      "vertices": [[x1, y1], [x2, y2], ...]}
+    """
+
+    def __init__(self, definition):
+        """Constructor
+
+        @param definition Dictionary with the gate definition.
+        """
+        vertices = definition["vertices"]
+        if len(vertices) < 3:
+            raise ValueError("a polygon needs at least three vertices")
+        self._xs = [float(v[0]) for v in vertices]
+        self._ys = [float(v[1]) for v in vertices]
+
+        # Precompute the edges (x1, y1, x2, y2) for the crossing test
+        n = len(self._xs)
+        self._edges = [(self._xs[i], self._ys[i],
+                        self._xs[(i + 1) % n], self._ys[(i + 1) % n])
+                       for i in range(n)]
+
+    def getBounds(self):
+        """Return the bounding box (xMin, xMax, yMin, yMax) of the gate."""
+        return (min(self._xs), max(self._xs), min(self._ys), max(self._ys))
+
+    def contains(self, x, y):
+        """Return True if the point (x, y) is inside the polygon."""
+        inside = False
+        for (x1, y1, x2, y2) in self._edges:
+            if (y1 > y) != (y2 > y) and \
+                x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+
+class EllipseGate:
+    """Ellipse gate, optionally rotated.
+
+    JSON definition: {"name": ..., "type": "ellipse",
+                      "center": [cx, cy], "radii": [rx, ry],
+                      "angle": <rotation in radians, default 0>}
+    """
+
+    def __init__(self, definition):
+        """Constructor
+
+        @param definition Dictionary with the gate definition.
+        """
+        (self._cx, self._cy) = [float(c) for c in definition["center"]]
+        (rx, ry) = [float(r) for r in definition["radii"]]
+        if rx <= 0.0 or ry <= 0.0:
+            raise ValueError("the radii of an ellipse must be positive")
+        angle = float(definition.get("angle", 0.0))
+        self._cos = math.cos(angle)
+        self._sin = math.sin(angle)
+        self._irx2 = 1.0 / (rx * rx)
+        self._iry2 = 1.0 / (ry * ry)
+
+        # Half-extents of the bounding box of the rotated ellipse
+        self._dx = math.sqrt((rx * self._cos) ** 2 + (ry * self._sin) ** 2)
+        self._dy = math.sqrt((rx * self._sin) ** 2 + (ry * self._cos) ** 2)
+
+    def getBounds(self):
+        """Return the bounding box (xMin, xMax, yMin, yMax) of the gate."""
+        return (self._cx - self._dx, self._cx + self._dx,
+                self._cy - self._dy, self._cy + self._dy)
+
+    def contains(self, x, y):
+        """Return True if the point (x, y) is inside the ellipse."""
+        dx = x - self._cx
+        dy = y - self._cy
+        u = dx * self._cos + dy * self._sin
+        v = -dx * self._sin + dy * self._cos
+        return u * u * self._irx2 + v * v * self._iry2 <= 1.0
+
+
+# Map gate types to the gate classes
+_GATES = {
+    "rectangle": RectangleGate,
+    "polygon": PolygonGate,
+    "ellipse": EllipseGate
+}
+
+
+def parseGates(gatesJSON, paramX, paramY, displayX, displayY):
+    """Parse the JSON-encoded list of gate definitions.
+
+    Besides the geometry, each definition can set:
+
+        "parent": name of the parent gate: the gate is only evaluated on the
+                  events inside the parent (default: none, i.e. all events);
+        "paramX", "paramY", "displayX", "displayY": the parameters and display
+                  transforms of the gate (default: those of the request).
+
+    Each gate is given a key that identifies its population: it is computed
+    from its definition and the key of its parent (but not from the names of
+    the gates), so that the same population defined in different requests
+    has the same key.
+
+    @param gatesJSON JSON string with a list of gate definitions.
+    @param paramX Default name of the parameter for the X axis.
+    @param paramY Default name of the parameter for the Y axis.
+    @param displayX Default display transform of the X axis.
+    @param displayY Default display transform of the Y axis.
+    @return list of gate nodes (dictionaries with keys name, type, gate,
+            parent, paramX, paramY, displayX, displayY and key), ordered so
+            that parents come before their children.
+    @throws ValueError if the definitions are not valid.
+    """
+
+    try:
+        definitions = json.loads(gatesJSON)
+    except (TypeError, ValueError):
+        raise ValueError("The gates could not be decoded.")
+
+    if not isinstance(definitions, list) or len(definitions) == 0:
+        raise ValueError("No gates were defined.")
+
+    nodes = []
+    names = set()
+    for i in range(len(definitions)):
+        if not isinstance(definitions[i], dict):
+            raise ValueError("Gate " + str(i + 1) + " is not valid.")
+        definition = dict(definitions[i])
+        name = definition.pop("name", "Gate " + str(i + 1))
+        if name in names:
+            raise ValueError("Gate '" + name + "' is defined more than once.")
+        names.add(name)
+        gateType = definition.get("type", "")
+        if gateType not in _GATES:
+            raise ValueError("Gate '" + name + "' has unsupported type '" +
+                             gateType + "'.")
+        try:
+            gate = _GATES[gateType](definition)
+        except (KeyError, TypeError, ValueError), e:
+            raise ValueError("Gate '" + name + "' is not valid: " + str(e))
+        node = {"name": name, "type": gateType, "gate": gate,
+                "parent": definition.pop("parent", None)}
+        for (key, default) in [("paramX", paramX), ("paramY", paramY),
+                               ("displayX", displayX),
+                               ("displayY", displayY)]:
+            definition[key] = definition.get(key, default)
+            node[key] = definition[key]
+        node["definition"] = json.dumps(definition, sort_keys=True)
+        nodes.append(node)
+
+    # Sort the gates so that parents come before their children, and
+    # compute the population keys along the way
+    ordered = []
+    keys = {}
+    pending = nodes
+    while len(pending) > 0:
+        remaining = []
+        for node in pending:
+            parent = node["parent"]
+            if parent is not None and parent not in names:
+                raise ValueError("Gate '" + node["name"] +
+                                 "' has unknown parent '" + parent + "'.")
+            if parent is None or parent in keys:
+                parentKey = ""
+                if parent is not None:
+                    parentKey = keys[parent]
+                node["key"] = hashlib.sha1((parentKey + "|" +
+                    node.pop("definition")).encode("utf-8")).hexdigest()
+                keys[node["name"]] = node["key"]
+                ordered.append(node)
+            else:
+                remaining.append(node)
+        if len(remaining) == len(pending):
+            raise ValueError("The gate hierarchy contains a cycle.")
+        pending = remaining
+
+    return ordered
+
+
+def getGatedParameters(nodes):
+    """Return the (sorted) list of the (parameter, display) pairs used by the
+    gates.
+
+    @param nodes List of gate nodes as returned by parseGates().
+    @return list of (parameter name, display transform) tuples.
+    """
+
+    pairs = set()
+    for node in nodes:
+        pairs.add((node["paramX"], node["displayX"]))
+        pairs.add((node["paramY"], node["displayY"]))
+    return sorted(pairs)
+
+
+def evaluateGates(gates, dataX, dataY, parentMask=None):
+    """Evaluate all gates in one pass over the events.
+
+    Each event is first tested against the bounding box of each gate; the
+    exact (and more expensive) test is only run for the events inside the
+    bounding box.
+
+    @param gates List of gate objects.
+    @param dataX Java double[] array with the X coordinates of the events.
+    @param dataY Java double[] array with the Y coordinates of the events.
+    @param parentMask (optional) java.util.BitSet: only the events whose bit
+           is set are evaluated.
+    @return list of java.util.BitSet membership masks (one per gate).
+    """
+
+    n = len(dataX)
+    masks = [BitSet(n) for gate in gates]
+    tests = [(gate.getBounds(), gate.contains, mask)
+             for (gate, mask) in zip(gates, masks)]
+
+    if parentMask is None:
+        i = 0
+    else:
+        i = parentMask.nextSetBit(0)
+
+    while 0 <= i < n:
+        x = dataX[i]
+        y = dataY[i]
+        for ((xMin, xMax, yMin, yMax), contains, mask) in tests:
+            if xMin <= x <= xMax and yMin <= y <= yMax and contains(x, y):
+                mask.set(i)
+        if parentMask is None:
+            i += 1
+        else:
+            i = parentMask.nextSetBit(i + 1)
+
+    return masks
+
+
+def evaluateHierarchy(nodes, getDisplayColumn, cacheKeyPrefix,
+                      maxCacheBytes):
+    """Return the membership masks of all gates of a hierarchy.
+
+    The masks are looked up in the mask cache first: a gate is only evaluated
+    if its mask is not cached, and then only on the events of its parent.
+    Gates that share the parent and the parameters are evaluated together in
+    one pass. The new masks are added to the cache.
+
+    @param nodes List of gate nodes as returned by parseGates().
+    @param getDisplayColumn Function (parameter, display) that returns all
+           events of the parameter in display coordinates (Java double[]).
+    @param cacheKeyPrefix Prefix of the cache keys: it must identify the
+           dataset and everything else that changes the display coordinates
+           (e.g. compensation).
+    @param maxCacheBytes Maximum size of the mask cache in bytes.
+    @return dictionary of java.util.BitSet masks by gate name. The masks may
+            be shared with the cache and must not be modified.
+    """
+
+    masks = {}
+    pending = []
+    for node in nodes:
+        mask = getCachedMask(cacheKeyPrefix + node["key"])
+        if mask is None:
+            pending.append(node)
+        else:
+            masks[node["name"]] = mask
+
+    # The nodes are ordered, so there is always a gate whose parent is known
+    while len(pending) > 0:
+
+        # Group the gates whose parent mask is available
+        groups = {}
+        for node in pending:
+            if node["parent"] is None or node["parent"] in masks:
+                group = (node["parent"], node["paramX"], node["displayX"],
+                         node["paramY"], node["displayY"])
+                groups.setdefault(group, []).append(node)
+
+        for ((parent, paramX, displayX, paramY, displayY), group) in \
+            groups.items():
+            parentMask = None
+            if parent is not None:
+                parentMask = masks[parent]
+            groupMasks = evaluateGates([node["gate"] for node in group],
+                                       getDisplayColumn(paramX, displayX),
+                                       getDisplayColumn(paramY, displayY),
+                                       parentMask)
+            for (node, mask) in zip(group, groupMasks):
+                masks[node["name"]] = mask
+                cacheMask(cacheKeyPrefix + node["key"], mask, maxCacheBytes)
+
+        pending = [node for node in pending if node["name"] not in masks]
+
+    return masks
+
+
+class _MaskCache:
+    """Cache of gate membership masks, least recently used first out.
+
+    The cache is shared by all jobs of the DSS (see SharedState.py). It keeps
+    a running total of the size of the cached masks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.masks = LinkedHashMap(16, 0.75, True)
+        self.numBytes = 0
+
+
+def _getMaskCache():
+    """Return the mask cache shared by all jobs."""
+    return getSharedObject(_MASK_CACHE_NAME, _MaskCache)
+
+
+def _getMaskBytes(mask):
+    """Return the memory used by a mask in bytes."""
+    return mask.size() / 8
+
+
+def getCachedMask(key):
+    """Return the cached mask with given key, or None.
+
+    @param key Cache key of the mask.
+    @return java.util.BitSet or None. The mask must not be modified.
+    """
+
+    cache = _getMaskCache()
+    cache.lock.acquire()
+    try:
+        return cache.masks.get(key)
+    finally:
+        cache.lock.release()
+
+
+def cacheMask(key, mask, maxCacheBytes):
+    """Add a mask to the cache. The least recently used masks are evicted
+    until the cache is not larger than maxCacheBytes.
+
+    @param key Cache key of the mask.
+    @param mask java.util.BitSet to cache.
+    @param maxCacheBytes Maximum size of the mask cache in bytes.
+    """
+
+    cache = _getMaskCache()
+    cache.lock.acquire()
+    try:
+        previousMask = cache.masks.put(key, mask)
+        if previousMask is not None:
+            cache.numBytes -= _getMaskBytes(previousMask)
+        cache.numBytes += _getMaskBytes(mask)
+
+        iterator = cache.masks.values().iterator()
+        while cache.numBytes > maxCacheBytes and iterator.hasNext():
+            cache.numBytes -= _getMaskBytes(iterator.next())
+            iterator.remove()
+    finally:
+        cache.lock.release()
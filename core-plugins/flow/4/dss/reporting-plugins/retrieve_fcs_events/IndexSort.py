@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+'''
+Event-to-well mapping of the index-sort files (mode "indexSort" of
+retrieve_fcs_events).
+
+Only the keyword scheme of the BD sorters (FACSDiva) is recognized: the sort
+locations are stored in the keywords "INDEX SORTING LOCATIONS_n" (or
+"INDEX SORT LOCATIONS_n"). The Influx, MoFlo XDP, S3e and Sony MA900/SH800S
+tubes can be flagged as index sort as well, but their sort locations are not
+stored in these keywords: their files are reported as having no index-sort
+information.
+'''
+
+import re
+import jarray
+from ch.ethz.scu.obit.common.server.longrunning import LRCache
+
+import Plates
+
+# Prefix of the LRCache keys of the cached event-to-well mappings
+_INDEX_SORT_KEY_PREFIX = "retrieve_fcs_events_index_sort_"
+
+# Keywords with the sort locations of the events, numbered from 1 (e.g.
+# "INDEX SORTING LOCATIONS_1"): each stores a list of "row,column;" entries
+# (0-based), one per event, continued in the next keyword
+_LOCATIONS_KEYWORD_PREFIXES = ["INDEX SORTING LOCATIONS_",
+                               "INDEX SORT LOCATIONS_"]
+
+# A location "row,column"
+_LOCATION_PATTERN = re.compile(r"^\s*(\d+)\s*,\s*(\d+)\s*$")
+
+# Packed location of the events that were not sorted into a well
+NOT_SORTED = -1
+
+
+def _getKeyword(reader, name):
+    """Return the value of a (custom) keyword, or None if it is not set."""
+
+    value = reader.getCustomKeyword(name)
+    if value is None or str(value).strip() == "":
+        return None
+    return str(value)
+
+
+def packLocation(row, column):
+    """Pack the 0-based (row, column) of a well in one value of the per-event
+    well array."""
+    return (row << 8) | column
+
+
+def unpackLocation(location):
+    """Return the 0-based (row, column) of a packed location, or None if the
+    event was not sorted."""
+    if location < 0:
+        return None
+    return (location >> 8, location & 0xFF)
+
+
+def getWellName(location):
+    """Return the name of the well (e.g. "B7") of a packed location, or None
+    if the event was not sorted."""
+    position = unpackLocation(location)
+    if position is None:
+        return None
+    return Plates.getRowLabel(position[0]) + str(position[1] + 1)
+
+
+def extractLocations(reader):
+    """Extract the sort locations of the events of an index-sort file.
+
+    The k-th location stored in the keywords is the well the k-th event was
+    sorted into; events without location were not sorted.
+
+    @param reader FCSReader (the HEADER and TEXT segments must be parsed).
+    @return Java short[] array with the packed location (see packLocation())
+            of each event, or NOT_SORTED.
+    @throws ValueError if the file has no (valid) index-sort information.
+    """
+
+    entries = []
+    for prefix in _LOCATIONS_KEYWORD_PREFIXES:
+        k = 1
+        value = _getKeyword(reader, prefix + str(k))
+        while value is not None:
+            entries.extend([entry for entry in value.split(";")
+                            if entry.strip() != ""])
+            k += 1
+            value = _getKeyword(reader, prefix + str(k))
+        if len(entries) > 0:
+            break
+
+    if len(entries) == 0:
+        raise ValueError("The file has no index-sort information.")
+
+    numEvents = int(reader.numEvents())
+    locations = jarray.array([NOT_SORTED] * numEvents, 'h')
+    for (k, entry) in enumerate(entries[:numEvents]):
+        match = _LOCATION_PATTERN.match(entry)
+        if match is None:
+            raise ValueError("Invalid index-sort location '" + entry + "'.")
+        row = int(match.group(1))
+        column = int(match.group(2))
+        if row > 127 or column > 255:
+            raise ValueError("Invalid index-sort location '" + entry + "'.")
+        locations[k] = packLocation(row, column)
+
+    return locations
+
+
+def getLocations(reader, code):
+    """Return the per-event sort locations of a dataset (see
+    extractLocations()). They are extracted on first access and cached in the
+    LRCache (two bytes per event).
+
+    @param reader FCSReader (the HEADER and TEXT segments must be parsed).
+    @param code Code of the dataset.
+    @return Java short[] array.
+    @throws ValueError if the file has no (valid) index-sort information.
+    """
+
+    key = _INDEX_SORT_KEY_PREFIX + code
+    locations = LRCache.get(key)
+    if locations is None:
+        locations = extractLocations(reader)
+        LRCache.set(key, locations)
+    return locations
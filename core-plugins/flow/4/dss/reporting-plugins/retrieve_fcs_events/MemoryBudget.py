@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+'''
+Memory budget shared by the jobs of the FCS event retrieval (see
+memory_budget_mb in plugin.properties).
+'''
+
+import time
+import threading
+
+
+class MemoryBudget:
+    """The MemoryBudget class tracks the memory (in MB) charged by the
+    running jobs against a common budget.
+
+    Jobs that do not fit in the memory left wait in a first-in, first-out
+    queue: memory is granted in the order it was requested.
+
+    The capacity can be changed while memory is in use (e.g. after a change
+    of the plug-in settings): the memory in use stays charged, and no job is
+    admitted until the new capacity allows it.
+    """
+
+    # Constructor
+    def __init__(self, capacityMB):
+        """Constructor
+
+        @param capacityMB Total memory in MB.
+        """
+
+        self._condition = threading.Condition()
+        self._capacityMB = capacityMB
+        self._usedMB = 0
+
+        # Waiting requests in order of arrival
+        self._queue = []
+
+    def setCapacity(self, capacityMB):
+        """Set the total memory in MB."""
+
+        self._condition.acquire()
+        try:
+            self._capacityMB = capacityMB
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def getCapacity(self):
+        """Return the total memory in MB."""
+        return self._capacityMB
+
+    def getUsed(self):
+        """Return the memory in MB that is currently charged."""
+        return self._usedMB
+
+    def tryAcquire(self, requiredMB, timeout):
+        """Charge requiredMB against the budget, waiting at most timeout
+        seconds for other jobs to release enough memory.
+
+        @param requiredMB Memory in MB.
+        @param timeout Maximum waiting time in seconds (0 not to wait).
+        @return True if the memory was charged (it must be given back with
+                release()), False otherwise.
+        """
+
+        deadline = time.time() + timeout
+        request = object()
+
+        self._condition.acquire()
+        try:
+            self._queue.append(request)
+            try:
+                while self._queue[0] is not request or \
+                        self._usedMB + requiredMB > self._capacityMB:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+
+                self._usedMB += requiredMB
+                return True
+            finally:
+                # The next request in the queue may be admitted now
+                self._queue.remove(request)
+                self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def release(self, requiredMB):
+        """Give back memory charged by tryAcquire()."""
+
+        self._condition.acquire()
+        try:
+            self._usedMB -= requiredMB
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
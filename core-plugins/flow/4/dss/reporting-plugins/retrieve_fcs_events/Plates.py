@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+'''
+Plate geometries and well names, and the arrangement of per-well values in a
+matrix with the layout of the plate (mode "plate" of retrieve_fcs_events).
+'''
+
+import re
+
+# Plate geometries are vocabulary terms of the form <n>_WELLS_<rows>X<columns>
+_GEOMETRY_PATTERN = re.compile(r"^(\d+)_WELLS_(\d+)X(\d+)$")
+
+# Well names are a row letter (or letters) followed by the column number
+_WELL_NAME_PATTERN = re.compile(r"^([A-Za-z]+)0*(\d+)$")
+
+# Standard plate sizes (rows, columns), from the smallest
+_STANDARD_GEOMETRIES = [(8, 12), (16, 24), (32, 48)]
+
+
+def parseGeometry(geometry):
+    """Parse a {PREFIX}_PLATE_GEOMETRY vocabulary term (e.g. 96_WELLS_8X12).
+
+    @param geometry Plate geometry.
+    @return tuple (numRows, numColumns) or None if it could not be parsed.
+    """
+
+    if geometry is None:
+        return None
+    match = _GEOMETRY_PATTERN.match(str(geometry).strip().upper())
+    if match is None:
+        return None
+    return (int(match.group(2)), int(match.group(3)))
+
+
+def parseWellName(name):
+    """Parse a well name (e.g. A1, B07, AA12) into 0-based (row, column).
+
+    @param name Well name.
+    @return tuple (row, column) or None if it could not be parsed.
+    """
+
+    if name is None:
+        return None
+    match = _WELL_NAME_PATTERN.match(str(name).strip())
+    if match is None:
+        return None
+    row = 0
+    for letter in match.group(1).upper():
+        row = 26 * row + (ord(letter) - ord("A") + 1)
+    return (row - 1, int(match.group(2)) - 1)
+
+
+def getRowLabel(row):
+    """Return the label (A, B, ..., Z, AA, AB, ...) of a 0-based row."""
+
+    label = ""
+    row += 1
+    while row > 0:
+        (row, remainder) = divmod(row - 1, 26)
+        label = chr(ord("A") + remainder) + label
+    return label
+
+
+def buildPlateMatrix(geometry, valuesByWell):
+    """Arrange per-well values in a matrix that matches the plate geometry.
+
+    If the geometry is not set (or cannot be parsed), the smallest standard
+    plate that contains all wells is used.
+
+    @param geometry Plate geometry (e.g. 384_WELLS_16X24).
+    @param valuesByWell Dictionary of values by well name.
+    @return dictionary with keys geometry, numRows, numColumns, rowLabels,
+            columnLabels, values (list of rows, with None for the wells
+            without value) and unplaced (names of the wells that could not be
+            placed in the matrix).
+    """
+
+    positions = {}
+    unplaced = []
+    for name in valuesByWell.keys():
+        position = parseWellName(name)
+        if position is None:
+            unplaced.append(name)
+        else:
+            positions[name] = position
+
+    size = parseGeometry(geometry)
+    if size is None:
+        maxRow = max([p[0] for p in positions.values()] + [0])
+        maxColumn = max([p[1] for p in positions.values()] + [0])
+        size = (maxRow + 1, maxColumn + 1)
+        for (numRows, numColumns) in _STANDARD_GEOMETRIES:
+            if maxRow < numRows and maxColumn < numColumns:
+                size = (numRows, numColumns)
+                break
+    (numRows, numColumns) = size
+
+    values = [[None] * numColumns for i in range(numRows)]
+    for (name, (row, column)) in positions.items():
+        if row < numRows and column < numColumns:
+            values[row][column] = valuesByWell[name]
+        else:
+            unplaced.append(name)
+
+    return {"geometry": geometry,
+            "numRows": numRows,
+            "numColumns": numColumns,
+            "rowLabels": [getRowLabel(i) for i in range(numRows)],
+            "columnLabels": [str(i + 1) for i in range(numColumns)],
+            "values": values,
+            "unplaced": sorted(unplaced)}
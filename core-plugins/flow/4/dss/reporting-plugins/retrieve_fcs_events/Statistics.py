@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+'''
+Summary statistics (count, mean, standard deviation, CV, minimum, maximum,
+median and percentiles) and histograms of the events of one parameter,
+optionally restricted to the events of a population.
+'''
+
+import math
+import jarray
+from java.util import Arrays
+
+# Percentiles returned with the statistics
+PERCENTILES = [5, 25, 75, 95]
+
+
+def _quantile(sortedValues, p):
+    """Return the p-th percentile (0 <= p <= 100) of a sorted Java double[]
+    array, linearly interpolated between the closest ranks."""
+
+    n = len(sortedValues)
+    if n == 0:
+        return None
+    position = (p / 100.0) * (n - 1)
+    lower = int(math.floor(position))
+    upper = min(lower + 1, n - 1)
+    fraction = position - lower
+    return sortedValues[lower] + \
+        fraction * (sortedValues[upper] - sortedValues[lower])
+
+
+def computeStatistics(column, mask=None, percentiles=PERCENTILES):
+    """Compute the statistics of a column of events.
+
+    Count, mean, standard deviation, minimum and maximum are accumulated in
+    one pass over the column (Welford's algorithm). The median and the
+    percentiles are exact: in the same pass, the selected values are copied
+    to a primitive array, which is then sorted (in Java). The quantiles thus
+    need a second pass (the sort) and O(n) additional memory per column (the
+    copy, 8 bytes per event, released when the function returns). This is
+    accounted for in the memory budget of the job; since the whole column is
+    in memory anyway, a bounded-memory quantile sketch would not lower the
+    peak memory, only the precision of the percentiles.
+
+    @param column Java double[] array.
+    @param mask (optional) java.util.BitSet: only the events whose bit is set
+           are considered.
+    @param percentiles (optional) list of the percentiles to compute
+           (default: PERCENTILES).
+    @return dictionary with keys count, mean, sd, cv (in %), min, max, median
+            and p<N> for N in percentiles. The values are None if there are
+            no events.
+    """
+
+    if mask is None:
+        count = len(column)
+    else:
+        count = mask.cardinality()
+
+    values = jarray.zeros(count, 'd')
+    mean = 0.0
+    m2 = 0.0
+    minimum = float("inf")
+    maximum = float("-inf")
+
+    k = 0
+    i = 0 if mask is None else mask.nextSetBit(0)
+    while k < count:
+        x = column[i]
+        values[k] = x
+        k += 1
+        delta = x - mean
+        mean += delta / k
+        m2 += delta * (x - mean)
+        if x < minimum:
+            minimum = x
+        if x > maximum:
+            maximum = x
+        if mask is None:
+            i += 1
+        else:
+            i = mask.nextSetBit(i + 1)
+
+    stats = {"count": count}
+    if count == 0:
+        for key in ["mean", "sd", "cv", "min", "max", "median"]:
+            stats[key] = None
+        for p in percentiles:
+            stats["p" + str(p)] = None
+        return stats
+
+    sd = math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+    Arrays.sort(values)
+
+    stats["mean"] = mean
+    stats["sd"] = sd
+    stats["cv"] = 100.0 * sd / abs(mean) if mean != 0.0 else None
+    stats["min"] = minimum
+    stats["max"] = maximum
+    stats["median"] = _quantile(values, 50.0)
+    for p in percentiles:
+        stats["p" + str(p)] = _quantile(values, float(p))
+
+    return stats
+
+
+def parseStatisticName(name):
+    """Parse the name of a statistic: one of the keys returned by
+    computeStatistics(), where p<N> can be any percentile 0 <= N <= 100.
+
+    @param name Name of the statistic.
+    @return tuple (key, percentiles): the key in the statistics returned by
+            computeStatistics() and the percentiles to pass to it to compute
+            the statistic.
+    @throws ValueError if the name is not valid.
+    """
+
+    if name in ["count", "mean", "sd", "cv", "min", "max", "median"]:
+        return (name, [])
+    if name.startswith("p"):
+        try:
+            p = float(name[1:])
+        except ValueError:
+            p = -1.0
+        if 0.0 <= p <= 100.0:
+            if p == int(p):
+                p = int(p)
+            return ("p" + str(p), [p])
+    raise ValueError("Unknown statistic '" + name + "'.")
+
+
+def computeHistogram(column, numBins, mask=None):
+    """Compute the histogram of a column of events over its own range.
+
+    @param column Java double[] array.
+    @param numBins Number of (equally wide) bins.
+    @param mask (optional) java.util.BitSet: only the events whose bit is set
+           are considered.
+    @return dictionary with keys min, max (the range of the values, None if
+            there are no events) and counts (list of numBins counts). Values
+            that are not finite are ignored.
+    """
+
+    minimum = float("inf")
+    maximum = float("-inf")
+    n = len(column)
+    i = 0 if mask is None else mask.nextSetBit(0)
+    while 0 <= i < n:
+        x = column[i]
+        if x < minimum:
+            minimum = x
+        if x > maximum:
+            maximum = x
+        i = i + 1 if mask is None else mask.nextSetBit(i + 1)
+
+    counts = [0] * numBins
+    if minimum > maximum or math.isinf(minimum) or math.isinf(maximum):
+        return {"min": None, "max": None, "counts": counts}
+
+    scale = numBins / (maximum - minimum) if maximum > minimum else 0.0
+    i = 0 if mask is None else mask.nextSetBit(0)
+    while 0 <= i < n:
+        x = column[i]
+        if minimum <= x <= maximum:
+            counts[min(int((x - minimum) * scale), numBins - 1)] += 1
+        i = i + 1 if mask is None else mask.nextSetBit(i + 1)
+
+    return {"min": minimum, "max": maximum, "counts": counts}
+
+
+def rebinHistogram(histogram, lower, upper, numBins):
+    """Redistribute the counts of a histogram computed by computeHistogram()
+    into numBins bins over [lower, upper], by the centers of its bins. This
+    allows histograms with different ranges to be compared; the error is at
+    most the width of one of the original bins.
+
+    @param histogram Histogram as returned by computeHistogram().
+    @param lower Lower bound of the new bins.
+    @param upper Upper bound of the new bins.
+    @param numBins Number of new bins.
+    @return list of numBins counts.
+    """
+
+    counts = [0] * numBins
+    if histogram["min"] is None:
+        return counts
+
+    width = (histogram["max"] - histogram["min"]) / len(histogram["counts"])
+    scale = numBins / (upper - lower) if upper > lower else 0.0
+    for (k, count) in enumerate(histogram["counts"]):
+        if count == 0:
+            continue
+        center = histogram["min"] + (k + 0.5) * width
+        b = int((center - lower) * scale)
+        counts[max(0, min(b, numBins - 1))] += count
+
+    return counts
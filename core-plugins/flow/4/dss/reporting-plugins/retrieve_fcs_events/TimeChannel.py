@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+'''
+Time parameter of the FCS files: restriction of the events to a time window
+of the acquisition ("timeRange") and events-per-second profile of the
+acquisition (mode "timeProfile" of retrieve_fcs_events).
+'''
+
+import json
+from java.util import BitSet
+
+# Names of the Time parameter ($PnN) written by the supported instruments
+TIME_PARAMETER_NAMES = ["time", "time (s)", "hdr-t"]
+
+
+def findTimeParameter(reader):
+    """Return the 0-based index of the Time parameter of a file, or -1 if
+    the file does not have one.
+
+    @param reader FCSReader (the HEADER and TEXT segments must be parsed).
+    @return index of the Time parameter or -1.
+    """
+
+    parameterNames = reader.getParameterNames()
+    for i in range(parameterNames.size()):
+        if str(parameterNames.get(i)).strip().lower() in TIME_PARAMETER_NAMES:
+            return i
+    return -1
+
+
+def getTimeStep(reader):
+    """Return the duration in seconds of one unit of the Time parameter
+    ($TIMESTEP), or 1.0 if it is not stored in the file.
+
+    @param reader FCSReader (the HEADER and TEXT segments must be parsed).
+    @return time step in seconds.
+    """
+
+    try:
+        timeStep = float(reader.getStandardKeyword("$TIMESTEP"))
+    except (TypeError, ValueError):
+        return 1.0
+    if timeStep <= 0.0:
+        return 1.0
+    return timeStep
+
+
+def parseTimeRange(timeRangeJSON):
+    """Parse the JSON-encoded time window {"start": ..., "end": ...} (in
+    seconds from the beginning of the acquisition). Both bounds are optional.
+
+    @param timeRangeJSON JSON-encoded time window.
+    @return tuple (start, end).
+    @throws ValueError if the time window is not valid.
+    """
+
+    try:
+        timeRange = json.loads(timeRangeJSON)
+    except ValueError:
+        raise ValueError("The time range could not be decoded.")
+    if not isinstance(timeRange, dict):
+        raise ValueError("The time range must be an object.")
+
+    bounds = []
+    for (name, default) in [("start", float("-inf")), ("end", float("inf"))]:
+        value = timeRange.get(name)
+        if value is None:
+            bounds.append(default)
+        else:
+            try:
+                bounds.append(float(value))
+            except (TypeError, ValueError):
+                raise ValueError("Invalid time range bound '" + name + "'.")
+
+    (start, end) = bounds
+    if start > end:
+        raise ValueError("Invalid time range bounds.")
+
+    return (start, end)
+
+
+def _lowerBound(column, value):
+    """Return the index of the first element of the sorted Java double[]
+    array column that is not smaller than value."""
+
+    low = 0
+    high = len(column)
+    while low < high:
+        middle = (low + high) / 2
+        if column[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _upperBound(column, value):
+    """Return the index of the first element of the sorted Java double[]
+    array column that is larger than value."""
+
+    low = 0
+    high = len(column)
+    while low < high:
+        middle = (low + high) / 2
+        if column[middle] <= value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def findEventRange(timeColumn, timeStep, timeRange):
+    """Find the events acquired within a time window.
+
+    The events are stored in acquisition order, so the first and last event
+    of the window are found by binary search on the Time column.
+
+    @param timeColumn Java double[] array with the Time parameter.
+    @param timeStep Duration in seconds of one unit of the Time parameter.
+    @param timeRange Tuple (start, end) in seconds as returned by
+           parseTimeRange().
+    @return tuple (first, last): the events first <= i < last are inside the
+            window.
+    @throws ValueError if the Time parameter is not monotonic.
+    """
+
+    n = len(timeColumn)
+    if n > 1 and timeColumn[0] > timeColumn[n - 1]:
+        raise ValueError("The events are not ordered by time.")
+
+    (start, end) = timeRange
+    first = _lowerBound(timeColumn, start / timeStep)
+    last = _upperBound(timeColumn, end / timeStep)
+    return (first, max(first, last))
+
+
+def getTimeWindowMask(reader, timeRange):
+    """Return the mask of the events of a file acquired within a time window.
+
+    @param reader FCSReader with the data loaded.
+    @param timeRange Tuple (start, end) in seconds as returned by
+           parseTimeRange().
+    @return java.util.BitSet with the events inside the window.
+    @throws ValueError if the file has no (monotonic) Time parameter.
+    """
+
+    indx = findTimeParameter(reader)
+    if indx == -1:
+        raise ValueError("The file has no Time parameter.")
+    numEvents = int(reader.numEvents())
+    timeColumn = reader.getDataPerColumnIndex(indx, numEvents, False)
+    (first, last) = findEventRange(timeColumn, getTimeStep(reader), timeRange)
+    mask = BitSet(numEvents)
+    mask.set(first, last)
+    return mask
+
+
+def computeEventRateProfile(timeColumn, timeStep, numBins):
+    """Compute the number of events per second over the acquisition.
+
+    @param timeColumn Java double[] array with the Time parameter.
+    @param timeStep Duration in seconds of one unit of the Time parameter.
+    @param numBins Number of (equally long) time intervals.
+    @return dictionary with keys start and end (in seconds), binWidth (in
+            seconds) and rates (list of numBins events per second).
+    @throws ValueError if the Time parameter is not monotonic.
+    """
+
+    n = len(timeColumn)
+    if n == 0:
+        return {"start": 0.0, "end": 0.0, "binWidth": 0.0,
+                "rates": [0.0] * numBins}
+    if timeColumn[0] > timeColumn[n - 1]:
+        raise ValueError("The events are not ordered by time.")
+
+    start = timeColumn[0] * timeStep
+    end = timeColumn[n - 1] * timeStep
+    binWidth = (end - start) / numBins
+    if binWidth <= 0.0:
+        return {"start": start, "end": end, "binWidth": 0.0,
+                "rates": [0.0] * numBins}
+
+    # The events of each interval are found by binary search
+    rates = []
+    first = 0
+    for b in range(numBins):
+        if b == numBins - 1:
+            last = n
+        else:
+            last = _lowerBound(timeColumn,
+                               (start + (b + 1) * binWidth) / timeStep)
+        rates.append((last - first) / binWidth)
+        first = last
+
+    return {"start": start, "end": end, "binWidth": binWidth,
+            "rates": rates}
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+'''
+Display transforms of the FCS event retrieval (Linear, Hyperlog, Arcsinh and
+Logicle).
+
+The parameters of a transform are estimated from a fixed subsample of the
+events, once per dataset and channel, and cached in the LRCache: the plots of
+a file do not change from one request to the next.
+'''
+
+import math
+import bisect
+import jarray
+from ch.ethz.scu.obit.flow.readers import Hyperlog
+from ch.ethz.scu.obit.common.server.longrunning import LRCache
+
+# Prefix of the LRCache keys of the cached transform parameters
+_TRANSFORM_KEY_PREFIX = "retrieve_fcs_events_transform_"
+
+# Number of events (regularly sampled from the whole file) used to estimate
+# the transform parameters. Since the subsample does not depend on the
+# request, the parameters (and therefore the plots) are stable.
+_ESTIMATION_NUM_EVENTS = 10000
+
+# Maximum size of the lookup table used for integer-typed channels
+_MAX_LOOKUP_TABLE_SIZE = 262144
+
+# Supported display transforms
+DISPLAY_TYPES = ["Linear", "Hyperlog", "Arcsinh", "Logicle"]
+
+
+def _percentile(sortedValues, p):
+    """Return the p-th percentile (0 <= p <= 100) of a sorted list."""
+
+    if len(sortedValues) == 0:
+        return 0.0
+    i = int(round((p / 100.0) * (len(sortedValues) - 1)))
+    return sortedValues[i]
+
+
+class HyperlogTransform:
+    """Hyperlog transform (Bagwell, 2005). The evaluation is delegated to the
+    Java Hyperlog class, which transforms whole columns at once. The output is
+    scaled to the top of the scale (T)."""
+
+    def __init__(self, params):
+        """Constructor
+
+        @param params [T, W, M, A] as returned by estimate().
+        """
+        self._params = params
+        self._hyperlog = Hyperlog(params[0], params[1], params[2], params[3])
+
+    @staticmethod
+    def estimate(data, rangeMax):
+        """Estimate the parameters from a (sub)sample of the data.
+
+        @param data Java double[] array.
+        @param rangeMax Range of the channel ($PnR).
+        @return list of parameters [T, W, M, A].
+        """
+        return [float(p) for p in Hyperlog.estimateParamHeuristic(data)]
+
+    def transform(self, column):
+        """Transform a whole column (Java double[] array).
+
+        @param column Java double[] array.
+        @return transformed Java double[] array.
+        """
+        return Hyperlog.arrayMult(self._hyperlog.transform(column),
+                                  self._params[0])
+
+
+class ArcsinhTransform:
+    """Inverse hyperbolic sine transform: y = asinh(x / cofactor)."""
+
+    # Cofactor used if it cannot be estimated from the data
+    DEFAULT_COFACTOR = 150.0
+
+    def __init__(self, params):
+        """Constructor
+
+        @param params [cofactor] as returned by estimate().
+        """
+        self._cofactor = params[0]
+
+    @staticmethod
+    def estimate(data, rangeMax):
+        """Estimate the cofactor from a (sub)sample of the data: the linear
+        region of the transform is chosen to cover the spread of the negative
+        values (5th percentile).
+
+        @param data Java double[] array.
+        @param rangeMax Range of the channel ($PnR).
+        @return list of parameters [cofactor].
+        """
+        r = _percentile(sorted(data), 5.0)
+        if r < 0.0:
+            return [max(1.0, abs(r))]
+        return [ArcsinhTransform.DEFAULT_COFACTOR]
+
+    def transform(self, column):
+        """Transform a whole column (Java double[] array).
+
+        @param column Java double[] array.
+        @return transformed Java double[] array.
+        """
+        n = len(column)
+        out = jarray.zeros(n, 'd')
+        c = self._cofactor
+        for i in xrange(n):
+            x = column[i] / c
+            # asinh(x) = sign(x) * log(|x| + sqrt(x^2 + 1))
+            if x >= 0.0:
+                out[i] = math.log(x + math.sqrt(x * x + 1.0))
+            else:
+                out[i] = -math.log(-x + math.sqrt(x * x + 1.0))
+        return out
+
+
+class LogicleTransform:
+    """Logicle transform (Parks, Roederer and Moore, 2006; implementation
+    after Moore and Parks, 2012). As in the reference "fast" implementation,
+    the (closed-form) inverse is tabulated on a regular grid of the display
+    scale, and the transform is evaluated by binary search and linear
+    interpolation in the table. The output is scaled to the top of the
+    scale (T)."""
+
+    # Number of intervals in the table
+    BINS = 4096
+
+    # Default number of decades and additional negative decades
+    DEFAULT_M = 4.5
+    DEFAULT_A = 0.0
+
+    def __init__(self, params):
+        """Constructor
+
+        @param params [T, W, M, A] as returned by estimate().
+        """
+        (T, W, M, A) = params
+        self._T = T
+
+        # Biexponential parameters
+        w = W / (M + A)
+        x2 = A / (M + A)
+        self._x1 = x2 + w
+        x0 = x2 + 2 * w
+        self._b = (M + A) * math.log(10.0)
+        self._d = self._solve(self._b, w)
+        c_a = math.exp(x0 * (self._b + self._d))
+        mf_a = math.exp(self._b * self._x1) - c_a / math.exp(self._d * self._x1)
+        self._a = T / ((math.exp(self._b) - mf_a) - c_a / math.exp(self._d))
+        self._c = c_a * self._a
+        self._f = -mf_a * self._a
+
+        # Tabulate the inverse on the display scale [0, 1]
+        self._table = [self._inverse(float(i) / self.BINS)
+                       for i in range(self.BINS + 1)]
+
+    @staticmethod
+    def estimate(data, rangeMax):
+        """Estimate the parameters from a (sub)sample of the data. T is the
+        top of the scale, W (the linearization width in decades) is computed
+        from the 5th percentile of the data if it is negative.
+
+        @param data Java double[] array.
+        @param rangeMax Range of the channel ($PnR).
+        @return list of parameters [T, W, M, A].
+        """
+        sortedData = sorted(data)
+        M = LogicleTransform.DEFAULT_M
+        A = LogicleTransform.DEFAULT_A
+        T = float(rangeMax)
+        if len(sortedData) > 0:
+            T = max(T, sortedData[-1])
+        if T <= 0.0:
+            T = 262144.0
+        W = 0.5
+        r = _percentile(sortedData, 5.0)
+        if r < 0.0:
+            W = (M - math.log10(T / abs(r))) / 2.0
+            W = min(max(W, 0.0), M / 2.0)
+        return [T, W, M, A]
+
+    def transform(self, column):
+        """Transform a whole column (Java double[] array).
+
+        @param column Java double[] array.
+        @return transformed Java double[] array.
+        """
+        n = len(column)
+        out = jarray.zeros(n, 'd')
+        table = self._table
+        last = self.BINS
+        for i in xrange(n):
+            x = column[i]
+            j = bisect.bisect_right(table, x) - 1
+            if j < 0 or j >= last:
+                y = self._scaleOutOfTable(x)
+            else:
+                y = (j + (x - table[j]) / (table[j + 1] - table[j])) / last
+            out[i] = y * self._T
+        return out
+
+    def _inverse(self, scale):
+        """Closed-form inverse of the transform (display scale to data)."""
+        negative = scale < self._x1
+        if negative:
+            scale = 2 * self._x1 - scale
+        inverse = self._a * math.exp(self._b * scale) + self._f - \
+            self._c * math.exp(-self._d * scale)
+        if negative:
+            return -inverse
+        return inverse
+
+    def _scaleOutOfTable(self, x):
+        """Display scale of a value outside the tabulated range. The transform
+        is essentially logarithmic there: the logarithmic estimate is refined
+        by a few Newton iterations on the inverse."""
+        v = abs(x)
+        y = math.log(max((v - self._f) / self._a, 1e-300)) / self._b
+        for i in range(4):
+            eby = self._a * math.exp(self._b * y)
+            edy = self._c * math.exp(-self._d * y)
+            y = y - (eby - edy + self._f - v) / \
+                (self._b * eby + self._d * edy)
+        if x < 0.0:
+            return 2 * self._x1 - y
+        return y
+
+    @staticmethod
+    def _solve(b, w):
+        """Solve 2 * (ln(d) - ln(b)) + w * (b + d) = 0 for d (by bisection)."""
+        if w == 0.0:
+            return b
+        d_lo = 0.0
+        d_hi = b
+        for i in range(200):
+            d = (d_lo + d_hi) / 2.0
+            if d_hi - d_lo <= 2 * b * 1e-15:
+                break
+            f = 2 * (math.log(d) - math.log(b)) + w * (b + d)
+            if f < 0.0:
+                d_lo = d
+            else:
+                d_hi = d
+        return d
+
+
+# Map display types to the transform classes
+_TRANSFORMS = {
+    "Hyperlog": HyperlogTransform,
+    "Arcsinh": ArcsinhTransform,
+    "Logicle": LogicleTransform
+}
+
+
+def getTransform(reader, code, channelIndex, displayType, compensation=None):
+    """Return the transform for given channel of a dataset.
+
+    The transform parameters are estimated once per (dataset, channel) on a
+    fixed, regularly sampled subset of the events and cached in the LRCache.
+    Compensated channels have their own parameters.
+
+    @param reader FCSReader with the data loaded.
+    @param code Code of the dataset.
+    @param channelIndex 0-based index of the channel.
+    @param displayType One of DISPLAY_TYPES.
+    @param compensation (optional) Compensation object if the channel is
+           displayed compensated.
+    @return transform object or None for a linear display.
+    """
+
+    if displayType not in _TRANSFORMS:
+        return None
+
+    transformClass = _TRANSFORMS[displayType]
+
+    key = _TRANSFORM_KEY_PREFIX + code + "_" + str(channelIndex) + "_" + \
+        displayType
+    if compensation is not None:
+        key += "_compensated"
+    params = LRCache.get(key)
+    if params is None:
+        numEvents = min(_ESTIMATION_NUM_EVENTS, int(reader.numEvents()))
+        if compensation is not None:
+            subsample = compensation.getColumn(reader, channelIndex,
+                                               numEvents, True)
+        else:
+            subsample = reader.getDataPerColumnIndex(channelIndex, numEvents,
+                                                     True)
+        params = transformClass.estimate(subsample,
+                                         _getRange(reader, channelIndex))
+        LRCache.set(key, params)
+
+    return transformClass(list(params))
+
+
+def transformColumn(reader, code, channelIndex, displayType, column,
+                    compensation=None):
+    """Apply the requested display transform to a whole column.
+
+    For (uncompensated) integer-typed channels with linear amplification, all
+    values are integers in [0, $PnR): if there are more values to transform
+    than possible values, the transform is tabulated once for the whole range
+    and applied as a lookup table.
+
+    @param reader FCSReader with the data loaded.
+    @param code Code of the dataset.
+    @param channelIndex 0-based index of the channel.
+    @param displayType One of DISPLAY_TYPES.
+    @param column Java double[] array.
+    @param compensation (optional) Compensation object if the column is
+           compensated.
+    @return transformed Java double[] array (or column for a linear display).
+    """
+
+    transform = getTransform(reader, code, channelIndex, displayType,
+                             compensation)
+    if transform is None:
+        return column
+
+    rangeMax = _getRange(reader, channelIndex)
+    if compensation is not None or \
+        not _isIntegerChannel(reader, channelIndex) or \
+        rangeMax > _MAX_LOOKUP_TABLE_SIZE or rangeMax >= len(column):
+        return transform.transform(column)
+
+    # Tabulate the transform for all possible values
+    values = jarray.array([float(v) for v in xrange(rangeMax)], 'd')
+    table = transform.transform(values)
+
+    # Look up the values (and transform the ones that are not in the table)
+    out = jarray.zeros(len(column), 'd')
+    missing = []
+    for i in xrange(len(column)):
+        x = column[i]
+        j = int(x)
+        if j == x and 0 <= j < rangeMax:
+            out[i] = table[j]
+        else:
+            missing.append(i)
+    if len(missing) > 0:
+        transformed = transform.transform(
+            jarray.array([column[i] for i in missing], 'd'))
+        for k in xrange(len(missing)):
+            out[missing[k]] = transformed[k]
+
+    return out
+
+
+def _getRange(reader, channelIndex):
+    """Return the range ($PnR) of given channel (0 if not set)."""
+    value = reader.getStandardKeyword("$P" + str(channelIndex + 1) + "R")
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _isIntegerChannel(reader, channelIndex):
+    """Return True if the values of given channel are stored as integers
+    with linear amplification and unit gain."""
+
+    if reader.getStandardKeyword("$DATATYPE") != "I":
+        return False
+
+    n = str(channelIndex + 1)
+    amplification = reader.getStandardKeyword("$P" + n + "E")
+    if amplification is not None:
+        try:
+            if float(amplification.split(",")[0]) != 0.0:
+                return False
+        except ValueError:
+            return False
+
+    gain = reader.getStandardKeyword("$P" + n + "G")
+    if gain is not None:
+        try:
+            if float(gain) != 1.0:
+                return False
+        except ValueError:
+            return False
+
+    return True
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+'''
+Selection of the events inside the viewport of a zoomed plot (mode
+"viewport" of retrieve_fcs_events). The minimum and maximum of each block of
+events are cached per column, so that most blocks are accepted or skipped as
+a whole.
+'''
+
+import json
+import jarray
+from java.util import BitSet
+from ch.ethz.scu.obit.common.server.longrunning import LRCache
+
+# Prefix of the LRCache keys of the cached block summaries
+_SUMMARY_KEY_PREFIX = "retrieve_fcs_events_block_summary_"
+
+# Number of consecutive events summarized by one block
+BLOCK_SIZE = 4096
+
+
+def parseViewport(viewportJSON):
+    """Parse the JSON-encoded viewport of a zoomed plot.
+
+    The viewport is an object {"xMin": ..., "xMax": ..., "yMin": ...,
+    "yMax": ...} in display coordinates. All bounds are optional: missing (or
+    null) bounds are unbounded (e.g. a plot zoomed along the X axis only).
+
+    @param viewportJSON JSON-encoded viewport.
+    @return tuple (xMin, xMax, yMin, yMax).
+    @throws ValueError if the viewport is not valid.
+    """
+
+    try:
+        viewport = json.loads(viewportJSON)
+    except ValueError:
+        raise ValueError("The viewport could not be decoded.")
+    if not isinstance(viewport, dict):
+        raise ValueError("The viewport must be an object.")
+
+    bounds = []
+    for (name, default) in [("xMin", float("-inf")), ("xMax", float("inf")),
+                            ("yMin", float("-inf")), ("yMax", float("inf"))]:
+        value = viewport.get(name)
+        if value is None:
+            bounds.append(default)
+        else:
+            try:
+                bounds.append(float(value))
+            except (TypeError, ValueError):
+                raise ValueError("Invalid viewport bound '" + name + "'.")
+
+    (xMin, xMax, yMin, yMax) = bounds
+    if xMin > xMax or yMin > yMax:
+        raise ValueError("Invalid viewport bounds.")
+
+    return (xMin, xMax, yMin, yMax)
+
+
+def computeBlockSummary(column):
+    """Compute the minimum and maximum of each block of BLOCK_SIZE
+    consecutive events of a column.
+
+    @param column Java double[] array.
+    @return Java double[] array with the minimum and maximum of block b at
+            positions 2 * b and 2 * b + 1.
+    """
+
+    n = len(column)
+    numBlocks = (n + BLOCK_SIZE - 1) / BLOCK_SIZE
+    summary = jarray.zeros(2 * numBlocks, 'd')
+    for b in range(numBlocks):
+        start = b * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, n)
+        minimum = column[start]
+        maximum = minimum
+        for i in xrange(start + 1, end):
+            x = column[i]
+            if x < minimum:
+                minimum = x
+            elif x > maximum:
+                maximum = x
+        summary[2 * b] = minimum
+        summary[2 * b + 1] = maximum
+    return summary
+
+
+def getBlockSummary(column, cacheKey):
+    """Return the block summary (see computeBlockSummary()) of a column. The
+    summaries are small (two values per BLOCK_SIZE events) and are cached in
+    the LRCache, so that they are computed only once per dataset, parameter
+    and compensation.
+
+    @param column Java double[] array.
+    @param cacheKey Key that identifies the column.
+    @return Java double[] array.
+    """
+
+    key = _SUMMARY_KEY_PREFIX + cacheKey
+    summary = LRCache.get(key)
+    if summary is None or len(summary) != \
+            2 * ((len(column) + BLOCK_SIZE - 1) / BLOCK_SIZE):
+        summary = computeBlockSummary(column)
+        LRCache.set(key, summary)
+    return summary
+
+
+def _identity(values):
+    """Transform that leaves the values unchanged."""
+    return values
+
+
+def findEventsInViewport(dataX, dataY, summaryX, summaryY, viewport,
+                         parentMask=None, transformX=None, transformY=None):
+    """Find all events inside the viewport.
+
+    The events are passed untransformed, with the display transforms as
+    functions: the viewport is in display coordinates. Since all display
+    transforms are increasing, the display range of a block is the transform
+    of its range in the data. Only the blocks whose ranges intersect the
+    viewport along both axes are transformed and scanned; blocks that are
+    entirely inside the viewport are added without transforming or testing
+    their events. A zoomed plot thus costs much less than a transform of the
+    whole columns.
+
+    @param dataX Java double[] array with the X coordinates of the events.
+    @param dataY Java double[] array with the Y coordinates of the events.
+    @param summaryX Block summary of dataX (see getBlockSummary()).
+    @param summaryY Block summary of dataY (see getBlockSummary()).
+    @param viewport Tuple (xMin, xMax, yMin, yMax) as returned by
+           parseViewport().
+    @param parentMask (optional) java.util.BitSet: only the events whose bit
+           is set are considered.
+    @param transformX (optional) function that applies the display transform
+           of X to a Java double[] array (of any length) and returns the
+           transformed array. Default: no transform.
+    @param transformY (optional) as transformX, for Y.
+    @return java.util.BitSet with the events inside the viewport.
+    """
+
+    if transformX is None:
+        transformX = _identity
+    if transformY is None:
+        transformY = _identity
+
+    # Block ranges in display coordinates
+    summaryX = transformX(summaryX)
+    summaryY = transformY(summaryY)
+
+    (xMin, xMax, yMin, yMax) = viewport
+    n = len(dataX)
+    mask = BitSet(n)
+    for b in range(len(summaryX) / 2):
+
+        # Skip the blocks outside of the viewport
+        (bxMin, bxMax) = (summaryX[2 * b], summaryX[2 * b + 1])
+        (byMin, byMax) = (summaryY[2 * b], summaryY[2 * b + 1])
+        if bxMax < xMin or bxMin > xMax or byMax < yMin or byMin > yMax:
+            continue
+
+        start = b * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, n)
+        if xMin <= bxMin and bxMax <= xMax and \
+                yMin <= byMin and byMax <= yMax:
+
+            # The whole block is inside the viewport
+            mask.set(start, end)
+
+        else:
+
+            blockX = transformX(dataX[start:end])
+            blockY = transformY(dataY[start:end])
+            for k in xrange(end - start):
+                x = blockX[k]
+                y = blockY[k]
+                if xMin <= x <= xMax and yMin <= y <= yMax:
+                    mask.set(start + k)
+
+    if parentMask is not None:
+        # "and" is a reserved word in Python
+        getattr(mask, "and")(parentMask)
+
+    return mask
@@ -3,6 +3,8 @@
 # Notes:
 #
 # - this plug-in uses LRCache.jar from export_flow_datasets/lib.
+# - the job results can also be persisted to disk (see plugin.properties); the
+#   store (ResultStore.py) is shared with export_flow_datasets.
 # - this plug-in requires Jython version 2.7 (for json module)
 
 '''
@@ -16,16 +18,99 @@ Later plots will use the CSV file directly.
 '''
 
 import os.path
+import sys
 import logging
+import math
+import re
 import java.io.File
 import java.util.ArrayList
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutorCompletionService
+from java.util.concurrent import Executors
 import json
 import uuid
+import jarray
 from threading import Thread
+from synchronize import apply_synchronized
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchSubCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClause
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClauseAttribute
 from ch.ethz.scu.obit.flow.readers import FCSReader
-from ch.ethz.scu.obit.flow.readers import Hyperlog
 from ch.ethz.scu.obit.common.server.longrunning import LRCache
 
+# Modules shared with the export plug-in
+sys.path.append("../core-plugins/flow/4/dss/reporting-plugins/export_flow_datasets")
+from ResultStore import ResultStore
+from SharedState import getSharedObject
+
+import Transforms
+import Compensation
+import Gating
+import Statistics
+import Plates
+import Viewport
+import TimeChannel
+import IndexSort
+from MemoryBudget import MemoryBudget
+
+# Prefix of the LRCache keys that map a request to the job computing it
+_INFLIGHT_KEY_PREFIX = "retrieve_fcs_events_inflight_"
+
+# Request parameters that identify identical requests
+_REQUEST_KEY_PARAMETERS = ["code", "paramX", "paramY", "displayX", "displayY",
+                           "maxNumEvents", "samplingMethod", "compensate",
+                           "mode", "gates", "statisticsParameters",
+                           "population", "samplePermId", "statistic",
+                           "viewport", "channels", "codes", "bins",
+                           "timeRange"]
+
+# Supported retrieval modes
+_MODES = ["events", "gates", "plate", "experiment", "viewport", "channels",
+          "columns", "overlay", "timeProfile", "indexSort"]
+
+# Modes that do not need paramX and paramY
+_MODES_WITHOUT_AXES = ["channels", "columns", "timeProfile"]
+
+# Default number of time intervals of the events-per-second profile
+_TIME_PROFILE_NUM_BINS = 200
+
+# Number of bins of the histograms of the single files in mode "overlay":
+# they are then combined into the requested number of bins over the range of
+# all files
+_OVERLAY_HISTOGRAM_RESOLUTION = 1024
+
+# Prefix of the LRCache keys of the cached statistics of the FCS files
+_FILE_STATISTICS_KEY_PREFIX = "retrieve_fcs_events_file_statistics_"
+
+# Columns of the statistics table returned in mode "experiment"
+_STATISTICS_TABLE_COLUMNS = ["code", "container", "sample", "parameter",
+                             "count", "mean", "sd", "cv", "min", "max",
+                             "median"] + \
+    ["p" + str(p) for p in Statistics.PERCENTILES]
+
+# Name of the memory budget shared by all jobs (see SharedState.py)
+_MEMORY_BUDGET_NAME = "retrieve_fcs_events.memoryBudget"
+
+# Message of the jobs that wait for memory (see setQueued())
+_QUEUED_MESSAGE = "The server is busy: your request is queued and will " + \
+    "be processed as soon as possible."
+
+# Name of the result store shared by all jobs (see SharedState.py)
+_RESULT_STORE_NAME = "retrieve_fcs_events.resultStore"
+
+# Result store of the current invocation (see getResultStore())
+_resultStore = None
+
+# Estimated memory (in bytes) used by each returned value: raw and
+# transformed Java doubles, Python float and its JSON representation
+_BYTES_PER_RETURNED_VALUE = 128
+
+# Estimated memory (in bytes) used by each value that is evaluated but not
+# returned: raw and transformed Java doubles and the sorted copy used for the
+# statistics
+_BYTES_PER_EVALUATED_VALUE = 32
+
 
 def setUpLogging():
     """Sets up logging and returns the logger object."""
@@ -74,12 +159,342 @@ def getFileForCode(code):
     return dataSetFiles
 
 
+def parsePropertiesFile():
+    """
+    Parse properties file for custom plug-in settings. Settings that are not
+    found in the file keep their default value.
+    """
+
+    filename = "../core-plugins/flow/4/dss/reporting-plugins/retrieve_fcs_events/plugin.properties"
+
+    # Default values (the type of the default is the type of the setting)
+    properties = {
+        "memory_budget_mb": 1024,
+        "max_queue_time_s": 600,
+        "result_store_dir": "",
+        "result_store_max_age_h": 24,
+        "gate_mask_cache_mb": 64,
+        "worker_threads": 4
+    }
+
+    try:
+        fp = open(filename, "r")
+    except:
+        return properties
+
+    try:
+        for line in fp:
+            line = re.sub('[ \'\"\n\r]', '', line)
+            parts = line.split("=")
+            if len(parts) == 2 and parts[0] in properties and parts[1] != "":
+                try:
+                    properties[parts[0]] = type(properties[parts[0]])(parts[1])
+                except ValueError:
+                    pass
+    finally:
+        fp.close()
+
+    return properties
+
+
+def estimateRequiredMemoryMB(fcsFile, extractions):
+    """
+    Estimate the memory (in MB) needed to load the FCS file and extract the
+    columns described by extractions: a list of (numColumns, maxNumEvents,
+    bytesPerValue) tuples, i.e. numColumns columns of (at most) maxNumEvents
+    events each, where each extracted value uses bytesPerValue bytes. If
+    maxNumEvents is None, all events are extracted. Only the HEADER and TEXT
+    segments of the file are read ($TOT, $PAR, $DATATYPE and $PnB keywords).
+    If the file could not be parsed, returns None.
+    """
+
+    # Open the FCS file without loading the data
+    reader = FCSReader(java.io.File(fcsFile), False)
+    if not reader.parse():
+        return None
+
+    numEventsInFile = int(reader.getStandardKeyword("$TOT"))
+    numParameters = int(reader.getStandardKeyword("$PAR"))
+    dataType = reader.getStandardKeyword("$DATATYPE")
+
+    # Size of one event in the DATA segment
+    if dataType == "D":
+        bytesPerEvent = 8 * numParameters
+    elif dataType == "F":
+        bytesPerEvent = 4 * numParameters
+    else:
+        bytesPerEvent = 0
+        for i in range(1, numParameters + 1):
+            numBits = int(reader.getStandardKeyword("$P" + str(i) + "B"))
+            bytesPerEvent += int(math.ceil(numBits / 8.0))
+
+    # The whole DATA segment is loaded, plus the extracted columns
+    dataBytes = numEventsInFile * bytesPerEvent
+    eventBytes = 0
+    for (numColumns, maxNumEvents, bytesPerValue) in extractions:
+        if maxNumEvents is None:
+            numExtractedEvents = numEventsInFile
+        else:
+            numExtractedEvents = min(maxNumEvents, numEventsInFile)
+        eventBytes += numColumns * numExtractedEvents * bytesPerValue
+
+    return int(math.ceil((dataBytes + eventBytes) / 1048576.0))
+
+
+def getMemoryBudget(budgetMB):
+    """
+    Return the MemoryBudget shared by all jobs in the DSS, with its capacity
+    set to budgetMB.
+
+    There is a single budget for the whole DSS (see SharedState.py), whatever
+    the setting: when memory_budget_mb changes, the memory charged by the
+    running jobs is still accounted for.
+    """
+
+    budget = getSharedObject(_MEMORY_BUDGET_NAME,
+                             lambda: MemoryBudget(budgetMB))
+    budget.setCapacity(budgetMB)
+    return budget
+
+
+def setQueued(resultToStore, queued):
+    """
+    Report that a worker of the job is waiting for memory (queued = True) or
+    has stopped waiting (queued = False). The job is reported as queued (with
+    _QUEUED_MESSAGE) as long as any of its workers is waiting.
+    """
+
+    def _update():
+        numQueued = resultToStore.get("numQueuedWorkers", 0)
+        if queued:
+            numQueued += 1
+        else:
+            numQueued -= 1
+        resultToStore["numQueuedWorkers"] = numQueued
+        resultToStore["queued"] = numQueued > 0
+        if numQueued > 0:
+            resultToStore["message"] = _QUEUED_MESSAGE
+        elif resultToStore["message"] == _QUEUED_MESSAGE:
+            resultToStore["message"] = ""
+
+    apply_synchronized(resultToStore, _update, ())
+    storeResults(resultToStore["uid"], resultToStore)
+
+
+def acquireMemoryBudget(requiredMemoryMB, resultToStore):
+    """
+    Charge requiredMemoryMB against the memory budget, waiting at most
+    max_queue_time_s seconds for other jobs to release enough memory. While
+    it waits, the job (resultToStore) is reported as queued.
+    Returns the budget (to be released by the caller) or None if the memory
+    could not be acquired.
+    """
+
+    properties = parsePropertiesFile()
+    budgetMB = properties["memory_budget_mb"]
+    if requiredMemoryMB > budgetMB:
+        return None
+
+    budget = getMemoryBudget(budgetMB)
+    if budget.tryAcquire(requiredMemoryMB, 0):
+        return budget
+
+    setQueued(resultToStore, True)
+    try:
+        if not budget.tryAcquire(requiredMemoryMB,
+                                 properties["max_queue_time_s"]):
+            return None
+    finally:
+        setQueued(resultToStore, False)
+
+    return budget
+
+
+def getResultStore():
+    """
+    Return the store that persists the job results to disk.
+
+    The store is created once for the DSS (see SharedState.py) and looked up
+    once per invocation of the plug-in, so that the settings are not parsed
+    again at every access.
+    """
+
+    global _resultStore
+    if _resultStore is None:
+        properties = parsePropertiesFile()
+        storeDir = properties["result_store_dir"]
+        maxAgeHours = properties["result_store_max_age_h"]
+        _resultStore = getSharedObject(
+            _RESULT_STORE_NAME + "|" + storeDir + "|" + str(maxAgeHours),
+            lambda: ResultStore(storeDir, maxAgeHours, ["data"]))
+    return _resultStore
+
+
+def storeResults(uid, resultToStore):
+    """
+    Store the results of the job with given uid in the LRCache and, if it is
+    enabled, in the result store. Once the job is completed and its results
+    are on disk, the (potentially large) data is not kept in the LRCache.
+    """
+
+    store = getResultStore()
+    store.save(uid, resultToStore)
+    if store.isEnabled() and "data" in resultToStore and \
+        resultToStore["completed"]:
+        resultToStore = dict(resultToStore)
+        resultToStore["data"] = None
+    LRCache.set(uid, resultToStore)
+
+
+def getResults(uid):
+    """
+    Return the results of the job with given uid. If they are not in the
+    LRCache (or their data was moved to disk), they are read from the result
+    store. Returns None if the job is not known.
+    """
+
+    result = LRCache.get(uid)
+    if result is None or ("data" in result and result["data"] is None):
+        result = getResultStore().load(uid)
+    return result
+
+
+def buildRequestKey(parameters):
+    """Build the key that identifies identical requests from the parameters."""
+
+    values = []
+    for name in _REQUEST_KEY_PARAMETERS:
+        value = parameters.get(name)
+        if value is None:
+            value = ""
+        values.append(str(value))
+
+    return "|".join(values)
+
+
+def registerRequest(requestKey, uid, resultToStore):
+    """
+    Register the job with given uid as the one computing the results for
+    requestKey, unless an identical request is already running. In the latter
+    case, the uid of the running job is returned and nothing is registered.
+    Otherwise, the initial results of the new job are stored and its uid is
+    returned.
+
+    The LRCache is shared by all threads of the DSS: the check-and-register
+    step is synchronized on the LRCache class. The results are written to the
+    result store afterwards, so that no disk I/O happens under the lock.
+    """
+
+    def _register():
+
+        # Is there a job running for the same request?
+        runningUid = LRCache.get(_INFLIGHT_KEY_PREFIX + requestKey)
+        if runningUid is not None and runningUid != "":
+            runningResult = LRCache.get(runningUid)
+            if runningResult is not None and not runningResult["completed"]:
+                return runningUid
+
+        # Register current job
+        LRCache.set(uid, resultToStore)
+        LRCache.set(_INFLIGHT_KEY_PREFIX + requestKey, uid)
+        return uid
+
+    registeredUid = apply_synchronized(LRCache, _register, ())
+    if registeredUid == uid:
+        getResultStore().save(uid, resultToStore)
+    return registeredUid
+
+
+def releaseRequest(requestKey, uid):
+    """Unregister the job with given uid as the one computing requestKey."""
+
+    def _release():
+        if LRCache.get(_INFLIGHT_KEY_PREFIX + requestKey) == uid:
+            LRCache.set(_INFLIGHT_KEY_PREFIX + requestKey, "")
+
+    apply_synchronized(LRCache, _release, ())
+
+
+def getIntParameter(parameters, name, default):
+    """Return the value of an integer parameter (default if it is not set)."""
+
+    value = parameters.get(name)
+    if value is None or str(value) == "":
+        return default
+    return int(value)
+
+
+def initializeResults(parameters, uid):
+    """Initialize the results to be stored from the request parameters."""
+
+    resultToStore = {}
+    resultToStore["uid"] = uid
+    resultToStore["completed"] = False
+    resultToStore["success"] = True
+    resultToStore["message"] = ""
+    resultToStore["data"] = ""
+    resultToStore["code"] = parameters.get("code")
+    for name in ["paramX", "paramY", "displayX", "displayY"]:
+        resultToStore[name] = parameters.get(name)
+        if resultToStore[name] is None:
+            resultToStore[name] = ""
+    resultToStore["numEvents"] = getIntParameter(parameters, "numEvents", 0)
+    resultToStore["maxNumEvents"] = getIntParameter(parameters,
+                                                    "maxNumEvents", 0)
+    resultToStore["samplingMethod"] = parameters.get("samplingMethod")
+    resultToStore["nodeKey"] = parameters.get("nodeKey")
+    resultToStore["queued"] = False
+    resultToStore["numQueuedWorkers"] = 0
+    resultToStore["compensate"] = parameters.get("compensate")
+    if resultToStore["compensate"] is None:
+        resultToStore["compensate"] = "0"
+    resultToStore["mode"] = parameters.get("mode")
+    if resultToStore["mode"] is None or resultToStore["mode"] == "":
+        resultToStore["mode"] = "events"
+    resultToStore["gates"] = parameters.get("gates")
+    if resultToStore["gates"] is None:
+        resultToStore["gates"] = ""
+    resultToStore["statisticsParameters"] = \
+        parameters.get("statisticsParameters")
+    if resultToStore["statisticsParameters"] is None:
+        resultToStore["statisticsParameters"] = ""
+    resultToStore["population"] = parameters.get("population")
+    if resultToStore["population"] is None:
+        resultToStore["population"] = ""
+    resultToStore["samplePermId"] = parameters.get("samplePermId")
+    if resultToStore["samplePermId"] is None:
+        resultToStore["samplePermId"] = ""
+    resultToStore["statistic"] = parameters.get("statistic")
+    if resultToStore["statistic"] is None or resultToStore["statistic"] == "":
+        resultToStore["statistic"] = "count"
+    resultToStore["viewport"] = parameters.get("viewport")
+    if resultToStore["viewport"] is None:
+        resultToStore["viewport"] = ""
+    resultToStore["channels"] = parameters.get("channels")
+    if resultToStore["channels"] is None:
+        resultToStore["channels"] = ""
+    resultToStore["codes"] = parameters.get("codes")
+    if resultToStore["codes"] is None:
+        resultToStore["codes"] = ""
+    resultToStore["bins"] = getIntParameter(parameters, "bins", 0)
+    resultToStore["timeRange"] = parameters.get("timeRange")
+    if resultToStore["timeRange"] is None:
+        resultToStore["timeRange"] = ""
+
+    return resultToStore
+
+
 # Plug-in entry point
 #
 # This plug-in always returns immediately. The first time it is called, it
 # starts the retrieve process in a separate thread and returns a unique ID to
 # the client that will later use to retrieve the state of the progress.
 #
+# Identical requests (same code, parameters, scaling, number of events and
+# sampling method) that arrive while the first one is still running do not
+# start a new thread: they are coalesced with the running job and all their
+# uids will receive its results.
+#
 # This method takes a list of parameters that also returns in a table (tableBuilder)
 # to the client. The names of the input parameters match the corresponding
 # column names. The following list describes the input parameters:
@@ -92,10 +507,113 @@ def getFileForCode(code):
 # code     : code of the FCS file to be loaded to retrieve the data to be plotted.
 # paramX   : name of the parameter for the X axis
 # paramY   : name of the parameter for the Y axis
-# displayX : scaling (linear or logarithmic) of the X axis -- CURRENTLY UNUSED
-# displayY : scaling (linear or logarithmic) of the Y axis -- CURRENTLY UNUSED
+# displayX : display transform of the X axis: one of "Linear", "Hyperlog",
+#            "Arcsinh" or "Logicle". The transform parameters are estimated
+#            once per dataset and parameter (see Transforms.py).
+# displayY : display transform of the Y axis (see displayX).
 # numEvents: total number of events known to be in the file
 # maxNumEvents: max number of events to be returned for plotting.
+# compensate: (optional) "1" to compensate the events with the spillover
+#            matrix stored in the FCS file ($SPILLOVER or SPILL keyword),
+#            "0" (default) otherwise. Files without spillover matrix are
+#            returned uncompensated.
+# mode     : (optional) one of:
+#            "events" (default): return maxNumEvents events of paramX and
+#                paramY for plotting.
+#            "gates": evaluate the gate hierarchy passed in "gates" on all
+#                events (after compensation and display transform) and
+#                return, for each gate, the number and percentage of events
+#                inside it and the statistics (see Statistics.py) of the
+#                events inside it. No events are returned. maxNumEvents and
+#                samplingMethod are ignored.
+#            "plate": compute "statistic" of paramX (optionally inside
+#                "population") for the FCS files of all wells of the
+#                {PREFIX}_PLATE sample with perm id "samplePermId", and return
+#                them as a matrix that matches the plate geometry (see
+#                Plates.py). The wells are processed in parallel by a pool of
+#                worker_threads threads (see plugin.properties); code,
+#                numEvents, maxNumEvents and samplingMethod are ignored.
+#            "experiment": compute the statistics of all parameters of the
+#                FCS files of all tubes and wells of the {PREFIX}_EXPERIMENT
+#                sample with perm id "samplePermId" (optionally inside
+#                "population"), and return them as one table. The files are
+#                processed in parallel as in mode "plate", and the statistics
+#                of each file are cached, so that repeated calls do not read
+#                the files again.
+#            "viewport": return up to maxNumEvents events of paramX and
+#                paramY (optionally inside "population") that fall inside
+#                "viewport", drawn from all events of the file, to show the
+#                details of a zoomed plot. The minimum and maximum of each
+#                block of events are cached per dataset and parameter (see
+#                Viewport.py), so that the blocks outside of the viewport are
+#                skipped: only the events of the blocks at the border of the
+#                viewport are transformed and tested. The data has the same
+#                format as in mode "events".
+#            "channels": return maxNumEvents events (optionally inside
+#                "population") of all parameters in "channels", together
+#                with their indices in the file. The subsample only depends
+#                on the file, maxNumEvents, samplingMethod and the population
+#                (and not on the channels), so that it can be used for linked
+#                views and scatter-plot matrices.
+#            "columns": as "channels", but without the event indices: this
+#                is used to add channels to a subsample retrieved with mode
+#                "channels", so that only the new columns are transferred.
+#            "overlay": return, for each of the FCS files in "codes", either
+#                maxNumEvents events of paramX and paramY (as in mode
+#                "events") or, if "bins" is set, the histogram of paramX
+#                (in display coordinates) with the same bins for all files,
+#                for overlay plots. The files are processed in parallel as in
+#                mode "plate"; numEvents and code are ignored.
+#            "timeProfile": return the number of events per second over the
+#                acquisition (from the Time parameter), to choose a stable
+#                "timeRange". The acquisition is split in "bins" intervals
+#                (default: 200).
+#            "indexSort": return the events of paramX and paramY that were
+#                index-sorted into a well, together with the name of the well
+#                (for all wells of the plate at once). The sort location of
+#                each event is extracted from the keywords of the file on
+#                first access and cached per dataset as a compact per-event
+#                array (see IndexSort.py). At most maxNumEvents events are
+#                returned. Only datasets of tubes flagged as index sort
+#                ({PREFIX}_TUBE_ISINDEXSORT) are accepted, and only the
+#                keywords of the BD sorters are recognized.
+# gates    : (mode "gates", or with "population") JSON-encoded list of gate
+#            definitions in display coordinates; see Gating.py for the
+#            supported gate types (rectangle, polygon and ellipse). Gates are
+#            defined on paramX and paramY unless they set their own
+#            parameters, and can be nested by naming a "parent" gate. The
+#            membership masks of the gates are cached per dataset (see
+#            gate_mask_cache_mb in plugin.properties), so that nested
+#            populations do not require re-evaluating their parents.
+# population: (optional) name of a gate in "gates": in modes "events" and
+#            "plate", only events inside this gate are considered.
+# timeRange: (optional) JSON-encoded time window {"start": ..., "end": ...}
+#            in seconds (both optional): in modes "events", "viewport",
+#            "channels", "columns" and "overlay", only events acquired
+#            within the window are considered. The file must have a Time
+#            parameter; since the events are stored in acquisition order,
+#            the window is found by binary search on it.
+# samplePermId: (modes "plate" and "experiment") perm id of the
+#            {PREFIX}_PLATE or {PREFIX}_EXPERIMENT sample.
+# viewport : (mode "viewport") JSON-encoded axis ranges {"xMin": ...,
+#            "xMax": ..., "yMin": ..., "yMax": ...} in display coordinates;
+#            missing bounds are unbounded.
+# channels : (modes "channels" and "columns") JSON-encoded list of the
+#            parameters to return: either names or {"name": ...,
+#            "display": ...} objects (see displayX; the default is "Linear").
+# codes    : (mode "overlay") JSON-encoded list of the codes of the FCS files.
+# bins     : (mode "overlay", optional) number of bins of the histograms; 0
+#            (default) to return events instead. (mode "timeProfile",
+#            optional) number of time intervals.
+# statistic: (mode "plate") one of "count" (default), "mean", "sd", "cv",
+#            "min", "max", "median" or "p<N>" for the N-th percentile (e.g.
+#            "p95"). All statistics but "count" are computed on the
+#            (compensated, if requested) values of paramX without display
+#            transform.
+# statisticsParameters: (mode "gates", optional) JSON-encoded list of the
+#            names of the parameters for which the statistics are computed;
+#            by default [paramX, paramY]. The statistics are computed on the
+#            (compensated, if requested) values without display transform.
 # nodeKey  : key of the FCS node in the tree. This is not used here, but needs
 #            to be passed back at the end of the process since it will be used
 #            for caching the data in the node itself to speed up subsequent
@@ -106,11 +624,43 @@ def getFileForCode(code):
 #
 # completed: True if the process has completed in the meanwhile, False if it
 #            is still running.
+# queued   : True if the process is waiting for memory to be released by
+#            other jobs before it can load the file, False otherwise.
 # success  : True if the process completed successfully, False otherwise.
 # message  : message to be displayed in the client. Please notice that this is
 #            not necessarily an error message (i.e. is success is True it will
 #            be a success message).
 # data     : the data read from the FCS/CSV file to be plotted in the client
+#            (modes "events" and "viewport"), or the JSON-encoded gate
+#            results (mode "gates"):
+#            {"numEvents": n, "gates": [{"name": ..., "type": ...,
+#             "parent": ..., "count": ..., "percent": ...,
+#             "percentOfParent": ..., "statistics": {param: {...}}}]}
+#            or the JSON-encoded plate matrix (mode "plate"):
+#            {"geometry": ..., "numRows": ..., "numColumns": ...,
+#             "rowLabels": [...], "columnLabels": [...], "values": [[...]],
+#             "counts": [[...]], "unplaced": [...], "dataSets": {well: code},
+#             "errors": {well: message}, "statistic": ..., "parameter": ...}
+#            or the JSON-encoded subsample (modes "channels" and "columns"):
+#            {"numEvents": ..., "indices": [...], "channels": [...],
+#             "displays": [...], "data": [[...]]} with one list of events per
+#            channel in data ("indices" is only returned in mode "channels")
+#            or the JSON-encoded overlay (mode "overlay"):
+#            {"codes": [...], "files": {code: {"numEvents": ...,
+#             "count": ..., "data": [[...], [...]] or "counts": [...]}},
+#             "edges": [...] (histograms only), "errors": {code: message}}
+#            or the JSON-encoded events-per-second profile (mode
+#            "timeProfile"): {"timeParameter": ..., "timeStep": ...,
+#             "numEvents": ..., "start": ..., "end": ..., "binWidth": ...,
+#             "rates": [...]} with times in seconds
+#            or the JSON-encoded index-sort events (mode "indexSort"):
+#            {"numEvents": ..., "numSorted": ..., "indices": [...],
+#             "wells": [...], "data": [[...], [...]]}
+#            or the JSON-encoded statistics table (mode "experiment"):
+#            {"columns": ["code", "container", "sample", "parameter",
+#             "count", "mean", ...], "rows": [[...]], "errors": {code: ...}}
+#            where container is the name of the plate (or "Tubes") and
+#            sample the name of the well (or tube).
 def aggregate(parameters, tableBuilder):
 
     # Add the table headers
@@ -128,6 +678,19 @@ def aggregate(parameters, tableBuilder):
     tableBuilder.addHeader("maxNumEvents")
     tableBuilder.addHeader("samplingMethod")
     tableBuilder.addHeader("nodeKey")
+    tableBuilder.addHeader("queued")
+    tableBuilder.addHeader("compensate")
+    tableBuilder.addHeader("mode")
+    tableBuilder.addHeader("gates")
+    tableBuilder.addHeader("statisticsParameters")
+    tableBuilder.addHeader("population")
+    tableBuilder.addHeader("samplePermId")
+    tableBuilder.addHeader("statistic")
+    tableBuilder.addHeader("viewport")
+    tableBuilder.addHeader("channels")
+    tableBuilder.addHeader("codes")
+    tableBuilder.addHeader("bins")
+    tableBuilder.addHeader("timeRange")
 
     # Get the ID of the call if it already exists
     uid = parameters.get("uid");
@@ -137,6 +700,10 @@ def aggregate(parameters, tableBuilder):
         # Create a unique id
         uid = str(uuid.uuid4())
 
+        # Delete expired results from the result store (at most every few
+        # minutes)
+        getResultStore().purgeExpired()
+
         # Fill in relevant information
         row = tableBuilder.addRow()
         row.setCell("uid", uid)
@@ -153,25 +720,61 @@ def aggregate(parameters, tableBuilder):
         row.setCell("maxNumEvents", "")
         row.setCell("samplingMethod", "")
         row.setCell("nodeKey", "")
+        row.setCell("queued", False)
+        row.setCell("compensate", "")
+        row.setCell("mode", "")
+        row.setCell("gates", "")
+        row.setCell("statisticsParameters", "")
+        row.setCell("population", "")
+        row.setCell("samplePermId", "")
+        row.setCell("statistic", "")
+        row.setCell("viewport", "")
+        row.setCell("channels", "")
+        row.setCell("codes", "")
+        row.setCell("bins", "")
+        row.setCell("timeRange", "")
+
+        # Is an identical request already being processed?
+        requestKey = buildRequestKey(parameters)
+        runningUid = registerRequest(requestKey, uid,
+                                     initializeResults(parameters, uid))
+        if runningUid != uid:
+
+            # Point to the running job: its results will be returned for
+            # this uid as well
+            storeResults(uid, {"uid": uid, "sharedWith": runningUid,
+                               "nodeKey": parameters.get("nodeKey")})
+
+            # Return immediately
+            return
 
         # Launch the actual process in a separate thread
         thread = Thread(target=retrieveProcess,
-                        args=(parameters, tableBuilder, uid))
+                        args=(parameters, tableBuilder, uid, requestKey))
         thread.start()
 
         # Return immediately
         return
 
-    # The process is already running in a separate thread. We get current
-    # results and return them
-    resultToSend = LRCache.get(uid);
+    # The process is already running in a separate thread (possibly on
+    # another DSS node). We get current results and return them
+    resultToSend = getResults(uid)
     if resultToSend is None:
         # This should not happen
         raise Exception("Could not retrieve results from result cache!")
 
+    # If the request was coalesced with an identical one, we return the
+    # results of the running job (but with our own node key)
+    nodeKey = resultToSend["nodeKey"]
+    if "sharedWith" in resultToSend:
+        resultToSend = getResults(resultToSend["sharedWith"])
+        if resultToSend is None:
+            # This should not happen
+            raise Exception("Could not retrieve results from result cache!")
+
     # Fill in relevant information
     row = tableBuilder.addRow()
-    row.setCell("uid", resultToSend["uid"])
+    row.setCell("uid", uid)
     row.setCell("completed", resultToSend["completed"])
     row.setCell("success", resultToSend["success"])
     row.setCell("message", resultToSend["message"])
@@ -184,62 +787,85 @@ def aggregate(parameters, tableBuilder):
     row.setCell("numEvents", resultToSend["numEvents"])
     row.setCell("maxNumEvents", resultToSend["maxNumEvents"])
     row.setCell("samplingMethod", resultToSend["samplingMethod"])
-    row.setCell("nodeKey", resultToSend["nodeKey"])
+    row.setCell("nodeKey", nodeKey)
+    row.setCell("queued", resultToSend["queued"])
+    row.setCell("compensate", resultToSend["compensate"])
+    row.setCell("mode", resultToSend["mode"])
+    row.setCell("gates", resultToSend["gates"])
+    row.setCell("statisticsParameters", resultToSend["statisticsParameters"])
+    row.setCell("population", resultToSend["population"])
+    row.setCell("samplePermId", resultToSend["samplePermId"])
+    row.setCell("statistic", resultToSend["statistic"])
+    row.setCell("viewport", resultToSend["viewport"])
+    row.setCell("channels", resultToSend["channels"])
+    row.setCell("codes", resultToSend["codes"])
+    row.setCell("bins", resultToSend["bins"])
+    row.setCell("timeRange", resultToSend["timeRange"])
 
 
 # Perform the retrieve process in a separate thread
-def retrieveProcess(parameters, tableBuilder, uid):
+def retrieveProcess(parameters, tableBuilder, uid, requestKey):
 
-    # Make sure to initialize and store the results. We need to have them since
-    # most likely the client will try to retrieve them again before the process
-    # is finished.
-    resultToStore = {}
-    resultToStore["uid"] = uid
-    resultToStore["completed"] = False
-    resultToStore["success"] = True
-    resultToStore["message"] = ""
-    resultToStore["data"] = ""
+    try:
 
-    # Get the parameters
+        if LRCache.get(uid)["mode"] == "plate":
 
-    # Get the entity code
-    code = parameters.get("code")
-    resultToStore["code"] = code
+            # Compute the statistics of all wells of a plate
+            computePlateStatistics(uid)
 
-    # Get the X-axis parameter
-    paramX = parameters.get("paramX")
-    resultToStore["paramX"] = paramX
+        elif LRCache.get(uid)["mode"] == "experiment":
 
-    # Get the Y-axis parameter
-    paramY = parameters.get("paramY")
-    resultToStore["paramY"] = paramY
+            # Compute the statistics of all files of an experiment
+            computeExperimentStatistics(uid)
 
-    # Get the X-axis scaling
-    displayX = parameters.get("displayX")
-    resultToStore["displayX"] = displayX
+        elif LRCache.get(uid)["mode"] == "overlay":
 
-    # Get the Y-axis scaling
-    displayY = parameters.get("displayY")
-    resultToStore["displayY"] = displayY
+            # Extract the events (or histograms) of several files
+            computeOverlay(uid)
 
-    # Number of events known to be in the file
-    numEvents = int(parameters.get("numEvents"))
-    resultToStore["numEvents"] = numEvents
+        else:
 
-    # Maximum number of events to return
-    maxNumEvents = int(parameters.get("maxNumEvents"))
-    resultToStore["maxNumEvents"] = maxNumEvents
+            # Retrieve the events
+            retrieveEvents(parameters, uid)
 
-    # Sampling
-    samplingMethod = parameters.get("samplingMethod")
-    resultToStore["samplingMethod"] = samplingMethod
+        # Store the final results
+        storeResults(uid, LRCache.get(uid))
 
-    # Node key
-    nodeKey = parameters.get("nodeKey")
-    resultToStore["nodeKey"] = nodeKey
+    except Exception, e:
 
-    # Store them into the cache
-    LRCache.set(uid, resultToStore)
+        # Make sure that the client (and all coalesced requests) do not
+        # wait forever for a job that failed
+        resultToStore = LRCache.get(uid)
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = "Could not retrieve the events: " + str(e)
+        storeResults(uid, resultToStore)
+
+    finally:
+
+        # Identical requests will now start a new job
+        releaseRequest(requestKey, uid)
+
+
+# Retrieve the requested events
+def retrieveEvents(parameters, uid):
+
+    # The results were initialized and stored when the job was registered.
+    # We need to have them since most likely the client will try to retrieve
+    # them again before the process is finished.
+    resultToStore = LRCache.get(uid)
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    displayX = resultToStore["displayX"]
+    displayY = resultToStore["displayY"]
+    numEvents = resultToStore["numEvents"]
+    maxNumEvents = resultToStore["maxNumEvents"]
+    samplingMethod = resultToStore["samplingMethod"]
+    mode = resultToStore["mode"]
+    population = resultToStore["population"]
 
     # Set up logging
     _logger = setUpLogging()
@@ -252,13 +878,133 @@ def retrieveProcess(parameters, tableBuilder, uid):
     _logger.info("Requested sampling method: " + samplingMethod)
     _logger.info("Number of events in file: " + str(numEvents) +
                 "; maximum number of events to return: " + str(maxNumEvents))
+    _logger.info("Requested mode: " + mode)
+
+    # Check the mode
+    if mode not in _MODES:
+
+        # Build the error message
+        message = "Unknown mode '" + mode + "'!"
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    # Check the viewport (if needed) before loading the file
+    if mode == "viewport":
+        try:
+            Viewport.parseViewport(resultToStore["viewport"])
+        except ValueError, e:
+
+            # Build the error message
+            message = "Invalid viewport: " + str(e)
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+    # Check the time window (if needed) before loading the file
+    timeRange = resultToStore["timeRange"]
+    if timeRange != "":
+        try:
+            TimeChannel.parseTimeRange(timeRange)
+        except ValueError, e:
+
+            # Build the error message
+            message = "Invalid time range: " + str(e)
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+    # Check the channels (if needed) before loading the file
+    channels = []
+    if mode in ["channels", "columns"]:
+        try:
+            channels = parseChannels(resultToStore["channels"])
+        except ValueError, e:
+
+            # Build the error message
+            message = "Invalid channels: " + str(e)
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+    # Check the gates (if needed) before loading the file
+    gatedParameters = []
+    if mode == "gates" or population != "":
+        try:
+            nodes = Gating.parseGates(resultToStore["gates"], paramX, paramY,
+                                      displayX, displayY)
+            if population != "" and \
+                population not in [node["name"] for node in nodes]:
+                raise ValueError("Unknown population '" + population + "'.")
+            gatedParameters = Gating.getGatedParameters(nodes)
+        except ValueError, e:
+
+            # Build the error message
+            message = "Invalid gates: " + str(e)
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+    # Check the tube (if needed) before loading the file
+    if mode == "indexSort" and not isIndexSortDataSet(code):
+
+        # Build the error message
+        message = "The dataset does not belong to an index-sort tube!"
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
 
     # Get the FCS file to process
     dataSetFiles = getFileForCode(code)
 
-    # Prepare the data
-    dataJSON = ""
-
     if len(dataSetFiles) != 1:
 
         # Build the error message
@@ -284,11 +1030,39 @@ def retrieveProcess(parameters, tableBuilder, uid):
         _logger.info("Dataset code " + code + " corresponds to FCS file " + \
                      fcsFile)
 
-        # Open the FCS file
-        reader = FCSReader(java.io.File(fcsFile), True);
-
-        # Parse the file with data
-        if not reader.parse():
+        # Estimate the memory needed to process the file: gates are
+        # evaluated on all events of the gated parameters, the statistics
+        # are computed on one parameter at a time, and events of a
+        # population are selected from all events of paramX and paramY.
+        # Events inside a viewport are selected from all (raw and
+        # transformed) events of paramX and paramY. Events inside a time
+        # window are found on all events of the Time parameter.
+        if mode == "gates":
+            extractions = [(len(gatedParameters) + 1, None,
+                            _BYTES_PER_EVALUATED_VALUE)]
+        elif mode == "timeProfile":
+            extractions = [(1, None, _BYTES_PER_EVALUATED_VALUE)]
+        elif mode == "indexSort":
+            extractions = [(2, maxNumEvents, _BYTES_PER_RETURNED_VALUE)]
+        elif mode == "viewport":
+            extractions = [(len(gatedParameters) + 4, None,
+                            _BYTES_PER_EVALUATED_VALUE),
+                           (2, maxNumEvents, _BYTES_PER_RETURNED_VALUE)]
+        elif mode in ["channels", "columns"]:
+            extractions = [(len(gatedParameters) + 2, None,
+                            _BYTES_PER_EVALUATED_VALUE),
+                           (len(channels) + 1, maxNumEvents,
+                            _BYTES_PER_RETURNED_VALUE)]
+        elif population != "" or timeRange != "":
+            extractions = [(len(gatedParameters) + 2, None,
+                            _BYTES_PER_EVALUATED_VALUE),
+                           (2, maxNumEvents, _BYTES_PER_RETURNED_VALUE)]
+        else:
+            extractions = [(2, maxNumEvents, _BYTES_PER_RETURNED_VALUE)]
+        if timeRange != "" and mode != "gates":
+            extractions.append((1, None, _BYTES_PER_EVALUATED_VALUE))
+        requiredMemoryMB = estimateRequiredMemoryMB(fcsFile, extractions)
+        if requiredMemoryMB is None:
 
             # Build the error message
             message = "Could not process file " + os.path.basename(fcsFile)
@@ -304,75 +1078,1513 @@ def retrieveProcess(parameters, tableBuilder, uid):
             # Return here
             return
 
-        # Preparation steps were successful
-        parameterNames = reader.getParameterNames()
+        # Get the memory budget settings
+        properties = parsePropertiesFile()
+        budgetMB = properties["memory_budget_mb"]
 
-        # Find the indices of the requested parameters
-        indxX = int(parameterNames.indexOf(paramX))
-        indxY = int(parameterNames.indexOf(paramY))
+        # Log
+        _logger.info("Estimated memory to process file " + fcsFile + ": " +
+                     str(requiredMemoryMB) + " MB (budget: " +
+                     str(budgetMB) + " MB)")
 
-        # Prepare the data arrays
-        data = []
-
-        # Actual number of events to be extracted
-        actualNumEvents = min(maxNumEvents, numEvents)
-
-        # Data sampling method.
-        #
-        # Method 1: the get the requested number of events, we will sub-
-        #           sample the file by skipping a certain number of rows
-        #           ("step") in between the returned once.
-        # Method 2: to get the requested number of events, we just return
-        #           the first N rows at the beginning of the file. This is
-        #           faster, and as far as the experts say, should still be
-        #           reasonably representative of the underlying population.
-        if samplingMethod == "1":
-            sample = True
-        else:
-            sample = False
-
-        # Now collect the first maxNumEvents rows
-        dataX = reader.getDataPerColumnIndex(indxX, actualNumEvents, sample)
-        dataY = reader.getDataPerColumnIndex(indxY, actualNumEvents, sample)
-
-        # Is the Hyperlog scaling requested?
-        if displayX == "Hyperlog":
-            params = Hyperlog.estimateParamHeuristic(dataX)
-            Hx = Hyperlog(params[0], params[1], params[2], params[3])
-            dataX = Hx.transform(dataX)
-            dataX = Hyperlog.arrayMult(dataX, params[0])
-
-        if displayY == "Hyperlog":
-            params = Hyperlog.estimateParamHeuristic(dataY)
-            Hy = Hyperlog(params[0], params[1], params[2], params[3])
-            dataY = Hy.transform(dataY)
-            dataY = Hyperlog.arrayMult(dataY, params[0])
-
-        # Build array to JSONify and return to the client
-        # Data is returned as a 2 x n array:
-        # data[0] is dataX; data[1] is dataY
-        data.append([float(dx) for dx in dataX])
-        data.append([float(dy) for dy in dataY])
-        
-        # This is maintained for historical reasons. Each
-        # [x, y] point is stored in a position in the array.
-        # for i in range (actualNumEvents):
-        #     data.append([float(dataX[i]), float(dataY[i])])
-
-        # JSON encode the data array
-        dataJSON = json.dumps(data)
-
-        # Success message
-        message = "Successfully processed file " + fcsFile
+        # Files that do not fit in the whole budget are rejected
+        if requiredMemoryMB > budgetMB:
 
-        # Log
-        _logger.info(message)
+            # Build the error message
+            message = "The file " + os.path.basename(fcsFile) + \
+                " is too large to be processed on the server (" + \
+                str(requiredMemoryMB) + " MB are needed, but only " + \
+                str(budgetMB) + " MB are available)!"
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+        # Charge the memory against the global budget. If it is currently
+        # used up by other jobs, the request is queued (see setQueued())
+        # until enough memory is released.
+        budget = acquireMemoryBudget(requiredMemoryMB, resultToStore)
+        if budget is None:
 
-        # Success
-        success = True
+            # Build the error message
+            message = "The server is too busy to process file " + \
+                os.path.basename(fcsFile) + ". Please try again later."
+
+            # Log the error
+            _logger.error(message)
+
+            # Store the results and set the completed flag
+            resultToStore["completed"] = True
+            resultToStore["success"] = False
+            resultToStore["message"] = message
+
+            # Return here
+            return
+
+        try:
+
+            # Open the FCS file and extract the events
+            processFCSFile(fcsFile, resultToStore, _logger)
+
+        finally:
+
+            # Give the memory back to the budget
+            budget.release(requiredMemoryMB)
+
+
+# Load the FCS file and extract the requested events (or evaluate the gates)
+def processFCSFile(fcsFile, resultToStore, _logger):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+
+    # Open the FCS file
+    reader = FCSReader(java.io.File(fcsFile), True);
+
+    # Parse the file with data
+    if not reader.parse():
+
+        # Build the error message
+        message = "Could not process file " + os.path.basename(fcsFile)
+
+        # Log the error
+        _logger.error(message)
 
         # Store the results and set the completed flag
         resultToStore["completed"] = True
-        resultToStore["success"] = True
+        resultToStore["success"] = False
         resultToStore["message"] = message
-        resultToStore["data"] = dataJSON
+
+        # Return here
+        return
+
+    # Preparation steps were successful
+    parameterNames = reader.getParameterNames()
+
+    # Find the indices of the requested parameters (the channels are checked
+    # when they are extracted)
+    indxX = int(parameterNames.indexOf(paramX))
+    indxY = int(parameterNames.indexOf(paramY))
+    if resultToStore["mode"] not in _MODES_WITHOUT_AXES and \
+        (indxX == -1 or indxY == -1):
+
+        # Build the error message
+        message = "Could not find the requested parameters in file " + \
+            os.path.basename(fcsFile)
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    # Is compensation requested (and possible)? The inverted spillover
+    # matrix is cached per dataset.
+    compensation = None
+    if resultToStore["compensate"] == "1":
+        compensation = Compensation.getCompensation(reader, code)
+        if compensation is None:
+            _logger.info("No valid spillover matrix found in file " +
+                         fcsFile + ": the events are not compensated.")
+
+    try:
+
+        if resultToStore["mode"] == "gates":
+
+            # Evaluate the gates on all events
+            dataJSON = evaluateGates(reader, indxX, indxY, compensation,
+                                     resultToStore)
+
+        elif resultToStore["mode"] == "indexSort":
+
+            # Extract the index-sorted events with their wells
+            dataJSON = extractIndexSortEvents(reader, indxX, indxY,
+                                              compensation, resultToStore)
+
+        elif resultToStore["mode"] == "timeProfile":
+
+            # Compute the events-per-second profile
+            dataJSON = computeTimeProfile(reader, resultToStore)
+
+        elif resultToStore["mode"] in ["channels", "columns"]:
+
+            # Extract the channels of the subsample
+            dataJSON = extractChannels(reader, compensation, resultToStore)
+
+        elif resultToStore["mode"] == "viewport":
+
+            # Extract the events inside the viewport
+            dataJSON = extractViewportEvents(reader, compensation,
+                                             resultToStore)
+
+        else:
+
+            # Extract the events to plot
+            dataJSON = extractEvents(reader, indxX, indxY, compensation,
+                                     resultToStore)
+
+    except ValueError, e:
+
+        # Build the error message
+        message = "Could not process file " + os.path.basename(fcsFile) + \
+            ": " + str(e)
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    # Success message
+    message = "Successfully processed file " + fcsFile
+
+    # Log
+    _logger.info(message)
+
+    # Store the results and set the completed flag
+    resultToStore["completed"] = True
+    resultToStore["success"] = True
+    resultToStore["message"] = message
+    resultToStore["data"] = dataJSON
+
+
+def getParameterCompensation(compensation, parameterName):
+    """
+    Return the compensation to apply to given parameter: None if no
+    compensation was requested or the parameter is not compensated.
+    """
+
+    if compensation is not None and compensation.isCompensated(parameterName):
+        return compensation
+    return None
+
+
+def readColumn(reader, indx, compensation, numEvents, sample):
+    """
+    Read numEvents events of the parameter with index indx (compensated if
+    compensation is not None) as a Java double[] array.
+    """
+
+    if compensation is not None:
+        return compensation.getColumn(reader, indx, numEvents, sample)
+    return reader.getDataPerColumnIndex(indx, numEvents, sample)
+
+
+def createColumnLoader(reader, code, compensation):
+    """
+    Return a function (name, display=None, keep=True) that returns all events
+    of the parameter with given name (compensated if requested) as a Java
+    double[] array, with the display transform applied (if display is not
+    None). Unless keep is False, the columns are kept for the following calls,
+    so that each column is read and transformed only once per request.
+    Raises a ValueError if the parameter does not exist.
+    """
+
+    numEventsInFile = int(reader.numEvents())
+    parameterNames = reader.getParameterNames()
+    columns = {}
+
+    def _getColumn(name, display=None, keep=True):
+        if (name, display) in columns:
+            return columns[(name, display)]
+        indx = int(parameterNames.indexOf(name))
+        if indx == -1:
+            raise ValueError("Unknown parameter '" + name + "'.")
+        parameterCompensation = getParameterCompensation(compensation, name)
+        if display is None:
+            column = readColumn(reader, indx, parameterCompensation,
+                                numEventsInFile, False)
+        else:
+            column = Transforms.transformColumn(reader, code, indx, display,
+                                                _getColumn(name, None, keep),
+                                                parameterCompensation)
+        if keep:
+            columns[(name, display)] = column
+        return column
+
+    return _getColumn
+
+
+def createColumnTransform(reader, code, compensation, name, display):
+    """
+    Return a function that applies the display transform of the parameter
+    with given name (compensated if requested) to a Java double[] array of
+    any length (e.g. a few events of the column) and returns the transformed
+    array.
+    """
+
+    indx = int(reader.getParameterNames().indexOf(name))
+    parameterCompensation = getParameterCompensation(compensation, name)
+
+    def _transform(values):
+        return Transforms.transformColumn(reader, code, indx, display, values,
+                                          parameterCompensation)
+
+    return _transform
+
+
+def getPopulationMasks(code, compensation, getColumn, resultToStore):
+    """
+    Return the gate nodes (see Gating.parseGates()) and the membership masks
+    of all gates of the request. The masks are cached per dataset, so that
+    only the gates that are not cached are evaluated.
+    """
+
+    nodes = Gating.parseGates(resultToStore["gates"],
+                              resultToStore["paramX"],
+                              resultToStore["paramY"],
+                              resultToStore["displayX"],
+                              resultToStore["displayY"])
+
+    # The display coordinates depend on the dataset and on whether the
+    # events are compensated
+    cacheKeyPrefix = code + "_"
+    if compensation is not None:
+        cacheKeyPrefix += "compensated_"
+
+    maxCacheBytes = parsePropertiesFile()["gate_mask_cache_mb"] * 1048576
+    masks = Gating.evaluateHierarchy(nodes, getColumn, cacheKeyPrefix,
+                                     maxCacheBytes)
+
+    return (nodes, masks)
+
+
+def selectEvents(mask, numEvents, sample):
+    """
+    Return the indices of numEvents events of the population in mask
+    (java.util.BitSet): regularly sampled from the whole population if
+    sample is True, the first numEvents events otherwise.
+    """
+
+    count = mask.cardinality()
+    numEvents = min(numEvents, count)
+    indices = []
+    if numEvents <= 0:
+        return indices
+
+    i = mask.nextSetBit(0)
+    rank = 0
+    while i >= 0 and len(indices) < numEvents:
+        if not sample or rank == (len(indices) * count) / numEvents:
+            indices.append(i)
+        rank += 1
+        i = mask.nextSetBit(i + 1)
+
+    return indices
+
+
+def getEventMask(reader, code, compensation, getColumn, resultToStore):
+    """
+    Return the mask (java.util.BitSet) of the events inside the population
+    and the time window of the request, or None if neither is set. Raises a
+    ValueError if the time window cannot be applied to the file.
+    """
+
+    mask = None
+    population = resultToStore["population"]
+    if population != "":
+        (nodes, masks) = getPopulationMasks(code, compensation, getColumn,
+                                            resultToStore)
+        mask = masks[population]
+
+    if resultToStore["timeRange"] != "":
+        timeRange = TimeChannel.parseTimeRange(resultToStore["timeRange"])
+        windowMask = TimeChannel.getTimeWindowMask(reader, timeRange)
+        if mask is None:
+            mask = windowMask
+        else:
+            # The cached population masks must not be modified
+            mask = mask.clone()
+            getattr(mask, "and")(windowMask)
+
+    return mask
+
+
+# Extract the requested events and return them JSON-encoded
+def extractEvents(reader, indxX, indxY, compensation, resultToStore):
+
+    # JSON encode the data array
+    return json.dumps(selectPlotEvents(reader, indxX, indxY, compensation,
+                                       resultToStore))
+
+
+# Extract the requested events and return them as a 2 x n array
+def selectPlotEvents(reader, indxX, indxY, compensation, resultToStore):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    displayX = resultToStore["displayX"]
+    displayY = resultToStore["displayY"]
+    numEvents = resultToStore["numEvents"]
+    maxNumEvents = resultToStore["maxNumEvents"]
+    samplingMethod = resultToStore["samplingMethod"]
+
+    # Prepare the data arrays
+    data = []
+
+    # Actual number of events to be extracted
+    actualNumEvents = min(maxNumEvents, numEvents)
+
+    # Data sampling method.
+    #
+    # Method 1: the get the requested number of events, we will sub-
+    #           sample the file by skipping a certain number of rows
+    #           ("step") in between the returned once.
+    # Method 2: to get the requested number of events, we just return
+    #           the first N rows at the beginning of the file. This is
+    #           faster, and as far as the experts say, should still be
+    #           reasonably representative of the underlying population.
+    if samplingMethod == "1":
+        sample = True
+    else:
+        sample = False
+
+    compensationX = getParameterCompensation(compensation, paramX)
+    compensationY = getParameterCompensation(compensation, paramY)
+    if resultToStore["population"] == "" and resultToStore["timeRange"] == "":
+
+        # Now collect the first maxNumEvents rows (compensated if needed)
+        dataX = readColumn(reader, indxX, compensationX, actualNumEvents,
+                           sample)
+        dataY = readColumn(reader, indxY, compensationY, actualNumEvents,
+                           sample)
+
+    else:
+
+        # Select the events of the requested population (and time window)
+        # from all events
+        getColumn = createColumnLoader(reader, code, compensation)
+        mask = getEventMask(reader, code, compensation, getColumn,
+                            resultToStore)
+        indices = selectEvents(mask, min(maxNumEvents, numEvents), sample)
+        allX = getColumn(paramX)
+        allY = getColumn(paramY)
+        dataX = jarray.array([allX[i] for i in indices], 'd')
+        dataY = jarray.array([allY[i] for i in indices], 'd')
+
+    # Apply the display transforms (if requested). The transform parameters
+    # are estimated once per dataset and parameter, so that they do not
+    # depend on the number of events requested.
+    dataX = Transforms.transformColumn(reader, code, indxX, displayX, dataX,
+                                       compensationX)
+    dataY = Transforms.transformColumn(reader, code, indxY, displayY, dataY,
+                                       compensationY)
+
+    # Build array to JSONify and return to the client
+    # Data is returned as a 2 x n array:
+    # data[0] is dataX; data[1] is dataY
+    data.append([float(dx) for dx in dataX])
+    data.append([float(dy) for dy in dataY])
+
+    # This is maintained for historical reasons. Each
+    # [x, y] point is stored in a position in the array.
+    # for i in range (actualNumEvents):
+    #     data.append([float(dataX[i]), float(dataY[i])])
+
+    return data
+
+
+def parseChannels(channelsJSON):
+    """
+    Parse the JSON-encoded list of channels to retrieve and return a list of
+    (name, display) tuples. Raises a ValueError if the list is not valid.
+    """
+
+    try:
+        channels = json.loads(channelsJSON)
+    except ValueError:
+        raise ValueError("The channels could not be decoded.")
+    if not isinstance(channels, list) or len(channels) == 0:
+        raise ValueError("The channels must be a non-empty list.")
+
+    parsed = []
+    for channel in channels:
+        if isinstance(channel, dict):
+            name = channel.get("name")
+            display = channel.get("display", "Linear")
+        else:
+            name = channel
+            display = "Linear"
+        if not isinstance(name, basestring) or name == "":
+            raise ValueError("Invalid channel name.")
+        if display not in Transforms.DISPLAY_TYPES:
+            raise ValueError("Unknown display '" + str(display) + "'.")
+        parsed.append((name, display))
+
+    return parsed
+
+
+def getSubsampleIndices(numEventsInFile, numEvents, sample):
+    """
+    Return the indices of numEvents events of a file with numEventsInFile
+    events: regularly sampled from the whole file if sample is True, the
+    first numEvents events otherwise (see selectEvents()).
+    """
+
+    numEvents = max(0, min(numEvents, numEventsInFile))
+    if not sample:
+        return range(numEvents)
+    return [(k * numEventsInFile) / numEvents for k in range(numEvents)]
+
+
+# Extract the requested channels for a stable subsample of the events and
+# return them JSON-encoded
+def extractChannels(reader, compensation, resultToStore):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    maxNumEvents = resultToStore["maxNumEvents"]
+    channels = parseChannels(resultToStore["channels"])
+
+    # See extractEvents()
+    sample = resultToStore["samplingMethod"] == "1"
+
+    # Check the channels
+    parameterNames = reader.getParameterNames()
+    for (name, display) in channels:
+        if int(parameterNames.indexOf(name)) == -1:
+            raise ValueError("Unknown parameter '" + name + "'.")
+
+    # Select the events: the subsample does not depend on the channels
+    numEventsInFile = int(reader.numEvents())
+    getColumn = createColumnLoader(reader, code, compensation)
+    mask = getEventMask(reader, code, compensation, getColumn, resultToStore)
+    if mask is not None:
+        indices = selectEvents(mask, maxNumEvents, sample)
+    else:
+        indices = getSubsampleIndices(numEventsInFile, maxNumEvents, sample)
+
+    # Extract the channels one at a time. The first events of a file are read
+    # directly; otherwise, the events are picked from the whole column.
+    data = []
+    for (name, display) in channels:
+        if mask is None and not sample:
+            indx = int(parameterNames.indexOf(name))
+            parameterCompensation = getParameterCompensation(compensation,
+                                                             name)
+            column = readColumn(reader, indx, parameterCompensation,
+                                len(indices), False)
+            column = Transforms.transformColumn(reader, code, indx, display,
+                                                column, parameterCompensation)
+            data.append([float(x) for x in column])
+        else:
+            column = getColumn(name, display, False)
+            data.append([float(column[i]) for i in indices])
+
+    result = {"numEvents": numEventsInFile,
+              "channels": [name for (name, display) in channels],
+              "displays": [display for (name, display) in channels],
+              "data": data}
+    if resultToStore["mode"] == "channels":
+        result["indices"] = indices
+
+    # JSON encode the subsample
+    return json.dumps(result)
+
+
+# Extract the requested events inside the viewport and return them
+# JSON-encoded
+def extractViewportEvents(reader, compensation, resultToStore):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    displayX = resultToStore["displayX"]
+    displayY = resultToStore["displayY"]
+    maxNumEvents = resultToStore["maxNumEvents"]
+    viewport = Viewport.parseViewport(resultToStore["viewport"])
+
+    # See extractEvents()
+    sample = resultToStore["samplingMethod"] == "1"
+
+    # All events of the parameters, untransformed: the display transforms
+    # are only applied to the blocks at the border of the viewport and to the
+    # returned events
+    getColumn = createColumnLoader(reader, code, compensation)
+    dataX = getColumn(paramX)
+    dataY = getColumn(paramY)
+    transformX = createColumnTransform(reader, code, compensation, paramX,
+                                       displayX)
+    transformY = createColumnTransform(reader, code, compensation, paramY,
+                                       displayY)
+
+    # Only events of the requested population (and time window) are
+    # considered
+    parentMask = getEventMask(reader, code, compensation, getColumn,
+                              resultToStore)
+
+    # The block summaries depend on the dataset, the parameter and the
+    # compensation
+    keys = []
+    for name in [paramX, paramY]:
+        key = code + "_" + name
+        if getParameterCompensation(compensation, name) is not None:
+            key += "_compensated"
+        keys.append(key)
+    summaryX = Viewport.getBlockSummary(dataX, keys[0])
+    summaryY = Viewport.getBlockSummary(dataY, keys[1])
+
+    # Select the events inside the viewport
+    mask = Viewport.findEventsInViewport(dataX, dataY, summaryX, summaryY,
+                                         viewport, parentMask, transformX,
+                                         transformY)
+    indices = selectEvents(mask, maxNumEvents, sample)
+
+    # Data is returned as a 2 x n array (see extractEvents()), in display
+    # coordinates
+    selectedX = transformX(jarray.array([dataX[i] for i in indices], 'd'))
+    selectedY = transformY(jarray.array([dataY[i] for i in indices], 'd'))
+    data = [[float(x) for x in selectedX],
+            [float(y) for y in selectedY]]
+
+    # JSON encode the data array
+    return json.dumps(data)
+
+
+# Extract the index-sorted events and their wells and return them
+# JSON-encoded
+def extractIndexSortEvents(reader, indxX, indxY, compensation, resultToStore):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    maxNumEvents = resultToStore["maxNumEvents"]
+
+    # Sort location of each event (extracted on first access)
+    locations = IndexSort.getLocations(reader, code)
+    indices = [i for i in range(len(locations))
+               if locations[i] != IndexSort.NOT_SORTED]
+    numSorted = len(indices)
+    if maxNumEvents > 0:
+        indices = indices[:maxNumEvents]
+
+    # Only the events up to the last sorted one are read
+    numEvents = 0
+    if len(indices) > 0:
+        numEvents = indices[-1] + 1
+    data = []
+    for (indx, name, display) in [(indxX, paramX, resultToStore["displayX"]),
+                                  (indxY, paramY, resultToStore["displayY"])]:
+        parameterCompensation = getParameterCompensation(compensation, name)
+        column = readColumn(reader, indx, parameterCompensation, numEvents,
+                            False)
+        column = Transforms.transformColumn(reader, code, indx, display,
+                                            column, parameterCompensation)
+        data.append([float(column[i]) for i in indices])
+
+    # JSON encode the events and their wells
+    return json.dumps({"numEvents": int(reader.numEvents()),
+                       "numSorted": numSorted,
+                       "indices": indices,
+                       "wells": [IndexSort.getWellName(locations[i])
+                                 for i in indices],
+                       "data": data})
+
+
+# Compute the events-per-second profile of the file and return it
+# JSON-encoded
+def computeTimeProfile(reader, resultToStore):
+
+    # Number of time intervals
+    numBins = resultToStore["bins"]
+    if numBins <= 0:
+        numBins = _TIME_PROFILE_NUM_BINS
+
+    # Find the Time parameter
+    indx = TimeChannel.findTimeParameter(reader)
+    if indx == -1:
+        raise ValueError("The file has no Time parameter.")
+
+    # Only the Time parameter is read
+    numEventsInFile = int(reader.numEvents())
+    timeColumn = reader.getDataPerColumnIndex(indx, numEventsInFile, False)
+    timeStep = TimeChannel.getTimeStep(reader)
+    profile = TimeChannel.computeEventRateProfile(timeColumn, timeStep,
+                                                  numBins)
+    profile["timeParameter"] = reader.getParameterNames().get(indx)
+    profile["timeStep"] = timeStep
+    profile["numEvents"] = numEventsInFile
+
+    # JSON encode the profile
+    return json.dumps(profile)
+
+
+# Evaluate the requested gates on all events and return the JSON-encoded
+# counts, percentages and statistics
+def evaluateGates(reader, indxX, indxY, compensation, resultToStore):
+
+    # Get the parameters
+    code = resultToStore["code"]
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+
+    # Parameters for which the statistics are computed
+    statisticsParameters = [paramX, paramY]
+    if resultToStore["statisticsParameters"] != "":
+        try:
+            statisticsParameters = \
+                json.loads(resultToStore["statisticsParameters"])
+        except ValueError:
+            raise ValueError("The statistics parameters could not be decoded.")
+    parameterNames = reader.getParameterNames()
+    for name in statisticsParameters:
+        if int(parameterNames.indexOf(name)) == -1:
+            raise ValueError("Unknown parameter '" + name + "'.")
+
+    # Get the membership masks of all gates (parsing the gates raises a
+    # ValueError if they are not valid)
+    getColumn = createColumnLoader(reader, code, compensation)
+    (nodes, masks) = getPopulationMasks(code, compensation, getColumn,
+                                        resultToStore)
+
+    # Collect the counts and percentages
+    numEventsInFile = int(reader.numEvents())
+    results = []
+    for node in nodes:
+        count = masks[node["name"]].cardinality()
+        if node["parent"] is None:
+            parentCount = numEventsInFile
+        else:
+            parentCount = masks[node["parent"]].cardinality()
+        percent = 0.0
+        if numEventsInFile > 0:
+            percent = 100.0 * count / numEventsInFile
+        percentOfParent = 0.0
+        if parentCount > 0:
+            percentOfParent = 100.0 * count / parentCount
+        results.append({"name": node["name"], "type": node["type"],
+                        "parent": node["parent"], "count": count,
+                        "percent": percent,
+                        "percentOfParent": percentOfParent,
+                        "statistics": {}})
+
+    # Compute the statistics (without display transform) inside the gates,
+    # one parameter at a time
+    for name in statisticsParameters:
+        column = getColumn(name, None, False)
+        for (node, result) in zip(nodes, results):
+            result["statistics"][name] = \
+                Statistics.computeStatistics(column, masks[node["name"]])
+
+    # JSON encode the results
+    return json.dumps({"numEvents": numEventsInFile, "gates": results})
+
+
+def computeFileStatistics(fcsFile, code, resultToStore, statisticsParameters,
+                          percentiles):
+    """
+    Compute the number of events and the statistics of the parameters in
+    statisticsParameters (with given percentiles) for the FCS file of a
+    dataset; if statisticsParameters is None, the statistics of all parameters
+    are computed. If a population is set in resultToStore, only the events
+    inside it are considered. The memory needed is charged against the memory
+    budget (while it waits for memory, the job is reported as queued).
+    Returns a dictionary {"count": ..., "statistics": {name: ...}}.
+    Raises a ValueError if the file cannot be processed.
+    """
+
+    population = resultToStore["population"]
+    fileName = os.path.basename(fcsFile)
+
+    # Without population, the number of events is stored in the header
+    if population == "" and statisticsParameters is not None and \
+        len(statisticsParameters) == 0:
+        reader = FCSReader(java.io.File(fcsFile), False)
+        if not reader.parse():
+            raise ValueError("Could not process file " + fileName)
+        return {"count": int(reader.getStandardKeyword("$TOT")),
+                "statistics": {}}
+
+    # All events of the gated parameters and of one statistics parameter at
+    # a time are needed
+    numColumns = 1
+    if population != "":
+        nodes = Gating.parseGates(resultToStore["gates"],
+                                  resultToStore["paramX"],
+                                  resultToStore["paramY"],
+                                  resultToStore["displayX"],
+                                  resultToStore["displayY"])
+        numColumns += len(Gating.getGatedParameters(nodes))
+    requiredMemoryMB = estimateRequiredMemoryMB(
+        fcsFile, [(numColumns, None, _BYTES_PER_EVALUATED_VALUE)])
+    if requiredMemoryMB is None:
+        raise ValueError("Could not process file " + fileName)
+
+    budget = acquireMemoryBudget(requiredMemoryMB, resultToStore)
+    if budget is None:
+        raise ValueError("Not enough memory to process file " + fileName)
+
+    try:
+
+        reader = FCSReader(java.io.File(fcsFile), True)
+        if not reader.parse():
+            raise ValueError("Could not process file " + fileName)
+
+        compensation = None
+        if resultToStore["compensate"] == "1":
+            compensation = Compensation.getCompensation(reader, code)
+        getColumn = createColumnLoader(reader, code, compensation)
+
+        mask = None
+        count = int(reader.numEvents())
+        if population != "":
+            (nodes, masks) = getPopulationMasks(code, compensation, getColumn,
+                                                resultToStore)
+            mask = masks[population]
+            count = mask.cardinality()
+
+        if statisticsParameters is None:
+            statisticsParameters = list(reader.getParameterNames())
+
+        statistics = {}
+        for name in statisticsParameters:
+            statistics[name] = Statistics.computeStatistics(
+                getColumn(name, None, False), mask, percentiles)
+
+        return {"count": count, "statistics": statistics}
+
+    finally:
+
+        # Give the memory back to the budget
+        budget.release(requiredMemoryMB)
+
+
+def getSample(samplePermId):
+    """Return the sample with given perm id, or None if it does not exist."""
+
+    sampleCriteria = SearchCriteria()
+    sampleCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.PERM_ID,
+            samplePermId)
+        )
+    samples = searchService.searchForSamples(sampleCriteria)
+    if len(samples) != 1:
+        return None
+    return samples[0]
+
+
+def isIndexSortDataSet(code):
+    """
+    Return True if the dataset with given code belongs to a {PREFIX}_TUBE
+    sample flagged as index sort ({PREFIX}_TUBE_ISINDEXSORT).
+    """
+
+    searchCriteria = SearchCriteria()
+    searchCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.CODE,
+            code)
+        )
+    dataSets = searchService.searchForDataSets(searchCriteria)
+    if len(dataSets) != 1:
+        return False
+
+    sample = dataSets[0].getSample()
+    if sample is None:
+        return False
+    sampleType = sample.getSampleType()
+    if not sampleType.endswith("_TUBE"):
+        return False
+
+    indexSort = sample.getPropertyValue(sampleType + "_ISINDEXSORT")
+    return str(indexSort).lower() == "true"
+
+
+def getFCSDataSetsForChildrenOf(prefix, sampleType, parentPermId):
+    """
+    Return the list of (sample name, dataset code) of the FCS files of all
+    samples of given type that are children of the sample with perm id
+    parentPermId. The datasets are retrieved with one search.
+    """
+
+    # The datasets are of type {PREFIX}_FCSFILE...
+    searchCriteria = SearchCriteria()
+    searchCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.TYPE,
+            prefix + "_FCSFILE")
+        )
+
+    # ...and belong to samples of given type that are children of the parent
+    sampleCriteria = SearchCriteria()
+    sampleCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.TYPE,
+            sampleType)
+        )
+    parentCriteria = SearchCriteria()
+    parentCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.PERM_ID,
+            parentPermId)
+        )
+    sampleCriteria.addSubCriteria(
+        SearchSubCriteria.createSampleParentCriteria(parentCriteria)
+    )
+    searchCriteria.addSubCriteria(
+        SearchSubCriteria.createSampleCriteria(sampleCriteria)
+    )
+    dataSets = searchService.searchForDataSets(searchCriteria)
+
+    samples = []
+    for dataSet in dataSets:
+        sample = dataSet.getSample()
+        if sample is not None:
+            samples.append((sample.getPropertyValue("$NAME"),
+                            dataSet.getDataSetCode()))
+
+    return samples
+
+
+def getSamplesOfTypeForParent(sampleType, parentPermId):
+    """
+    Return all samples of given type that are children of the sample with
+    perm id parentPermId.
+    """
+
+    searchCriteria = SearchCriteria()
+    searchCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.TYPE,
+            sampleType)
+        )
+    parentCriteria = SearchCriteria()
+    parentCriteria.addMatchClause(
+        MatchClause.createAttributeMatch(
+            MatchClauseAttribute.PERM_ID,
+            parentPermId)
+        )
+    searchCriteria.addSubCriteria(
+        SearchSubCriteria.createSampleParentCriteria(parentCriteria)
+    )
+    return searchService.searchForSamples(searchCriteria)
+
+
+def getWellDataSetsForPlate(platePermId):
+    """
+    Return the geometry of the {PREFIX}_PLATE sample with given perm id and
+    the list of (well name, dataset code) of the FCS files of its wells. The
+    datasets of all wells are retrieved with one search. Returns None if the
+    plate does not exist.
+    """
+
+    # Retrieve the plate
+    plate = getSample(platePermId)
+    if plate is None:
+        return None
+    plateType = plate.getSampleType()
+    geometry = plate.getPropertyValue(plateType + "_GEOMETRY")
+    prefix = plateType[:plateType.rfind("_PLATE")]
+
+    # Retrieve the FCS files of all wells
+    wells = getFCSDataSetsForChildrenOf(prefix, prefix + "_WELL", platePermId)
+
+    return (geometry, wells)
+
+
+def getDataSetsForExperimentSample(expSamplePermId):
+    """
+    Return the list of (container name, sample name, dataset code) of the FCS
+    files of all tubes and wells of the {PREFIX}_EXPERIMENT sample with given
+    perm id; the container is the plate of a well or "Tubes". The datasets are
+    retrieved with one search for the tubes and one search per plate. Returns
+    None if the experiment sample does not exist.
+    """
+
+    # Retrieve the experiment sample
+    expSample = getSample(expSamplePermId)
+    if expSample is None:
+        return None
+    expSampleType = expSample.getSampleType()
+    prefix = expSampleType[:expSampleType.rfind("_EXPERIMENT")]
+
+    # Tubes
+    dataSets = []
+    for (tubeName, code) in getFCSDataSetsForChildrenOf(
+            prefix, prefix + "_TUBE", expSamplePermId):
+        dataSets.append(("Tubes", tubeName, code))
+
+    # Wells
+    for plate in getSamplesOfTypeForParent(prefix + "_PLATE",
+                                           expSamplePermId):
+        plateName = plate.getPropertyValue("$NAME")
+        for (wellName, code) in getFCSDataSetsForChildrenOf(
+                prefix, prefix + "_WELL", plate.getPermId()):
+            dataSets.append((plateName, wellName, code))
+
+    return dataSets
+
+
+def getFileStatisticsCacheKey(code, resultToStore):
+    """
+    Return the LRCache key of the statistics of all parameters of the FCS file
+    of a dataset: it depends on the compensation and the population.
+    """
+
+    key = _FILE_STATISTICS_KEY_PREFIX + code + "_" + resultToStore["compensate"]
+    population = resultToStore["population"]
+    if population != "":
+        nodes = Gating.parseGates(resultToStore["gates"],
+                                  resultToStore["paramX"],
+                                  resultToStore["paramY"],
+                                  resultToStore["displayX"],
+                                  resultToStore["displayY"])
+        for node in nodes:
+            if node["name"] == population:
+                key += "_" + node["key"]
+    return key
+
+
+def getFileStatistics(code, resultToStore):
+    """
+    Return the number of events and the statistics of all parameters of the
+    FCS file of a dataset (see computeFileStatistics()). The statistics are
+    cached in the LRCache per dataset (and compensation and population).
+    Raises a ValueError if the file cannot be processed.
+    """
+
+    key = getFileStatisticsCacheKey(code, resultToStore)
+    statistics = LRCache.get(key)
+    if statistics is None:
+        dataSetFiles = getFileForCode(code)
+        if len(dataSetFiles) != 1:
+            raise ValueError("Could not retrieve the FCS file to process!")
+        statistics = computeFileStatistics(dataSetFiles[0], code,
+                                           resultToStore, None,
+                                           Statistics.PERCENTILES)
+        LRCache.set(key, statistics)
+    return statistics
+
+
+def runInParallel(tasks, uid, resultToStore, itemName, _logger):
+    """
+    Run the tasks (Callables) on a bounded pool of worker_threads threads and
+    return their results (in order of completion). The progress is reported
+    in the message of the job after each completed task.
+    """
+
+    results = []
+    if len(tasks) == 0:
+        return results
+
+    numThreads = max(1, min(parsePropertiesFile()["worker_threads"],
+                            len(tasks)))
+    executor = Executors.newFixedThreadPool(numThreads)
+    try:
+        completionService = ExecutorCompletionService(executor)
+        for task in tasks:
+            completionService.submit(task)
+
+        for i in range(len(tasks)):
+            results.append(completionService.take().get())
+
+            # Inform the client about the progress
+            resultToStore["message"] = "Processed " + str(i + 1) + " of " + \
+                str(len(tasks)) + " " + itemName + "."
+            storeResults(uid, resultToStore)
+    finally:
+        executor.shutdownNow()
+
+    _logger.info("Processed " + str(len(tasks)) + " " + itemName + " with " +
+                 str(numThreads) + " threads.")
+
+    return results
+
+
+class WellStatisticTask(Callable):
+    """Compute the requested statistic for the FCS file of one well."""
+
+    def __init__(self, wellName, code, resultToStore, statisticKey,
+                 statisticsParameters, percentiles):
+        self._wellName = wellName
+        self._code = code
+        self._resultToStore = resultToStore
+        self._statisticKey = statisticKey
+        self._statisticsParameters = statisticsParameters
+        self._percentiles = percentiles
+
+    def call(self):
+        """Return (well name, value, number of events, error message)."""
+
+        try:
+
+            # Use the statistics of the whole file if they are cached
+            result = LRCache.get(getFileStatisticsCacheKey(
+                self._code, self._resultToStore))
+            if result is not None and self._statisticKey != "count" and \
+                self._statisticKey not in result["statistics"].get(
+                    self._statisticsParameters[0], {}):
+                result = None
+
+            if result is None:
+                dataSetFiles = getFileForCode(self._code)
+                if len(dataSetFiles) != 1:
+                    raise ValueError(
+                        "Could not retrieve the FCS file to process!")
+                result = computeFileStatistics(dataSetFiles[0], self._code,
+                                               self._resultToStore,
+                                               self._statisticsParameters,
+                                               self._percentiles)
+
+            if self._statisticKey == "count":
+                value = result["count"]
+            else:
+                parameter = self._statisticsParameters[0]
+                value = result["statistics"][parameter][self._statisticKey]
+            return (self._wellName, value, result["count"], None)
+        except Exception, e:
+            return (self._wellName, None, None, str(e))
+
+
+# Compute the requested statistic for all wells of a plate
+def computePlateStatistics(uid):
+
+    # The results were initialized and stored when the job was registered
+    resultToStore = LRCache.get(uid)
+
+    # Get the parameters
+    platePermId = resultToStore["samplePermId"]
+    paramX = resultToStore["paramX"]
+    statistic = resultToStore["statistic"]
+    population = resultToStore["population"]
+
+    # Set up logging
+    _logger = setUpLogging()
+
+    # Log parameter info
+    _logger.info("Requested statistic " + statistic + " of parameter " +
+                 str(paramX) + " for plate " + platePermId)
+
+    # Check the parameters before processing any file
+    try:
+        (statisticKey, percentiles) = Statistics.parseStatisticName(statistic)
+        statisticsParameters = []
+        if statisticKey != "count":
+            if paramX is None or paramX == "":
+                raise ValueError("No parameter specified.")
+            statisticsParameters = [paramX]
+        if population != "":
+            nodes = Gating.parseGates(resultToStore["gates"], paramX,
+                                      resultToStore["paramY"],
+                                      resultToStore["displayX"],
+                                      resultToStore["displayY"])
+            if population not in [node["name"] for node in nodes]:
+                raise ValueError("Unknown population '" + population + "'.")
+        plate = getWellDataSetsForPlate(platePermId)
+        if plate is None:
+            raise ValueError("Could not retrieve plate with perm id " +
+                             platePermId + ".")
+    except ValueError, e:
+
+        # Build the error message
+        message = str(e)
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    (geometry, wells) = plate
+
+    # Only consider one FCS file per well
+    dataSetsByWell = {}
+    for (wellName, code) in wells:
+        if wellName in dataSetsByWell:
+            _logger.info("Well " + wellName + " has more than one FCS " +
+                         "file: only " + dataSetsByWell[wellName] +
+                         " is used.")
+        else:
+            dataSetsByWell[wellName] = code
+
+    _logger.info("Found " + str(len(dataSetsByWell)) + " wells with FCS " +
+                 "files for plate " + platePermId)
+
+    # Process the wells on a bounded pool of worker threads
+    tasks = [WellStatisticTask(wellName, code, resultToStore, statisticKey,
+                               statisticsParameters, percentiles)
+             for (wellName, code) in dataSetsByWell.items()]
+    valuesByWell = {}
+    countsByWell = {}
+    errors = {}
+    for (wellName, value, count, error) in \
+        runInParallel(tasks, uid, resultToStore, "wells", _logger):
+        valuesByWell[wellName] = value
+        countsByWell[wellName] = count
+        if error is not None:
+            errors[wellName] = error
+            _logger.error("Could not process well " + wellName + ": " + error)
+
+    # Arrange the values in the plate geometry
+    matrix = Plates.buildPlateMatrix(geometry, valuesByWell)
+    matrix["counts"] = Plates.buildPlateMatrix(geometry, countsByWell)["values"]
+    matrix["dataSets"] = dataSetsByWell
+    matrix["errors"] = errors
+    matrix["statistic"] = statistic
+    matrix["parameter"] = paramX
+    matrix["population"] = population
+
+    # Success message
+    message = "Successfully processed " + \
+        str(len(dataSetsByWell) - len(errors)) + " of " + \
+        str(len(dataSetsByWell)) + " wells of plate " + platePermId
+
+    # Log
+    _logger.info(message)
+
+    # Store the results and set the completed flag
+    resultToStore["completed"] = True
+    resultToStore["success"] = True
+    resultToStore["message"] = message
+    resultToStore["data"] = json.dumps(matrix)
+
+
+class FileStatisticsTask(Callable):
+    """Compute the statistics of all parameters of the FCS file of one
+    dataset."""
+
+    def __init__(self, code, resultToStore):
+        self._code = code
+        self._resultToStore = resultToStore
+
+    def call(self):
+        """Return (dataset code, statistics, error message)."""
+
+        try:
+            return (self._code, getFileStatistics(self._code,
+                                                  self._resultToStore), None)
+        except Exception, e:
+            return (self._code, None, str(e))
+
+
+# Compute the statistics of all FCS files of an experiment sample
+def computeExperimentStatistics(uid):
+
+    # The results were initialized and stored when the job was registered
+    resultToStore = LRCache.get(uid)
+
+    # Get the parameters
+    expSamplePermId = resultToStore["samplePermId"]
+    population = resultToStore["population"]
+
+    # Set up logging
+    _logger = setUpLogging()
+
+    # Log parameter info
+    _logger.info("Requested statistics for experiment sample " +
+                 expSamplePermId)
+
+    # Check the parameters before processing any file
+    try:
+        if population != "":
+            nodes = Gating.parseGates(resultToStore["gates"],
+                                      resultToStore["paramX"],
+                                      resultToStore["paramY"],
+                                      resultToStore["displayX"],
+                                      resultToStore["displayY"])
+            if population not in [node["name"] for node in nodes]:
+                raise ValueError("Unknown population '" + population + "'.")
+        dataSets = getDataSetsForExperimentSample(expSamplePermId)
+        if dataSets is None:
+            raise ValueError("Could not retrieve experiment sample with " +
+                             "perm id " + expSamplePermId + ".")
+    except ValueError, e:
+
+        # Build the error message
+        message = str(e)
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    _logger.info("Found " + str(len(dataSets)) + " FCS files for " +
+                 "experiment sample " + expSamplePermId)
+
+    # Process the files on a bounded pool of worker threads
+    tasks = [FileStatisticsTask(code, resultToStore)
+             for (container, sample, code) in dataSets]
+    statisticsByCode = {}
+    errors = {}
+    for (code, statistics, error) in \
+        runInParallel(tasks, uid, resultToStore, "files", _logger):
+        if error is None:
+            statisticsByCode[code] = statistics
+        else:
+            errors[code] = error
+            _logger.error("Could not process dataset " + code + ": " + error)
+
+    # Build the table (one row per file and parameter)
+    rows = []
+    for (container, sample, code) in dataSets:
+        if code not in statisticsByCode:
+            continue
+        statistics = statisticsByCode[code]["statistics"]
+        for parameter in sorted(statistics.keys()):
+            row = [code, container, sample, parameter]
+            for column in _STATISTICS_TABLE_COLUMNS[4:]:
+                row.append(statistics[parameter][column])
+            rows.append(row)
+
+    # Success message
+    message = "Successfully processed " + str(len(statisticsByCode)) + \
+        " of " + str(len(dataSets)) + " files of experiment sample " + \
+        expSamplePermId
+
+    # Log
+    _logger.info(message)
+
+    # Store the results and set the completed flag
+    resultToStore["completed"] = True
+    resultToStore["success"] = True
+    resultToStore["message"] = message
+    resultToStore["data"] = json.dumps({"columns": _STATISTICS_TABLE_COLUMNS,
+                                        "rows": rows, "errors": errors})
+
+
+def extractOverlayFile(fcsFile, code, resultToStore):
+    """
+    Extract maxNumEvents events of paramX and paramY (or, if bins is set, the
+    histogram of paramX in display coordinates, see
+    Statistics.computeHistogram()) from the FCS file of a dataset for an
+    overlay. If a population is set in resultToStore, only the events inside
+    it are considered. The memory needed is charged against the memory
+    budget. Returns a dictionary {"numEvents": ..., "count": ..., "data": ...}
+    or {"numEvents": ..., "count": ..., "histogram": ...}. Raises a
+    ValueError if the file cannot be processed.
+    """
+
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    population = resultToStore["population"]
+    timeRange = resultToStore["timeRange"]
+    histogram = resultToStore["bins"] > 0
+    fileName = os.path.basename(fcsFile)
+
+    # Histograms need all (raw and transformed) events of paramX; events of a
+    # population are selected from all events of paramX and paramY
+    numGatedParameters = 0
+    if population != "":
+        nodes = Gating.parseGates(resultToStore["gates"], paramX, paramY,
+                                  resultToStore["displayX"],
+                                  resultToStore["displayY"])
+        numGatedParameters = len(Gating.getGatedParameters(nodes))
+    if histogram:
+        extractions = [(numGatedParameters + 2, None,
+                        _BYTES_PER_EVALUATED_VALUE)]
+    elif population != "" or timeRange != "":
+        extractions = [(numGatedParameters + 2, None,
+                        _BYTES_PER_EVALUATED_VALUE),
+                       (2, resultToStore["maxNumEvents"],
+                        _BYTES_PER_RETURNED_VALUE)]
+    else:
+        extractions = [(2, resultToStore["maxNumEvents"],
+                        _BYTES_PER_RETURNED_VALUE)]
+    if timeRange != "":
+        extractions.append((1, None, _BYTES_PER_EVALUATED_VALUE))
+    requiredMemoryMB = estimateRequiredMemoryMB(fcsFile, extractions)
+    if requiredMemoryMB is None:
+        raise ValueError("Could not process file " + fileName)
+
+    budget = acquireMemoryBudget(requiredMemoryMB, resultToStore)
+    if budget is None:
+        raise ValueError("Not enough memory to process file " + fileName)
+
+    try:
+
+        reader = FCSReader(java.io.File(fcsFile), True)
+        if not reader.parse():
+            raise ValueError("Could not process file " + fileName)
+
+        parameterNames = reader.getParameterNames()
+        indxX = int(parameterNames.indexOf(paramX))
+        indxY = int(parameterNames.indexOf(paramY))
+        if indxX == -1 or (not histogram and indxY == -1):
+            raise ValueError("Could not find the requested parameters in " +
+                             "file " + fileName)
+
+        compensation = None
+        if resultToStore["compensate"] == "1":
+            compensation = Compensation.getCompensation(reader, code)
+
+        # The file-specific parameters
+        numEventsInFile = int(reader.numEvents())
+        fileResultToStore = dict(resultToStore)
+        fileResultToStore["code"] = code
+        fileResultToStore["numEvents"] = numEventsInFile
+
+        if not histogram:
+            data = selectPlotEvents(reader, indxX, indxY, compensation,
+                                    fileResultToStore)
+            return {"numEvents": numEventsInFile, "count": len(data[0]),
+                    "data": data}
+
+        getColumn = createColumnLoader(reader, code, compensation)
+        count = numEventsInFile
+        mask = getEventMask(reader, code, compensation, getColumn,
+                            fileResultToStore)
+        if mask is not None:
+            count = mask.cardinality()
+        column = getColumn(paramX, resultToStore["displayX"], False)
+        return {"numEvents": numEventsInFile, "count": count,
+                "histogram": Statistics.computeHistogram(
+                    column, _OVERLAY_HISTOGRAM_RESOLUTION, mask)}
+
+    finally:
+
+        # Give the memory back to the budget
+        budget.release(requiredMemoryMB)
+
+
+class OverlayFileTask(Callable):
+    """Extract the events (or the histogram) of the FCS file of one dataset
+    for an overlay."""
+
+    def __init__(self, code, resultToStore):
+        self._code = code
+        self._resultToStore = resultToStore
+
+    def call(self):
+        """Return (dataset code, result, error message)."""
+
+        try:
+            dataSetFiles = getFileForCode(self._code)
+            if len(dataSetFiles) != 1:
+                raise ValueError("Could not retrieve the FCS file to process!")
+            return (self._code, extractOverlayFile(dataSetFiles[0],
+                                                   self._code,
+                                                   self._resultToStore), None)
+        except Exception, e:
+            return (self._code, None, str(e))
+
+
+# Extract the events (or histograms) of several FCS files for an overlay
+def computeOverlay(uid):
+
+    # The results were initialized and stored when the job was registered
+    resultToStore = LRCache.get(uid)
+
+    # Get the parameters
+    paramX = resultToStore["paramX"]
+    paramY = resultToStore["paramY"]
+    population = resultToStore["population"]
+    numBins = resultToStore["bins"]
+
+    # Set up logging
+    _logger = setUpLogging()
+
+    # Check the parameters before processing any file
+    try:
+        try:
+            codes = json.loads(resultToStore["codes"])
+        except ValueError:
+            raise ValueError("The dataset codes could not be decoded.")
+        if not isinstance(codes, list) or len(codes) == 0:
+            raise ValueError("The dataset codes must be a non-empty list.")
+        codes = [str(code) for code in codes]
+        if paramX == "" or (numBins <= 0 and paramY == ""):
+            raise ValueError("No parameter specified.")
+        if resultToStore["timeRange"] != "":
+            TimeChannel.parseTimeRange(resultToStore["timeRange"])
+        if population != "":
+            nodes = Gating.parseGates(resultToStore["gates"], paramX, paramY,
+                                      resultToStore["displayX"],
+                                      resultToStore["displayY"])
+            if population not in [node["name"] for node in nodes]:
+                raise ValueError("Unknown population '" + population + "'.")
+    except ValueError, e:
+
+        # Build the error message
+        message = str(e)
+
+        # Log the error
+        _logger.error(message)
+
+        # Store the results and set the completed flag
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+
+        # Return here
+        return
+
+    # Log parameter info
+    _logger.info("Requested overlay of " + str(len(codes)) + " datasets " +
+                 "for parameters (" + paramX + ", " + paramY + ")")
+
+    # Process the files on a bounded pool of worker threads
+    tasks = [OverlayFileTask(code, resultToStore) for code in codes]
+    files = {}
+    errors = {}
+    for (code, result, error) in \
+        runInParallel(tasks, uid, resultToStore, "files", _logger):
+        if error is None:
+            files[code] = result
+        else:
+            errors[code] = error
+            _logger.error("Could not process dataset " + code + ": " + error)
+
+    overlay = {"codes": codes, "files": files, "errors": errors}
+
+    # Combine the histograms of the files into the same bins
+    if numBins > 0:
+        histograms = [result["histogram"] for result in files.values()
+                      if result["histogram"]["min"] is not None]
+        lower = min([h["min"] for h in histograms] + [float("inf")])
+        upper = max([h["max"] for h in histograms] + [float("-inf")])
+        if lower > upper:
+            (lower, upper) = (0.0, 1.0)
+        width = (upper - lower) / numBins
+        overlay["edges"] = [lower + k * width for k in range(numBins)] + \
+            [upper]
+        for result in files.values():
+            result["counts"] = Statistics.rebinHistogram(
+                result.pop("histogram"), lower, upper, numBins)
+
+    # Success message
+    message = "Successfully processed " + str(len(files)) + " of " + \
+        str(len(codes)) + " files"
+
+    # Log
+    _logger.info(message)
+
+    # Store the results and set the completed flag
+    resultToStore["completed"] = True
+    resultToStore["success"] = True
+    resultToStore["message"] = message
+    resultToStore["data"] = json.dumps(overlay)
@@ -0,0 +1,77 @@
+"""
+Import of the modules of the core plug-ins in the tests.
+
+The plug-ins run in Jython 2.7; the tests of their pure-Python parts run
+under CPython 2.7. Run them from the root of the repository with:
+
+    python2.7 -m unittest discover tests
+
+Outside of Jython, the Java packages imported by the modules are replaced by
+empty placeholders: only the functions that do not use Java classes can be
+tested.
+"""
+
+import os
+import sys
+import types
+import unittest
+
+# Folder of the reporting plug-ins
+_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "core-plugins", "flow", "4", "dss",
+                            "reporting-plugins")
+
+# Top-level packages of the Java classes used by the plug-ins
+_JAVA_PACKAGES = ["java", "jarray", "ch"]
+
+
+class _JavaPlaceholder(types.ModuleType):
+    """Placeholder of a Java package or class: all its attributes are
+    placeholders as well, so that the imports succeed."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        placeholder = _JavaPlaceholder(self.__name__ + "." + name)
+        setattr(self, name, placeholder)
+        return placeholder
+
+
+class _JavaImporter(object):
+    """Import hook that returns placeholders for the Java packages."""
+
+    def find_module(self, fullName, path=None):
+        if fullName.split(".")[0] in _JAVA_PACKAGES:
+            return self
+        return None
+
+    def load_module(self, fullName):
+        if fullName not in sys.modules:
+            module = _JavaPlaceholder(fullName)
+            module.__path__ = []
+            module.__loader__ = self
+            sys.modules[fullName] = module
+        return sys.modules[fullName]
+
+
+def importPlugin(plugin, name):
+    """Import a module of a reporting plug-in.
+
+    @param plugin Name of the plug-in (e.g. "retrieve_fcs_events").
+    @param name Name of the module (e.g. "Plates").
+    @return the module.
+    @throws unittest.SkipTest if the tests do not run in Python 2.
+    """
+
+    if sys.version_info[0] != 2:
+        raise unittest.SkipTest("The plug-ins require Python 2.7.")
+
+    if not sys.platform.startswith("java") and \
+            not any(isinstance(importer, _JavaImporter)
+                    for importer in sys.meta_path):
+        sys.meta_path.append(_JavaImporter())
+
+    folder = os.path.join(_PLUGINS_DIR, plugin)
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+    return __import__(name)
@@ -0,0 +1,75 @@
+"""
+Tests of the scheduler of export_flow_datasets (ExportScheduler.py).
+
+See plugins.py for how to run them.
+"""
+
+import unittest
+
+import plugins
+
+ExportScheduler = plugins.importPlugin("export_flow_datasets",
+                                       "ExportScheduler")
+
+
+class TestExportScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ExportScheduler.ExportScheduler(2, 1)
+
+    def enqueue(self, jobs):
+        for (uid, userId) in jobs:
+            self.scheduler.enqueue(uid, userId)
+
+    def canStart(self, uid):
+        return self.scheduler._canStart(uid)
+
+    def testFirstInFirstOut(self):
+        self.enqueue([("j1", "alice"), ("j2", "bob"), ("j3", "carol")])
+        self.assertTrue(self.canStart("j1"))
+        self.assertFalse(self.canStart("j2"))
+        self.assertFalse(self.canStart("j3"))
+
+        self.assertTrue(self.scheduler.waitForTurn("j1", 0))
+        self.assertTrue(self.canStart("j2"))
+        self.assertEqual(self.scheduler.getQueuePosition("j3"), 2)
+
+    def testMaximumNumberOfJobs(self):
+        self.enqueue([("j1", "alice"), ("j2", "bob"), ("j3", "carol")])
+        self.assertTrue(self.scheduler.waitForTurn("j1", 0))
+        self.assertTrue(self.scheduler.waitForTurn("j2", 0))
+        self.assertFalse(self.canStart("j3"))
+        self.assertFalse(self.scheduler.waitForTurn("j3", 0))
+
+        self.scheduler.release("j1")
+        self.assertTrue(self.canStart("j3"))
+        self.assertEqual(self.scheduler.getNumberOfRunningJobs(), 1)
+
+    def testUsersDoNotHoldBackOthers(self):
+        # The second job of alice waits for her first one; bob's job does not
+        self.enqueue([("j1", "alice"), ("j2", "alice"), ("j3", "bob")])
+        self.assertTrue(self.scheduler.waitForTurn("j1", 0))
+        self.assertFalse(self.canStart("j2"))
+        self.assertTrue(self.canStart("j3"))
+
+        self.scheduler.release("j1")
+        self.assertTrue(self.canStart("j2"))
+        self.assertFalse(self.canStart("j3"))
+
+    def testReleaseQueuedJob(self):
+        self.enqueue([("j1", "alice"), ("j2", "bob")])
+        self.scheduler.release("j1")
+        self.assertEqual(self.scheduler.getQueuePosition("j1"), 0)
+        self.assertTrue(self.canStart("j2"))
+
+    def testSetLimits(self):
+        self.enqueue([("j1", "alice"), ("j2", "alice")])
+        self.assertTrue(self.scheduler.waitForTurn("j1", 0))
+        self.assertFalse(self.canStart("j2"))
+
+        self.scheduler.setLimits(2, 2)
+        self.assertTrue(self.canStart("j2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Tests of the pure-Python FCS reader (tools/fcsreader.py).
+
+Run from the root of the repository with (the tests of the plug-ins are
+skipped, see plugins.py):
+
+    python3 -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Reason to skip the tests, if any
+_SKIP_REASON = None
+if sys.version_info[0] < 3:
+    _SKIP_REASON = "The FCS reader requires Python 3."
+else:
+    try:
+        import numpy as np
+    except ImportError:
+        _SKIP_REASON = "The FCS reader requires NumPy."
+
+if _SKIP_REASON is None:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                    "tools"))
+    from fcsreader import FCSReader
+
+
+def writeFCS(filename, keywords, data):
+    """Write a minimal FCS 3.0 file with given keywords and DATA segment."""
+
+    # The DATA offsets are in the TEXT segment as well: their (fixed) width
+    # does not depend on the values
+    keywords = dict(keywords)
+    keywords["$BEGINDATA"] = "0" * 10
+    keywords["$ENDDATA"] = "0" * 10
+    beginText = 58
+
+    def buildText():
+        return ("/" + "".join(key + "/" + value + "/"
+                              for (key, value) in sorted(keywords.items()))
+                ).encode("latin-1")
+
+    endText = beginText + len(buildText()) - 1
+    beginData = endText + 1
+    endData = beginData + len(data) - 1
+    keywords["$BEGINDATA"] = "%010d" % beginData
+    keywords["$ENDDATA"] = "%010d" % endData
+    text = buildText()
+
+    header = b"FCS3.0    " + b"".join(
+        ("%8d" % value).encode("ascii")
+        for value in [beginText, endText, beginData, endData, 0, 0])
+    with open(filename, "wb") as f:
+        f.write(header + text + data)
+
+
+def standardKeywords(numEvents, bits, ranges, dataType):
+    """Return the standard keywords of a list mode file."""
+
+    keywords = {"$TOT": str(numEvents), "$PAR": str(len(bits)),
+                "$MODE": "L", "$BYTEORD": "1,2,3,4",
+                "$DATATYPE": dataType}
+    for (i, (b, r)) in enumerate(zip(bits, ranges)):
+        p = "$P" + str(i + 1)
+        keywords[p + "N"] = "P" + str(i + 1)
+        keywords[p + "B"] = str(b)
+        keywords[p + "R"] = str(r)
+        keywords[p + "E"] = "0,0"
+    return keywords
+
+
+@unittest.skipIf(_SKIP_REASON is not None, _SKIP_REASON)
+class TestFCSReader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.fcs")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testIntegers(self):
+        values = np.array([[1, 70000], [2, 3], [1023, 65536]], dtype="<u4")
+        keywords = standardKeywords(3, [32, 32], [1024, 262144], "I")
+        writeFCS(self.filename, keywords, values.tobytes())
+
+        for memoryMap in [True, False]:
+            with FCSReader(self.filename, True, memoryMap) as reader:
+                self.assertTrue(reader.parse())
+                self.assertEqual(reader.getParameterNames(), ["P1", "P2"])
+                np.testing.assert_array_equal(
+                    reader.getDataPerColumnIndices([0, 1]),
+                    values.astype(np.float64))
+
+    def testIntegersAreMaskedByRange(self):
+        values = np.array([[1029], [5]], dtype="<u2")
+        keywords = standardKeywords(2, [16], [1024], "I")
+        writeFCS(self.filename, keywords, values.tobytes())
+
+        with FCSReader(self.filename, True) as reader:
+            self.assertTrue(reader.parse())
+            np.testing.assert_array_equal(
+                reader.getDataPerColumnIndex(0, 2, False), [5.0, 5.0])
+
+    def testFloats(self):
+        values = np.array([[0.5, -1.25], [3.0, 1e6], [2.5, 0.0]],
+                          dtype="<f4")
+        keywords = standardKeywords(3, [32, 32], [1024, 1024], "F")
+        writeFCS(self.filename, keywords, values.tobytes())
+
+        with FCSReader(self.filename, True) as reader:
+            self.assertTrue(reader.parse())
+            np.testing.assert_array_equal(
+                reader.getDataPerColumnNames(["P2"]),
+                values[:, 1:].astype(np.float64))
+
+            # Sampling returns regularly spaced events
+            np.testing.assert_array_equal(
+                reader.getDataPerColumnIndex(0, 2, True), [0.5, 3.0])
+
+    def testBitPackedIntegers(self):
+        # Two parameters of 10 and 6 bits, most significant bit first
+        values = [(1023, 63), (512, 1), (3, 32)]
+        bits = "".join(format(a, "010b") + format(b, "06b")
+                       for (a, b) in values)
+        data = bytes(int(bits[i:i + 8], 2) for i in range(0, len(bits), 8))
+        keywords = standardKeywords(3, [10, 6], [1024, 64], "I")
+        writeFCS(self.filename, keywords, data)
+
+        with FCSReader(self.filename, True) as reader:
+            self.assertTrue(reader.parse())
+            np.testing.assert_array_equal(
+                reader.getDataPerColumnIndices([0, 1]),
+                np.array(values, dtype=np.float64))
+
+    def testClose(self):
+        values = np.arange(8, dtype="<u2").reshape(4, 2)
+        keywords = standardKeywords(4, [16, 16], [1024, 1024], "I")
+        writeFCS(self.filename, keywords, values.tobytes())
+
+        reader = FCSReader(self.filename, True, True)
+        self.assertTrue(reader.parse())
+        column = reader.getDataPerColumnIndex(1, 4, False)
+
+        # Parsing again remaps the file
+        self.assertTrue(reader.parse())
+        reader.close()
+        reader.close()
+
+        # The returned events do not depend on the memory map
+        np.testing.assert_array_equal(column, [1.0, 3.0, 5.0, 7.0])
+
+        # The data is available again after parsing
+        self.assertTrue(reader.parse())
+        np.testing.assert_array_equal(
+            reader.getDataPerColumnIndex(0, 4, False), [0.0, 2.0, 4.0, 6.0])
+        reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Tests of the checksum manifest of export_flow_datasets (Manifest.py).
+
+See plugins.py for how to run them.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import plugins
+
+Manifest = plugins.importPlugin("export_flow_datasets", "Manifest")
+
+# Digest of an empty file
+_EMPTY_SHA256 = \
+    "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testFormatManifest(self):
+        entries = {u"b/f2.fcs": (12, 0xabc, "ff" * 32),
+                   u"a/f1.fcs": (0, 0, _EMPTY_SHA256)}
+        self.assertEqual(Manifest.formatManifest(entries),
+                         u"path\tsize\tcrc32\tsha256\n" +
+                         u"a/f1.fcs\t0\t00000000\t" + _EMPTY_SHA256 + u"\n" +
+                         u"b/f2.fcs\t12\t00000abc\t" + "ff" * 32 + u"\n")
+
+    def testWriteAndReadManifest(self):
+        entries = {u"Plate 1/A1 \u00e9.fcs": (3000000000, 0xffffffff,
+                                              "00" * 32),
+                   u"tubes/t1.fcs": (5, 0x1234, _EMPTY_SHA256)}
+        Manifest.writeManifest(self.folder, entries)
+        self.assertEqual(Manifest.readManifest(self.folder), entries)
+
+    def testReadMissingManifest(self):
+        self.assertEqual(Manifest.readManifest(self.folder), {})
+
+    def testReadInvalidLines(self):
+        f = open(os.path.join(self.folder, Manifest.MANIFEST_FILE_NAME), "wb")
+        try:
+            f.write("path\tsize\tcrc32\tsha256\n"
+                    "ok.fcs\t1\t0000000a\t" + _EMPTY_SHA256 + "\n"
+                    "missing.fcs\t1\n"
+                    "size.fcs\tx\t0000000a\t" + _EMPTY_SHA256 + "\n")
+        finally:
+            f.close()
+        self.assertEqual(Manifest.readManifest(self.folder),
+                         {u"ok.fcs": (1, 10, _EMPTY_SHA256)})
+
+
+if __name__ == "__main__":
+    unittest.main()
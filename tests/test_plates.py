@@ -0,0 +1,57 @@
+"""
+Tests of the plate layout of retrieve_fcs_events (Plates.py).
+
+See plugins.py for how to run them.
+"""
+
+import unittest
+
+import plugins
+
+Plates = plugins.importPlugin("retrieve_fcs_events", "Plates")
+
+
+class TestPlates(unittest.TestCase):
+
+    def testParseGeometry(self):
+        self.assertEqual(Plates.parseGeometry("96_WELLS_8X12"), (8, 12))
+        self.assertEqual(Plates.parseGeometry(" 384_wells_16x24 "), (16, 24))
+        self.assertEqual(Plates.parseGeometry("1536_WELLS_32X48"), (32, 48))
+
+    def testParseInvalidGeometry(self):
+        for geometry in [None, "", "96_WELLS", "WELLS_8X12", "96_WELLS_8X",
+                         "96 WELLS 8X12"]:
+            self.assertEqual(Plates.parseGeometry(geometry), None)
+
+    def testParseWellName(self):
+        self.assertEqual(Plates.parseWellName("A1"), (0, 0))
+        self.assertEqual(Plates.parseWellName("b07"), (1, 6))
+        self.assertEqual(Plates.parseWellName("AA12"), (26, 11))
+        self.assertEqual(Plates.parseWellName("1A"), None)
+        self.assertEqual(Plates.parseWellName(None), None)
+
+    def testRowLabels(self):
+        for row in [0, 7, 25, 26, 51, 700]:
+            label = Plates.getRowLabel(row)
+            self.assertEqual(Plates.parseWellName(label + "1"), (row, 0))
+        self.assertEqual(Plates.getRowLabel(26), "AA")
+
+    def testBuildPlateMatrix(self):
+        matrix = Plates.buildPlateMatrix("96_WELLS_8X12",
+                                         {"A1": 1, "H12": 2, "I1": 3,
+                                          "?": 4})
+        self.assertEqual((matrix["numRows"], matrix["numColumns"]), (8, 12))
+        self.assertEqual(matrix["values"][0][0], 1)
+        self.assertEqual(matrix["values"][7][11], 2)
+        self.assertEqual(matrix["unplaced"], ["?", "I1"])
+
+    def testBuildPlateMatrixWithoutGeometry(self):
+        # The smallest standard plate with all wells is used
+        matrix = Plates.buildPlateMatrix(None, {"A1": 1, "I13": 2})
+        self.assertEqual((matrix["numRows"], matrix["numColumns"]), (16, 24))
+        self.assertEqual(matrix["rowLabels"][:3], ["A", "B", "C"])
+        self.assertEqual(matrix["unplaced"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
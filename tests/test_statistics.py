@@ -0,0 +1,57 @@
+"""
+Tests of the statistics of retrieve_fcs_events (Statistics.py).
+
+See plugins.py for how to run them.
+"""
+
+import unittest
+
+import plugins
+
+Statistics = plugins.importPlugin("retrieve_fcs_events", "Statistics")
+
+
+class TestStatistics(unittest.TestCase):
+
+    def testParseStatisticName(self):
+        for name in ["count", "mean", "sd", "cv", "min", "max", "median"]:
+            self.assertEqual(Statistics.parseStatisticName(name), (name, []))
+
+    def testParsePercentile(self):
+        self.assertEqual(Statistics.parseStatisticName("p95"), ("p95", [95]))
+        self.assertEqual(Statistics.parseStatisticName("p0"), ("p0", [0]))
+        self.assertEqual(Statistics.parseStatisticName("p100.0"),
+                         ("p100", [100]))
+        self.assertEqual(Statistics.parseStatisticName("p2.5"),
+                         ("p2.5", [2.5]))
+
+    def testParseInvalidStatisticName(self):
+        for name in ["", "p", "p101", "p-1", "pX", "average", "Mean"]:
+            self.assertRaises(ValueError, Statistics.parseStatisticName, name)
+
+    def testComputeHistogram(self):
+        histogram = Statistics.computeHistogram([0.0, 1.0, 2.5, 4.0,
+                                                 float("nan")], 4)
+        self.assertEqual((histogram["min"], histogram["max"]), (0.0, 4.0))
+        self.assertEqual(histogram["counts"], [1, 1, 1, 1])
+
+    def testRebinHistogram(self):
+        # Bins [0, 1), [1, 2), [2, 3), [3, 4] with centers 0.5 ... 3.5
+        histogram = {"min": 0.0, "max": 4.0, "counts": [1, 2, 3, 4]}
+        self.assertEqual(Statistics.rebinHistogram(histogram, 0.0, 4.0, 2),
+                         [3, 7])
+        self.assertEqual(Statistics.rebinHistogram(histogram, 0.0, 8.0, 4),
+                         [3, 7, 0, 0])
+
+        # Counts outside of the new range go to the first or last bin
+        self.assertEqual(Statistics.rebinHistogram(histogram, 1.0, 3.0, 2),
+                         [3, 7])
+
+    def testRebinEmptyHistogram(self):
+        histogram = {"min": None, "max": None, "counts": [0, 0]}
+        self.assertEqual(Statistics.rebinHistogram(histogram, 0.0, 1.0, 3),
+                         [0, 0, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,475 @@
+"""
+Pure-Python FCS 2.0/3.0/3.1 reader for offline (CPython) tools.
+
+The reader exposes the same keyword and parameter API as the Java reader
+used by the openBIS plug-ins (ch.ethz.scu.obit.flow.readers.FCSReader):
+
+    reader = FCSReader("/path/to/file.fcs", True)
+    if reader.parse():
+        names = reader.getParameterNames()
+        date = reader.getStandardKeyword("$DATE")
+        column = reader.getDataPerColumnIndex(names.index("FSC-A"),
+                                              reader.numEvents(), False)
+
+The TEXT segment is only split into keywords when a keyword is first
+requested, and the DATA segment is decoded with NumPy dtype views (list mode,
+any byte order, $DATATYPE I, F, D and A, including bit-packed integers). The
+DATA segment can be memory-mapped, in which case only the requested columns
+are read from disk.
+
+Requires NumPy.
+"""
+
+import mmap
+
+import numpy as np
+
+
+class FCSReader(object):
+    """Reader of FCS 2.0, 3.0 and 3.1 files."""
+
+    # Supported versions
+    VERSIONS = ["FCS2.0", "FCS3.0", "FCS3.1"]
+
+    def __init__(self, filename, readData=False, memoryMap=True):
+        """Constructor
+
+        @param filename Full path of the FCS file.
+        @param readData If True, the DATA segment is made available by
+               parse(); otherwise only the HEADER and TEXT segments are read.
+        @param memoryMap If True (default), the DATA segment is memory-mapped
+               and only the requested columns are read; otherwise it is read
+               into memory at once.
+        """
+
+        self.filename = filename
+        self.readData = readData
+        self.memoryMap = memoryMap
+        self.version = None
+
+        self._text = None
+        self._delimiter = None
+        self._keywords = None
+        self._segments = {}
+        self._raw = None
+        self._data = None
+        self._mmap = None
+        self._parametersAttr = None
+
+    def parse(self):
+        """Parse the file.
+
+        The HEADER is parsed and the TEXT segment is read (it is split into
+        keywords on first access). If the reader was created with readData
+        True, the DATA segment is prepared for decoding.
+
+        @return True if the file could be parsed, False otherwise.
+        """
+
+        try:
+            with open(self.filename, "rb") as f:
+                self._parseHeader(f)
+                (begin, end) = self._segments["TEXT"]
+                f.seek(begin)
+                self._text = f.read(end - begin + 1)
+            if len(self._text) < 2:
+                return False
+            self._delimiter = self._text[0:1]
+            self._keywords = None
+            if self.readData:
+                self._prepareData()
+        except (IOError, OSError, ValueError):
+            return False
+
+        return True
+
+    def close(self):
+        """Release the memory map of the DATA segment (if any). The data is
+        not available anymore until the file is parsed again."""
+
+        # The views of the memory map must be released before it is closed
+        self._raw = None
+        self._data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    # ---------------------------------------------------------------------
+    # Keywords
+    # ---------------------------------------------------------------------
+
+    def getStandardKeyword(self, key):
+        """Return the value of a standard (i.e. starting with $) keyword, or
+        None if it is not set.
+
+        @param key Name of the keyword (case-insensitive), e.g. "$DATE".
+        @return value of the keyword or None.
+        """
+
+        key = key.upper()
+        if not key.startswith("$"):
+            key = "$" + key
+        return self.getAllKeywords().get(key)
+
+    def getCustomKeyword(self, key):
+        """Return the value of a custom (i.e. not starting with $) keyword, or
+        None if it is not set.
+
+        @param key Name of the keyword (case-insensitive).
+        @return value of the keyword or None.
+        """
+
+        return self.getAllKeywords().get(key.upper())
+
+    def getAllKeywords(self):
+        """Return all keywords of the TEXT (and supplemental TEXT) segments.
+
+        The keywords are parsed the first time this is called.
+
+        @return dictionary of the keyword values by (upper-case) name.
+        """
+
+        if self._keywords is None:
+            if self._text is None:
+                raise ValueError("The file has not been parsed.")
+            self._keywords = self._splitKeywords(self._text, self._delimiter)
+            self._readSupplementalText()
+        return self._keywords
+
+    def numEvents(self):
+        """Return the number of events ($TOT)."""
+        return int(self.getStandardKeyword("$TOT"))
+
+    def numParameters(self):
+        """Return the number of parameters ($PAR)."""
+        return int(self.getStandardKeyword("$PAR"))
+
+    def getParameterNames(self):
+        """Return the names ($PnN) of all parameters.
+
+        @return list of parameter names; the index in the list is the index
+                of the column.
+        """
+
+        return [self.getStandardKeyword("$P" + str(i) + "N")
+                for i in range(1, self.numParameters() + 1)]
+
+    @property
+    def parametersAttr(self):
+        """Dictionary with the attributes of the parameters, as stored in
+        the {PREFIX}_FCSFILE_PARAMETERS property of the datasets: numEvents,
+        numParameters and, for parameter n, PnN, PnS, PnR, PnB, PnE, PnG,
+        PnV, PnDISPLAY ("LIN" or "LOG") and PnCHANNELTYPE (BD Influx only).
+        """
+
+        if self._parametersAttr is None:
+            attr = {"numEvents": str(self.numEvents()),
+                    "numParameters": str(self.numParameters())}
+            for i in range(1, self.numParameters() + 1):
+                p = "P" + str(i)
+                for suffix in ["N", "S", "R", "B", "E", "G", "V"]:
+                    value = self.getStandardKeyword("$" + p + suffix)
+                    attr[p + suffix] = "" if value is None else value
+                display = self.getCustomKeyword(p + "DISPLAY")
+                if display is None:
+                    display = "LOG" if self._decades(i - 1) > 0 else "LIN"
+                attr[p + "DISPLAY"] = display
+                channelType = self.getCustomKeyword(p + "CHANNELTYPE")
+                if channelType is not None:
+                    attr[p + "CHANNELTYPE"] = channelType
+            self._parametersAttr = attr
+        return self._parametersAttr
+
+    # ---------------------------------------------------------------------
+    # Data
+    # ---------------------------------------------------------------------
+
+    def getDataPerColumnIndex(self, columnIndex, numEvents, sample):
+        """Return the events of one parameter.
+
+        @param columnIndex 0-based index of the parameter.
+        @param numEvents Number of events to return.
+        @param sample If True, the events are regularly sampled from the whole
+               file; otherwise, the first numEvents events are returned.
+        @return NumPy float64 array.
+        """
+
+        return self.getDataPerColumnIndices([columnIndex], numEvents,
+                                            sample)[:, 0]
+
+    def getDataPerColumnIndices(self, columnIndices, numEvents=None,
+                                sample=False):
+        """Return the events of several parameters. Only the requested
+        columns are decoded (and, if the DATA segment is memory-mapped, read
+        from disk).
+
+        @param columnIndices List of 0-based indices of the parameters.
+        @param numEvents (optional) Number of events to return (default: all).
+        @param sample If True, the events are regularly sampled from the whole
+               file; otherwise, the first numEvents events are returned.
+        @return NumPy float64 array with one column per parameter.
+        """
+
+        data = self._getData()
+        totalEvents = self.numEvents()
+        if numEvents is None:
+            numEvents = totalEvents
+        numEvents = max(0, min(numEvents, totalEvents))
+        if sample and numEvents > 0:
+            rows = (np.arange(numEvents, dtype=np.int64) * totalEvents) // \
+                numEvents
+        else:
+            rows = slice(0, numEvents)
+
+        result = np.empty((numEvents, len(columnIndices)), dtype=np.float64)
+        for (k, columnIndex) in enumerate(columnIndices):
+            result[:, k] = self._decodeColumn(data, columnIndex, rows)
+        return result
+
+    def getDataPerColumnNames(self, names, numEvents=None, sample=False):
+        """Return the events of the parameters with given names (see
+        getDataPerColumnIndices()).
+
+        @param names List of parameter names ($PnN).
+        @return NumPy float64 array with one column per parameter.
+        @throws ValueError if a parameter does not exist.
+        """
+
+        parameterNames = self.getParameterNames()
+        return self.getDataPerColumnIndices(
+            [parameterNames.index(name) for name in names], numEvents, sample)
+
+    # ---------------------------------------------------------------------
+    # Private methods
+    # ---------------------------------------------------------------------
+
+    def _parseHeader(self, f):
+        """Parse the HEADER segment and store the segment offsets."""
+
+        header = f.read(58)
+        if len(header) < 58:
+            raise ValueError("Invalid HEADER segment.")
+        self.version = header[0:6].decode("ascii")
+        if self.version not in self.VERSIONS:
+            raise ValueError("Unsupported version " + self.version + ".")
+
+        offsets = []
+        for i in range(6):
+            field = header[10 + 8 * i:18 + 8 * i].strip()
+            offsets.append(int(field) if len(field) > 0 else 0)
+        self._segments["TEXT"] = (offsets[0], offsets[1])
+        self._segments["DATA"] = (offsets[2], offsets[3])
+        self._segments["ANALYSIS"] = (offsets[4], offsets[5])
+
+    @staticmethod
+    def _splitKeywords(text, delimiter):
+        """Split a TEXT segment into keywords. A doubled delimiter is part
+        of a key or value."""
+
+        # Replace the escaped delimiters before splitting
+        placeholder = b"\x00"
+        fields = text[1:].replace(delimiter + delimiter, placeholder) \
+            .split(delimiter)
+        if len(fields) > 0 and fields[-1] == b"":
+            fields = fields[:-1]
+
+        keywords = {}
+        for i in range(0, len(fields) - 1, 2):
+            key = fields[i].replace(placeholder, delimiter)
+            value = fields[i + 1].replace(placeholder, delimiter)
+            keywords[key.decode("latin-1").strip().upper()] = \
+                value.decode("utf-8", "replace").strip()
+        return keywords
+
+    def _readSupplementalText(self):
+        """Add the keywords of the supplemental TEXT segment (FCS 3.x)."""
+
+        begin = int(self._keywords.get("$BEGINSTEXT", "0") or 0)
+        end = int(self._keywords.get("$ENDSTEXT", "0") or 0)
+        if begin <= 0 or end <= begin:
+            return
+        with open(self.filename, "rb") as f:
+            f.seek(begin)
+            text = f.read(end - begin + 1)
+        if len(text) > 1:
+            for (key, value) in self._splitKeywords(text, text[0:1]).items():
+                self._keywords.setdefault(key, value)
+
+    def _decades(self, columnIndex):
+        """Return the number of decades of logarithmic amplification
+        (first value of $PnE) of a parameter."""
+
+        value = self.getStandardKeyword("$P" + str(columnIndex + 1) + "E")
+        try:
+            return float(value.split(",")[0])
+        except (AttributeError, ValueError, IndexError):
+            return 0.0
+
+    def _dataSegment(self):
+        """Return the (begin, end) offsets of the DATA segment. Files larger
+        than 99,999,999 bytes store them in $BEGINDATA and $ENDDATA."""
+
+        (begin, end) = self._segments["DATA"]
+        if begin == 0 and end == 0:
+            begin = int(self.getStandardKeyword("$BEGINDATA"))
+            end = int(self.getStandardKeyword("$ENDDATA"))
+        return (begin, end)
+
+    def _byteOrder(self):
+        """Return the NumPy byte order of $BYTEORD."""
+
+        order = self.getStandardKeyword("$BYTEORD")
+        order = "".join(order.split()) if order is not None else "1,2,3,4"
+        if order in ["1,2,3,4", "1,2", "1"]:
+            return "<"
+        if order in ["4,3,2,1", "2,1"]:
+            return ">"
+        raise ValueError("Unsupported byte order " + order + ".")
+
+    def _bits(self):
+        """Return the number of bits ($PnB) of each parameter."""
+
+        bits = []
+        for i in range(1, self.numParameters() + 1):
+            value = self.getStandardKeyword("$P" + str(i) + "B")
+            bits.append(value)
+        return bits
+
+    def _prepareData(self):
+        """Check the DATA segment and map it (or read it) as raw bytes."""
+
+        mode = self.getStandardKeyword("$MODE")
+        if mode is not None and mode.upper() != "L":
+            raise ValueError("Only list mode data is supported.")
+
+        (begin, end) = self._dataSegment()
+        length = end - begin + 1
+        if length <= 0:
+            self._raw = np.zeros(0, dtype=np.uint8)
+            return
+
+        self.close()
+        if self.memoryMap:
+            with open(self.filename, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._raw = np.frombuffer(self._mmap, dtype=np.uint8,
+                                      count=length, offset=begin)
+        else:
+            with open(self.filename, "rb") as f:
+                f.seek(begin)
+                self._raw = np.frombuffer(f.read(length), dtype=np.uint8)
+
+    def _getData(self):
+        """Return the decoded (but not converted) view of the DATA segment:
+        a structured array with one field per parameter for byte-aligned
+        data, or a bit matrix for bit-packed integers."""
+
+        if self._data is not None:
+            return self._data
+        if not self.readData:
+            raise ValueError("The reader was created without data.")
+
+        numEvents = self.numEvents()
+        numParameters = self.numParameters()
+        dataType = (self.getStandardKeyword("$DATATYPE") or "").upper()
+        bits = self._bits()
+
+        if dataType in ["F", "D"]:
+            itemType = "f4" if dataType == "F" else "f8"
+            dtype = np.dtype([("p" + str(i), self._byteOrder() + itemType)
+                              for i in range(numParameters)])
+            self._data = ("fields", self._raw[:numEvents * dtype.itemsize]
+                          .view(dtype))
+
+        elif dataType == "I":
+            bits = [int(b) for b in bits]
+            if all(b in [8, 16, 32, 64] for b in bits):
+                order = self._byteOrder()
+                dtype = np.dtype([("p" + str(i), order + "u" + str(b // 8))
+                                  for (i, b) in enumerate(bits)])
+                self._data = ("fields", self._raw[:numEvents * dtype.itemsize]
+                              .view(dtype))
+            else:
+                # Bit-packed integers: the values are stored one after the
+                # other without padding, most significant bit first
+                bitsPerEvent = sum(bits)
+                numBytes = (numEvents * bitsPerEvent + 7) // 8
+                self._data = ("bits", (bits, bitsPerEvent,
+                                       self._raw[:numBytes]))
+
+        elif dataType == "A":
+            self._data = ("ascii", self._decodeAscii(bits, numEvents))
+
+        else:
+            raise ValueError("Unsupported data type " + dataType + ".")
+
+        return self._data
+
+    def _decodeAscii(self, bits, numEvents):
+        """Decode ASCII data (fixed width, or delimited if $PnB is *)."""
+
+        numParameters = len(bits)
+        if all(b == "*" for b in bits):
+            values = np.array(self._raw.tobytes().split(), dtype=np.float64)
+        else:
+            widths = [int(b) for b in bits]
+            dtype = np.dtype([("p" + str(i), "S" + str(w))
+                              for (i, w) in enumerate(widths)])
+            records = self._raw[:numEvents * dtype.itemsize].view(dtype)
+            values = np.column_stack([records["p" + str(i)].astype(np.float64)
+                                      for i in range(numParameters)])
+        return values[:numEvents * numParameters].reshape(numEvents,
+                                                          numParameters)
+
+    def _rangeMask(self, columnIndex, bits):
+        """Return the bit mask to apply to an integer parameter: values must
+        be masked by $PnR - 1 if $PnR is a power of 2 smaller than 2^$PnB."""
+
+        value = self.getStandardKeyword("$P" + str(columnIndex + 1) + "R")
+        try:
+            rangeMax = int(float(value))
+        except (TypeError, ValueError):
+            return None
+        if 0 < rangeMax < (1 << bits) and rangeMax & (rangeMax - 1) == 0:
+            return rangeMax - 1
+        return None
+
+    def _decodeColumn(self, data, columnIndex, rows):
+        """Decode the selected events of one parameter as float64."""
+
+        (kind, content) = data
+        if kind == "ascii":
+            return content[rows, columnIndex]
+
+        if kind == "fields":
+            column = content["p" + str(columnIndex)][rows]
+            if column.dtype.kind == "u":
+                bits = column.dtype.itemsize * 8
+                mask = self._rangeMask(columnIndex, bits)
+                if mask is not None:
+                    column = column & mask
+            return column.astype(np.float64)
+
+        # Bit-packed integers: unpack only the bytes of the requested bits
+        (bits, bitsPerEvent, raw) = content
+        numBits = bits[columnIndex]
+        offset = sum(bits[:columnIndex])
+        numEvents = self.numEvents()
+        events = np.arange(numEvents, dtype=np.int64)[rows]
+        start = events * bitsPerEvent + offset
+        values = np.zeros(len(events), dtype=np.uint64)
+        for b in range(numBits):
+            position = start + b
+            bit = (raw[position // 8] >> (7 - position % 8).astype(np.uint8)) \
+                & 1
+            values = (values << np.uint64(1)) | bit.astype(np.uint64)
+        mask = self._rangeMask(columnIndex, numBits)
+        if mask is not None:
+            values = values & np.uint64(mask)
+        return values.astype(np.float64)